@@ -0,0 +1,6 @@
+"""
+Benchmarks for the stmpy runtime.
+
+Run single modules with `python -m benchmarks.<module>`, or the whole suite
+with `python -m benchmarks`, which writes the results to a JSON file.
+"""
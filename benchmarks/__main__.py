@@ -0,0 +1,162 @@
+"""
+Run the benchmark suite and write the results to a JSON file.
+
+    python -m benchmarks [--quick] [--output results.json] [--compare old.json] [case ...]
+
+Each case runs one of the benchmark modules with fixed parameters. The
+results file records the commit, the Python version and the platform with
+the measurements of each case, so that runs can be compared over time. With
+`--compare`, the measurements are also printed next to those of an earlier
+results file. Higher is better for rates (`*_per_s`), lower for times.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+from . import checkpoint
+from . import defer
+from . import dispatch
+from . import doaction
+from . import export
+from . import fanin
+from . import machines
+from . import timers
+
+
+def _dispatch(quick):
+    events = 20000 if quick else 200000
+    return {
+        "events_per_s": dispatch.run(events, 50, 20),
+        "journal_events_per_s": dispatch.run(events, 50, 20, journal=True),
+        "no_recorder_events_per_s": dispatch.run(events, 50, 20, flight_recorder=0),
+    }
+
+
+def _timers(quick):
+    size = 10000 if quick else 100000
+    result = {}
+    for backend in timers.BACKENDS:
+        r = timers.run(backend, size, size)
+        for key in ["start_ns", "restart_ns", "stop_ns", "expire_ns"]:
+            result["{}_{}".format(backend, key)] = r[key]
+    return result
+
+
+def _defer(quick):
+    events = 2000 if quick else 10000
+    return {"seconds": defer.run(events, 100)}
+
+
+def _fanin(quick):
+    messages = 10000 if quick else 100000
+    return {"items_per_s": fanin.run(messages, 1000)}
+
+
+def _doaction(quick):
+    rounds = 200 if quick else 2000
+    return {
+        "thread_rounds_per_s": doaction.run(rounds),
+        "pool_rounds_per_s": doaction.run(rounds, 4),
+    }
+
+
+def _export(quick):
+    states = 50 if quick else 200
+    result = export.run(states, 20)
+    return {"{}_seconds".format(name): elapsed for name, elapsed in result.items()}
+
+
+def _machines(quick):
+    count = 5000 if quick else 50000
+    seconds, size, _ = machines.run(machines.create_typed_machines, count)
+    return {"typed_seconds": seconds, "typed_bytes_per_machine": size}
+
+
+def _checkpoint(quick):
+    return checkpoint.run(10000 if quick else 100000)
+
+
+CASES = {
+    "dispatch": _dispatch,
+    "timers": _timers,
+    "defer": _defer,
+    "fanin": _fanin,
+    "doaction": _doaction,
+    "export": _export,
+    "machines": _machines,
+    "checkpoint": _checkpoint,
+}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_results(results, previous=None):
+    for case, values in results.items():
+        for key, value in values.items():
+            line = "{:>10} {:>28} {:>14.6g}".format(case, key, value)
+            old = (previous or {}).get(case, {}).get(key)
+            if old:
+                line += " {:>14.6g} {:>7.2f}x".format(old, value / old)
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("cases", nargs="*", help=", ".join(CASES))
+    parser.add_argument("--quick", action="store_true", help="smaller workloads")
+    parser.add_argument("--output", help="results file, by default in .benchmarks/")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    args = parser.parse_args(argv)
+    for case in args.cases:
+        if case not in CASES:
+            parser.error("unknown case {}".format(case))
+    commit = _commit()
+    started = datetime.datetime.now(datetime.timezone.utc)
+    results = {}
+    for case in args.cases or list(CASES):
+        print("running {}...".format(case), file=sys.stderr)
+        results[case] = CASES[case](args.quick)
+    report = {
+        "commit": commit,
+        "date": started.isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "results": results,
+    }
+    output = args.output
+    if output is None:
+        output = os.path.join(
+            ".benchmarks",
+            "{}-{}.json".format(started.strftime("%Y%m%dT%H%M%S"), commit or "unknown"),
+        )
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)["results"]
+    _print_results(results, previous)
+    print("results written to {}".format(output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Measure checkpoints of a driver with many machines, and restarts from them.
+
+    python -m benchmarks.checkpoint [--machines 100000]
+
+The machines are created by a `MachineType`. Half of them are busy with an
+active timer, and the other half are idle with a deferred event. While the
+driver runs, the benchmark takes a checkpoint, and reports how long the loop
+of the driver paused to capture its state, how long the whole checkpoint
+took, and the size of the file. It then restarts the machines in a new
+driver, and reports how long it took to create and add them, to restore
+them from the checkpoint, and, for comparison, to bring them into the same
+state again by executing their initial transitions and events.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from stmpy import Driver
+from stmpy.checkpoint import _capture
+
+from .machines import create_typed_machines
+
+
+def _prepare(driver):
+    # half of the machines start a timer, the others defer an event
+    driver.send_many(
+        ("start" if i % 2 else "tick", stm_id, None, None)
+        for i, stm_id in enumerate(driver._stms_by_id)
+    )
+
+
+def _wait_until_idle(driver):
+    while driver.queue_metrics()["queued"]:
+        time.sleep(0.01)
+
+
+def _add(count):
+    driver = Driver()
+    for stm in create_typed_machines(count):
+        driver.add_machine(stm)
+    return driver
+
+
+def run(count):
+    result = {}
+    driver = _add(count)
+    _prepare(driver)
+    driver.start(keep_active=True)
+    _wait_until_idle(driver)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "driver.checkpoint")
+        start = time.perf_counter()
+        driver.checkpoint(path)
+        result["checkpoint_seconds"] = time.perf_counter() - start
+        driver.stop()
+        driver.wait_until_finished()
+        # the loop only pauses while the state is captured
+        start = time.perf_counter()
+        _capture(driver)
+        result["pause_seconds"] = time.perf_counter() - start
+        result["bytes"] = os.path.getsize(path)
+
+        start = time.perf_counter()
+        restored = _add(count)
+        result["create_seconds"] = time.perf_counter() - start
+        start = time.perf_counter()
+        restored.restore(path)
+        result["restore_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    replayed = _add(count)
+    _prepare(replayed)
+    replayed.start(keep_active=True)
+    _wait_until_idle(replayed)
+    result["replay_seconds"] = time.perf_counter() - start
+    replayed.stop()
+    replayed.wait_until_finished()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--machines", type=int, default=100000)
+    args = parser.parse_args(argv)
+    for key, value in run(args.machines).items():
+        if key == "bytes":
+            print(
+                "{:>20} {:>10} ({:.1f} per machine)".format(
+                    key, value, value / args.machines
+                )
+            )
+        else:
+            print("{:>20} {:>10.3f} s".format(key, value))
+
+
+if __name__ == "__main__":
+    main()
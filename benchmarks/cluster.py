@@ -0,0 +1,82 @@
+"""
+Measure event throughput of a cluster with an increasing number of workers.
+
+    python -m benchmarks.cluster [--workers 1 2 4] [--machines 64] [--tokens 256] [--seconds 3] [--channel shm]
+
+The machines form a ring. Tokens are sent to the machines, and each machine
+passes every token on to the next machine of the ring, which mostly lives in
+another worker. After the given time, the cluster is stopped, and the
+benchmark reports how many events all machines handled per second. With
+enough cores, throughput should grow about linearly with the workers.
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+
+from stmpy import Machine
+from stmpy.cluster import Cluster
+
+
+class Relay:
+    def __init__(self, index, machines, counts):
+        self.index = index
+        self.next = "stm_{}".format((index + 1) % machines)
+        self.counts = counts
+        self.count = 0
+
+    def forward(self):
+        self.count = self.count + 1
+        self.counts[self.index] = self.count
+        self.stm.driver.send("token", self.next)
+
+
+def create(index, machines, counts):
+    relay = Relay(index, machines, counts)
+    t0 = {"source": "initial", "target": "s"}
+    t1 = {"trigger": "token", "source": "s", "target": "s", "effect": "forward"}
+    relay.stm = Machine(name="stm_{}".format(index), transitions=[t0, t1], obj=relay)
+    return relay.stm
+
+
+def run(workers, machines, tokens, seconds, channel):
+    counts = multiprocessing.RawArray("q", machines)
+    cluster = Cluster(workers=workers, channel=channel)
+    for i in range(machines):
+        cluster.add_machine("stm_{}".format(i), create, i, machines, counts)
+    cluster.start(keep_active=True)
+    cluster.send_many(
+        ("token", "stm_{}".format(i % machines), None, None) for i in range(tokens)
+    )
+    cluster.flush()
+    time.sleep(seconds)
+    cluster.stop()
+    cluster.wait_until_finished()
+    return sum(counts) / seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+")
+    parser.add_argument("--machines", type=int, default=64)
+    parser.add_argument("--tokens", type=int, default=256)
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--channel", choices=["shm", "pipe"], default="pipe")
+    args = parser.parse_args(argv)
+    workers = args.workers
+    if not workers:
+        cpus = os.cpu_count() or 1
+        workers = [1]
+        while workers[-1] * 2 <= cpus:
+            workers.append(workers[-1] * 2)
+    print("{:>8} {:>12} {:>8}".format("workers", "events/s", "scaling"))
+    base = None
+    for count in workers:
+        rate = run(count, args.machines, args.tokens, args.seconds, args.channel)
+        base = base or rate
+        print("{:>8} {:>12.0f} {:>8.2f}".format(count, rate, rate / base))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Measure the cost of deferred events across repeated state changes.
+
+    python -m benchmarks.defer [--events 10000] [--flips 100]
+
+A machine flips between two states that both defer the event `work`. First,
+all `work` events are sent and deferred, then the machine flips state the
+given number of times, and finally enters a state that handles `work`. The
+benchmark reports how long the driver takes for all of this.
+"""
+
+import argparse
+import time
+
+from stmpy import Driver
+from stmpy import Machine
+
+
+class Worker:
+    def __init__(self):
+        self.count = 0
+
+    def work(self):
+        self.count = self.count + 1
+
+
+def run(events, flips):
+    worker = Worker()
+    t0 = {"source": "initial", "target": "a"}
+    t1 = {"trigger": "flip", "source": "a", "target": "b"}
+    t2 = {"trigger": "flip", "source": "b", "target": "a"}
+    t3 = {"trigger": "drain", "source": "a", "target": "c"}
+    t4 = {"trigger": "drain", "source": "b", "target": "c"}
+    a = {"name": "a", "work": "defer"}
+    b = {"name": "b", "work": "defer"}
+    c = {"name": "c", "work": "work"}
+    stm = Machine(
+        name="stm", transitions=[t0, t1, t2, t3, t4], states=[a, b, c], obj=worker
+    )
+    driver = Driver()
+    driver.add_machine(stm)
+    driver.send_many(("work", "stm", None, None) for _ in range(events))
+    driver.send_many(("flip", "stm", None, None) for _ in range(flips))
+    driver.send("drain", "stm")
+    start = time.perf_counter()
+    driver.start(max_transitions=1 + flips + 1 + events)
+    driver.wait_until_finished()
+    elapsed = time.perf_counter() - start
+    assert worker.count == events
+    return elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--flips", type=int, default=100)
+    args = parser.parse_args(argv)
+    elapsed = run(args.events, args.flips)
+    print(
+        "{} deferred events, {} state flips: {:.3f} s".format(
+            args.events, args.flips, elapsed
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Measure event dispatch throughput of a machine with many transitions.
+
+    python -m benchmarks.dispatch [--events 200000] [--states 50] [--triggers 20] [--metrics] [--journal] [--flight-recorder 1024]
+
+The machine has a ring of states. In every state, each trigger leads to an
+internal transition, except one that moves on to the next state. Effects
+call methods with and without arguments, and entry and exit actions start
+and stop a timer. All events are queued before the driver starts, so the
+measurement covers the driver loop and the dispatch of each event. With
+`--metrics`, the driver measures its work, see `stmpy.Driver.metrics`, and
+with `--journal`, it writes a journal into a temporary directory.
+`--flight-recorder 0` switches off the recorder of recent transitions.
+"""
+
+import argparse
+import tempfile
+import time
+
+from stmpy import Driver
+from stmpy import Machine
+
+
+class Logic:
+    def __init__(self):
+        self.count = 0
+
+    def m1(self):
+        self.count = self.count + 1
+
+    def m2(self, value):
+        self.count = self.count + value
+
+    def m3(self, *args, **kwargs):
+        self.count = self.count + len(args)
+
+
+def build_machine(states, triggers, obj, name="stm"):
+    transitions = [{"source": "initial", "target": "s0", "effect": "m1"}]
+    state_dicts = []
+    for s in range(states):
+        source = "s{}".format(s)
+        transitions.append(
+            {
+                "trigger": "next",
+                "source": source,
+                "target": "s{}".format((s + 1) % states),
+                "effect": "m1; m2(2)",
+            }
+        )
+        state = {
+            "name": source,
+            "entry": "m1; start_timer('t', 60000)",
+            "exit": "stop_timer('t')",
+        }
+        for t in range(triggers - 1):
+            state["e{}".format(t)] = "m1; m2(1); m3(*)"
+        state_dicts.append(state)
+    return Machine(name=name, transitions=transitions, obj=obj, states=state_dicts)
+
+
+def workload(events, triggers):
+    for i in range(events):
+        if i % triggers == 0:
+            yield "next", []
+        else:
+            yield "e{}".format(i % (triggers - 1)), [i]
+
+
+def run(events, states, triggers, metrics=False, journal=False, flight_recorder=1024):
+    if journal:
+        with tempfile.TemporaryDirectory() as directory:
+            return _run(events, states, triggers, metrics, directory, flight_recorder)
+    return _run(events, states, triggers, metrics, None, flight_recorder)
+
+
+def _run(events, states, triggers, metrics, journal, flight_recorder):
+    logic = Logic()
+    stm = build_machine(states, triggers, logic)
+    driver = Driver(metrics=metrics, journal=journal, flight_recorder=flight_recorder)
+    driver.add_machine(stm)
+    for event_id, args in workload(events, triggers):
+        driver.send(event_id, "stm", args=args)
+    start = time.perf_counter()
+    driver.start(max_transitions=events + 1)
+    driver.wait_until_finished()
+    return events / (time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--states", type=int, default=50)
+    parser.add_argument("--triggers", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--metrics", action="store_true")
+    parser.add_argument("--journal", action="store_true")
+    parser.add_argument("--flight-recorder", type=int, default=1024)
+    args = parser.parse_args(argv)
+    best = max(
+        run(
+            args.events,
+            args.states,
+            args.triggers,
+            args.metrics,
+            args.journal,
+            args.flight_recorder,
+        )
+        for _ in range(args.repeat)
+    )
+    print("{:.0f} events/s".format(best))
+
+
+if __name__ == "__main__":
+    main()
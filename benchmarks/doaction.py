@@ -0,0 +1,60 @@
+"""
+Measure the turnaround of do-actions.
+
+    python -m benchmarks.doaction [--rounds 2000] [--workers 4]
+
+A machine enters a state with a do-action that returns at once, and goes
+back to its idle state with the `done` event, over and over. The benchmark
+reports the round trips per second, with a new thread for each do-action
+and with a thread pool of the driver.
+"""
+
+import argparse
+import time
+
+from stmpy import Driver
+from stmpy import Machine
+
+
+class Worker:
+    def __init__(self, rounds):
+        self.rounds = rounds
+
+    def work(self):
+        pass
+
+    def again(self):
+        self.rounds = self.rounds - 1
+        if self.rounds > 0:
+            self.stm.send("go")
+
+
+def run(rounds, workers=None):
+    worker = Worker(rounds)
+    t0 = {"source": "initial", "target": "idle", "effect": "again"}
+    t1 = {"trigger": "go", "source": "idle", "target": "busy"}
+    t2 = {"trigger": "done", "source": "busy", "target": "idle", "effect": "again"}
+    busy = {"name": "busy", "do": "work"}
+    worker.stm = Machine(
+        name="stm", transitions=[t0, t1, t2], states=[busy], obj=worker
+    )
+    driver = Driver(do_workers=workers)
+    driver.add_machine(worker.stm)
+    start = time.perf_counter()
+    driver.start(max_transitions=2 * rounds - 1)
+    driver.wait_until_finished()
+    return rounds / (time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args(argv)
+    print("{:>10} {:>12}".format("executor", "rounds/s"))
+    print("{:>10} {:>12.0f}".format("thread", run(args.rounds)))
+    print("{:>10} {:>12.0f}".format("pool", run(args.rounds, args.workers)))
+
+
+if __name__ == "__main__":
+    main()
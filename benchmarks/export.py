@@ -0,0 +1,71 @@
+"""
+Measure the export of large machines to Graphviz and Promela.
+
+    python -m benchmarks.export [--states 200] [--triggers 20]
+
+The machine has a ring of states, and in each state, a self-transition for
+each trigger. States are only declared by transitions, since `to_promela`
+does not support state declarations. The benchmark reports how long
+`to_graphviz` and `to_promela` take for the machine.
+"""
+
+import argparse
+import time
+
+from stmpy import Machine
+from stmpy import to_graphviz
+from stmpy import to_promela
+
+
+def build_machine(states, triggers):
+    transitions = [{"source": "initial", "target": "s0", "effect": "m1"}]
+    for s in range(states):
+        source = "s{}".format(s)
+        transitions.append(
+            {
+                "trigger": "next",
+                "source": source,
+                "target": "s{}".format((s + 1) % states),
+                "effect": "m1; m2(2)",
+            }
+        )
+        for t in range(triggers - 1):
+            transitions.append(
+                {
+                    "trigger": "e{}".format(t),
+                    "source": source,
+                    "target": source,
+                    "effect": "m1; start_timer('t', 1000)",
+                }
+            )
+    return Machine(name="stm", transitions=transitions, obj=None)
+
+
+def run(states, triggers, repeat=3):
+    stm = build_machine(states, triggers)
+    result = {}
+    for name, export in [
+        ("graphviz", lambda: to_graphviz(stm)),
+        ("promela", lambda: to_promela([stm])),
+    ]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            export()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        result[name] = best
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--states", type=int, default=200)
+    parser.add_argument("--triggers", type=int, default=20)
+    args = parser.parse_args(argv)
+    for name, elapsed in run(args.states, args.triggers).items():
+        print("{:>10} {:.3f} s".format(name, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Measure how fast many machines can feed a single machine.
+
+    python -m benchmarks.fanin [--messages 100000] [--sources 1000]
+
+Each source machine forwards every `go` event as an `item` message to a
+single sink machine, from within its transition. All `go` events are queued
+before the driver starts, and the benchmark reports how many items per
+second the sink receives.
+"""
+
+import argparse
+import time
+
+from stmpy import Driver
+from stmpy import Machine
+
+
+class Source:
+    def forward(self):
+        self.stm.driver.send("item", "sink")
+
+
+class Sink:
+    def __init__(self):
+        self.count = 0
+
+    def receive(self):
+        self.count = self.count + 1
+
+
+def run(messages, sources):
+    driver = Driver()
+    sink = Sink()
+    t0 = {"source": "initial", "target": "s"}
+    t1 = {"trigger": "item", "source": "s", "target": "s", "effect": "receive"}
+    driver.add_machine(Machine(name="sink", transitions=[t0, t1], obj=sink))
+    t1 = {"trigger": "go", "source": "s", "target": "s", "effect": "forward"}
+    for i in range(sources):
+        source = Source()
+        source.stm = Machine(
+            name="source_{}".format(i), transitions=[t0, t1], obj=source
+        )
+        driver.add_machine(source.stm)
+    driver.send_many(
+        ("go", "source_{}".format(i % sources), None, None) for i in range(messages)
+    )
+    start = time.perf_counter()
+    driver.start(max_transitions=1 + sources + 2 * messages)
+    driver.wait_until_finished()
+    elapsed = time.perf_counter() - start
+    assert sink.count == messages
+    return messages / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--sources", type=int, default=1000)
+    args = parser.parse_args(argv)
+    rate = run(args.messages, args.sources)
+    print("{} sources: {:.0f} items/s".format(args.sources, rate))
+
+
+if __name__ == "__main__":
+    main()
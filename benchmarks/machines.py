@@ -0,0 +1,95 @@
+"""
+Measure the cost of creating many machines with the same behavior.
+
+    python -m benchmarks.machines [--machines 50000]
+
+The machines are created once with `Machine`, which parses the transitions
+and states for each machine, and once with a `MachineType`, which parses
+them once for all machines. For both, the benchmark reports the time to
+create the machines and add them to a driver, the memory allocated for each
+idle machine, including its object and its entries in the driver, and the
+size of the machine instance itself.
+"""
+
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+from stmpy import Driver
+from stmpy import Machine
+from stmpy import MachineType
+
+
+class Counter:
+    def __init__(self):
+        self.count = 0
+
+    def increment(self):
+        self.count = self.count + 1
+
+
+t0 = {"source": "initial", "target": "idle"}
+t1 = {"trigger": "start", "source": "idle", "target": "busy"}
+t2 = {"trigger": "stop", "source": "busy", "target": "idle", "effect": "increment"}
+t3 = {"trigger": "t", "source": "busy", "target": "idle", "effect": "increment()"}
+idle = {"name": "idle", "entry": 'stop_timer("t")', "tick": "defer"}
+busy = {"name": "busy", "entry": 'start_timer("t", 1000)', "tick": "increment"}
+
+
+def create_machines(count):
+    return [
+        Machine(
+            name="stm_{}".format(i),
+            transitions=[t0, t1, t2, t3],
+            states=[idle, busy],
+            obj=Counter(),
+        )
+        for i in range(count)
+    ]
+
+
+def create_typed_machines(count):
+    counter = MachineType(transitions=[t0, t1, t2, t3], states=[idle, busy])
+    return [counter.create("stm_{}".format(i), Counter()) for i in range(count)]
+
+
+def run(create, count):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    driver = Driver()
+    machines = create(count)
+    for machine in machines:
+        driver.add_machine(machine)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    instance = sys.getsizeof(machines[0])
+    if hasattr(machines[0], "__dict__"):
+        instance += sys.getsizeof(machines[0].__dict__)
+    return elapsed, size / count, instance
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--machines", type=int, default=50000)
+    args = parser.parse_args(argv)
+    print(
+        "{:>12} {:>10} {:>14} {:>10}".format(
+            "", "time (s)", "bytes/machine", "instance"
+        )
+    )
+    for label, create in [
+        ("Machine", create_machines),
+        ("MachineType", create_typed_machines),
+    ]:
+        elapsed, size, instance = run(create, args.machines)
+        print(
+            "{:>12} {:>10.3f} {:>14.0f} {:>10}".format(label, elapsed, size, instance)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Compare sending messages one by one with `send_many`.
+
+    python -m benchmarks.send [--messages 200000] [--machines 100] [--batch 1000]
+
+A producer thread sends messages to a running driver, either by calling
+`Driver.send` for each message, or in batches via `Driver.send_many`. The
+benchmark reports how fast the producer hands off messages, and how long it
+takes until the driver has processed all of them.
+"""
+
+import argparse
+import time
+
+from stmpy import Driver
+from stmpy import Machine
+
+
+class Counter:
+    def __init__(self):
+        self.count = 0
+
+    def on_message(self):
+        self.count = self.count + 1
+
+
+def build(machines):
+    driver = Driver()
+    counters = []
+    for i in range(machines):
+        counter = Counter()
+        t0 = {"source": "initial", "target": "s"}
+        t1 = {"trigger": "m", "source": "s", "target": "s", "effect": "on_message"}
+        driver.add_machine(
+            Machine(name="stm_{}".format(i), transitions=[t0, t1], obj=counter)
+        )
+        counters.append(counter)
+    return driver, counters
+
+
+def run(mode, messages, machines, batch):
+    driver, counters = build(machines)
+    ids = ["stm_{}".format(i % machines) for i in range(messages)]
+    driver.start(max_transitions=machines + messages)
+    start = time.perf_counter()
+    if mode == "send":
+        for stm_id in ids:
+            driver.send("m", stm_id)
+    else:
+        for i in range(0, messages, batch):
+            driver.send_many(("m", stm_id, None, None) for stm_id in ids[i : i + batch])
+    sent = time.perf_counter() - start
+    driver.wait_until_finished()
+    done = time.perf_counter() - start
+    assert sum(counter.count for counter in counters) == messages
+    return messages / sent, messages / done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--machines", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args(argv)
+    print("{:>10} {:>14} {:>16}".format("mode", "sent msg/s", "processed msg/s"))
+    for mode in ["send", "send_many"]:
+        sent, done = run(mode, args.messages, args.machines, args.batch)
+        print("{:>10} {:>14.0f} {:>16.0f}".format(mode, sent, done))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Compare the timer backends of `stmpy.Driver`.
+
+    python -m benchmarks.timers [--sizes 10000 100000 1000000]
+
+For each number of active timers, the benchmark arms that many timers with
+timeouts between 1 and 60 seconds, restarts and stops a sample of them, and
+then advances the clock in steps of 10 ms until all timers expired.
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from stmpy.timers import _HeapTimerQueue
+from stmpy.timers import _TimingWheel
+
+BACKENDS = {
+    "heap": lambda: _HeapTimerQueue(),
+    "wheel": lambda: _TimingWheel(tick=10, levels=4, now=0),
+}
+
+
+class _Stm:
+    def __init__(self, id):
+        self.id = id
+
+
+def _timer(stm, name, timeout, now):
+    return {
+        "id": name,
+        "timeout": timeout,
+        "timeout_abs": now + timeout,
+        "stm": stm,
+        "tid": (stm.id, name),
+    }
+
+
+def run(backend, size, churn, seed=0):
+    rnd = random.Random(seed)
+    stms = [_Stm("stm_{}".format(i)) for i in range(size)]
+    timeouts = [rnd.randint(1000, 60000) for _ in range(size)]
+    sample = [rnd.randrange(size) for _ in range(churn)]
+    queue = BACKENDS[backend]()
+    result = {"backend": backend, "timers": size}
+
+    start = time.perf_counter()
+    for stm, timeout in zip(stms, timeouts):
+        queue.start(_timer(stm, "t", timeout, 0))
+    result["start_ns"] = (time.perf_counter() - start) / size * 1e9
+
+    start = time.perf_counter()
+    for i in sample:
+        queue.start(_timer(stms[i], "t", timeouts[i], 0))
+    result["restart_ns"] = (time.perf_counter() - start) / churn * 1e9
+
+    start = time.perf_counter()
+    for i in sample:
+        queue.stop((stms[i].id, "t"))
+    result["stop_ns"] = (time.perf_counter() - start) / churn * 1e9
+
+    remaining = len(queue)
+    now = 0
+    start = time.perf_counter()
+    while len(queue):
+        now += 10
+        queue.pop_expired(now)
+        queue.next_timeout_abs()
+    result["expire_ns"] = (time.perf_counter() - start) / remaining * 1e9
+    return result
+
+
+def measure_memory(backend, size, seed=0):
+    rnd = random.Random(seed)
+    stms = [_Stm("stm_{}".format(i)) for i in range(size)]
+    tracemalloc.start()
+    queue = BACKENDS[backend]()
+    for stm in stms:
+        queue.start(_timer(stm, "t", rnd.randint(1000, 60000), 0))
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--churn", type=int, default=100000)
+    parser.add_argument("--memory", action="store_true", help="report bytes per timer")
+    args = parser.parse_args(argv)
+    header = "{:>7} {:>8} {:>9} {:>11} {:>8} {:>10}".format(
+        "timers", "backend", "start ns", "restart ns", "stop ns", "expire ns"
+    )
+    if args.memory:
+        header += " {:>10}".format("bytes/tmr")
+    print(header)
+    for size in args.sizes:
+        for backend in BACKENDS:
+            r = run(backend, size, min(args.churn, size))
+            line = "{:>7} {:>8} {:>9.0f} {:>11.0f} {:>8.0f} {:>10.0f}".format(
+                size,
+                backend,
+                r["start_ns"],
+                r["restart_ns"],
+                r["stop_ns"],
+                r["expire_ns"],
+            )
+            if args.memory:
+                line += " {:>10.0f}".format(measure_memory(backend, size))
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
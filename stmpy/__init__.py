@@ -13,11 +13,28 @@ from queue import Empty
 from threading import Thread
 
 from .machine import Machine
+from .machine import MachineType
 from .driver import Driver
+from .async_driver import AsyncDriver
+from .pool import DriverPool
+from .cluster import Cluster
+from .clock import WallClock
+from .clock import VirtualClock
 from .spin import to_promela
 from .graphviz import to_graphviz
 
-__all__ = ["Machine", "Driver", "to_promela", "to_graphviz"]
+__all__ = [
+    "Machine",
+    "MachineType",
+    "Driver",
+    "AsyncDriver",
+    "DriverPool",
+    "Cluster",
+    "WallClock",
+    "VirtualClock",
+    "to_promela",
+    "to_graphviz",
+]
 
 
 def get_graphviz_dot(machine):
@@ -0,0 +1,420 @@
+import asyncio
+from collections import deque
+from functools import partial
+from inspect import iscoroutinefunction
+from threading import Event
+from threading import get_ident
+
+from .checkpoint import _capture
+from .checkpoint import _pack
+from .checkpoint import _write
+from .driver import Driver
+from .event import _NO_ARGS
+from .event import _NO_KWARGS
+from .event import _Event
+from .recorder import _FINAL
+from .recorder import _UNHANDLED
+
+_STEPS_PER_YIELD = 100
+
+
+class AsyncDriver(Driver):
+    """
+    A driver that runs its machines as a task within an asyncio event loop.
+
+    The run-to-completion semantics are the same as for `stmpy.Driver`, but
+    instead of a thread of its own, the driver runs as a task on an existing
+    event loop, and timers are scheduled with `loop.call_at`. Sending
+    messages from coroutines on the same loop does not cross threads.
+    Messages can still be sent from other threads. This driver dispatches
+    expired timers before waiting messages, and otherwise in the order in
+    which messages were sent; it does not support priorities, mailboxes,
+    metrics or writing journals. It takes and restores checkpoints, and
+    replays journals written by a `stmpy.Driver`. Machines whose type declares
+    priorities, a capacity or overflow policies are rejected with a
+    `ValueError` when they are added, and so are messages sent with a
+    priority.
+
+    **Coroutine actions:**
+    Methods of `obj` used as actions may be coroutine functions. The
+    coroutine of an action is awaited before the next action of the
+    transition runs, so that actions run in the same order as with
+    `stmpy.Driver`. While it is awaited, other tasks of the loop run, but
+    the driver does not dispatch any other event.
+
+    **Do-actions:**
+    A do-action that is a coroutine function runs as a task of the event
+    loop. Other do-actions run in the executor selected for them, see
+    `stmpy.Driver.add_executor`, or in the default executor of the loop. When the
+    do-action finishes, the machine receives the event `done`, as with
+    `stmpy.Driver`. If the machine leaves the state or terminates before the
+    do-action finishes, its task is cancelled and no `done` event is sent.
+
+        #!python
+        async def main():
+            driver = AsyncDriver()
+            driver.add_machine(stm)
+            driver.start()
+            await driver.wait_until_finished()
+
+        asyncio.run(main())
+    """
+
+    def __init__(
+        self, trace=None, gc_freeze=False, do_workers=None, process_workers=None
+    ):
+        """Create a new asyncio driver. See `stmpy.Driver` for the arguments."""
+        Driver.__init__(
+            self,
+            trace=trace,
+            gc_freeze=gc_freeze,
+            do_workers=do_workers,
+            process_workers=process_workers,
+        )
+        self._events = deque()
+        self._timer_events = deque()
+        self._timers = {}
+        self._do_tasks = {}
+        # do-actions of machines restored or replayed before the start
+        self._waiting_do_actions = {}
+        # coroutines of actions, awaited in the order of the actions
+        self._pending = deque()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    def start(self, max_transitions=None, keep_active=False):
+        """
+        Start the driver as a task on the running event loop.
+
+        This method must be called from a coroutine or callback running on
+        the loop, and returns the task. To wait until the driver finishes, use
+        `stmpy.AsyncDriver.wait_until_finished`.
+
+        `max_transitions`: execute only this number of transitions, then stop
+        `keep_active`: When true, keep the driver running even when all state
+        machines terminated
+        """
+        self._loop = asyncio.get_running_loop()
+        self._thread_ident = get_ident()
+        self._wakeup = asyncio.Event()
+        self._active = True
+        if self._gc_freeze:
+            self._freeze()
+        self._max_transitions = max_transitions
+        self._keep_active = keep_active
+        # timers and do-actions of a restore or replay before the start
+        for timer, handle in list(self._timers.values()):
+            if handle is None:
+                self._schedule_timer(timer)
+        waiting = self._waiting_do_actions
+        self._waiting_do_actions = {}
+        for stm, arguments in waiting.items():
+            self._start_do_action(stm, *arguments)
+        self._task = self._loop.create_task(self._run())
+        return self._task
+
+    async def step(self, steps=1):
+        """Execute a number of steps."""
+        self.start(max_transitions=steps)
+        await self.wait_until_finished()
+
+    async def wait_until_finished(self):
+        """Wait until the driver finished its execution."""
+        await self._task
+
+    def _in_loop(self):
+        return self._loop is not None and get_ident() == self._thread_ident
+
+    def _wake_queue(self):
+        if self._wakeup is None:
+            return
+        if self._in_loop():
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _queued_events(self):
+        return list(self._timer_events) + [e for e in list(self._events) if e]
+
+    def queue_depth(self, stm_id):
+        stm = self._stms_by_id.get(stm_id)
+        return sum(1 for event in self._queued_events() if event.stm is stm)
+
+    def _active_timers(self):
+        return [timer for timer, _ in list(self._timers.values())]
+
+    def add_machine(self, machine):
+        machine_type = machine._type
+        if (
+            machine_type._priorities
+            or machine_type._capacity is not None
+            or machine_type._overflow
+        ):
+            raise ValueError(
+                "AsyncDriver does not support priorities, capacities or "
+                "overflow policies of machines."
+            )
+        Driver.add_machine(self, machine)
+
+    def _add_event(self, event_id, args, kwargs, stm, priority=0):
+        self._events.append(_Event(event_id, args, kwargs, stm))
+        self._wake_queue()
+
+    def _bound(self, high_watermark=None):
+        raise ValueError("AsyncDriver does not support bounded queues.")
+
+    def checkpoint(self, path):
+        """
+        Save the state of this driver to a file, see `stmpy.Driver.checkpoint`.
+
+        Called from a coroutine or callback on the loop of the driver, the
+        state is captured right away, which is always between two
+        transitions, and the file is written before the method returns. From
+        another thread, the loop captures the state, and the calling thread
+        blocks until the file is written. Like `stmpy.Driver.restore` and
+        `stmpy.Driver.replay`, restoring works before the driver starts, and
+        timers and do-actions of the restored states start with the driver.
+        """
+        captured = []
+        if self._task is not None and not self._task.done() and not self._in_loop():
+            done = Event()
+
+            def capture():
+                captured.append(_capture(self))
+                done.set()
+
+            self._loop.call_soon_threadsafe(capture)
+            # the task may also have finished in the meantime
+            while not done.wait(0.1) and not self._task.done():
+                pass
+        _write(_pack(captured[0] if captured else _capture(self)), path)
+
+    def _take_events(self):
+        events = self._queued_events()
+        self._timer_events.clear()
+        self._events.clear()
+        return events
+
+    def _send_event(self, event):
+        if event.priority:
+            raise ValueError("AsyncDriver does not support priorities.")
+        self._events.append(event)
+        self._wake_queue()
+
+    def _add_events(self, events):
+        self._events.extend(events)
+        self._wake_queue()
+
+    def _add_events_front(self, events):
+        self._events.extendleft(reversed(events))
+        self._wake_queue()
+
+    def _start_timer(self, name, timeout, stm):
+        if self._loop is not None and not self._in_loop():
+            # timers are scheduled by the loop, and only from its thread
+            self._loop.call_soon_threadsafe(self._start_timer, name, timeout, stm)
+            return
+        if self._trace:
+            self._logger.debug("Start timer with name=%s from stm=%s", name, stm.id)
+        tid = (stm.id, name)
+        self._cancel_timer(tid)
+        timer = {
+            "id": name,
+            "timeout": timeout,
+            "timeout_abs": self._clock.time_millis() + int(timeout),
+            "stm": stm,
+            "tid": tid,
+        }
+        if self._loop is None:
+            # scheduled when the driver starts
+            self._timers[tid] = (timer, None)
+        else:
+            self._schedule_timer(timer)
+
+    def _schedule_timer(self, timer):
+        timer["when"] = self._loop.time() + int(timer["timeout"]) / 1000
+        handle = self._loop.call_at(timer["when"], self._timer_expired, timer["tid"])
+        self._timers[timer["tid"]] = (timer, handle)
+
+    def _stop_timer(self, name, stm, log=True):
+        if self._loop is not None and not self._in_loop():
+            self._loop.call_soon_threadsafe(self._stop_timer, name, stm, log)
+            return
+        if log and self._trace:
+            self._logger.debug("Stopping timer with name=%s from stm=%s", name, stm.id)
+        self._cancel_timer((stm.id, name))
+
+    def _cancel_timer(self, tid):
+        entry = self._timers.pop(tid, None)
+        if entry is not None and entry[1] is not None:
+            entry[1].cancel()
+
+    def _get_timer(self, name, stm):
+        entry = self._timers.get((stm.id, name))
+        if entry is None:
+            return None
+        if entry[1] is None:
+            return max(0, entry[0]["timeout_abs"] - self._clock.time_millis())
+        return int(round((entry[0]["when"] - self._loop.time()) * 1000))
+
+    def _timer_expired(self, tid):
+        timer, _ = self._timers.pop(tid)
+        if self._trace:
+            self._logger.debug(
+                "Timer %s expired for stm %s, adding it to event queue.",
+                timer["id"],
+                timer["stm"].id,
+            )
+        self._timer_events.append(
+            _Event(timer["id"], _NO_ARGS, _NO_KWARGS, timer["stm"])
+        )
+        self._wakeup.set()
+
+    def _start_do_action(
+        self, stm, function, function_name, args, kwargs, executor=None
+    ):
+        if self._loop is None:
+            # started with the driver
+            self._waiting_do_actions[stm] = (
+                function,
+                function_name,
+                args,
+                kwargs,
+                executor,
+            )
+            return
+        if iscoroutinefunction(function):
+            awaitable = function(*args, **kwargs)
+        else:
+            pool = self._get_executor(executor)
+            if pool is not None and pool.processes:
+                try:
+                    future = pool.submit(partial(function, *args, **kwargs))
+                except Exception:
+                    stm._log_function_error(function_name)
+                    self._add_event("done", _NO_ARGS, _NO_KWARGS, stm)
+                    return
+                self._do_tasks[stm] = self._loop.create_task(
+                    self._run_process_action(stm, future, function_name)
+                )
+                return
+            if pool is not None:
+                awaitable = asyncio.wrap_future(
+                    pool.submit(partial(function, *args, **kwargs))
+                )
+            else:
+                awaitable = self._loop.run_in_executor(
+                    None, partial(function, *args, **kwargs)
+                )
+        self._do_tasks[stm] = self._loop.create_task(
+            self._run_do_action(stm, awaitable, function_name, args, kwargs)
+        )
+
+    async def _run_do_action(self, stm, awaitable, function_name, args, kwargs):
+        try:
+            await awaitable
+        except AttributeError:
+            stm._log_function_error(function_name)
+        finally:
+            if self._do_tasks.get(stm) is asyncio.current_task():
+                del self._do_tasks[stm]
+        if self._trace:
+            self._logger.debug(
+                "Do action complete, sending completion action after done."
+            )
+        self._add_event("done", args, kwargs, stm)
+
+    async def _run_process_action(self, stm, future, function_name):
+        try:
+            args = [await asyncio.wrap_future(future)]
+        except Exception:
+            stm._log_function_error(function_name)
+            args = _NO_ARGS
+        finally:
+            if self._do_tasks.get(stm) is asyncio.current_task():
+                del self._do_tasks[stm]
+        if self._trace:
+            self._logger.debug(
+                "Do action complete, sending completion action after done."
+            )
+        self._add_event("done", args, _NO_KWARGS, stm)
+
+    def _stop_do_action(self, stm):
+        self._waiting_do_actions.pop(stm, None)
+        task = self._do_tasks.pop(stm, None)
+        if task is not None:
+            task.cancel()
+
+    def _await(self, coroutine):
+        self._pending.append(coroutine)
+
+    def _terminate_stm(self, stm_id):
+        stm = self._stms_by_id.get(stm_id)
+        if stm is not None:
+            self._stop_do_action(stm)
+        Driver._terminate_stm(self, stm_id)
+
+    async def _dispatch(self, event):
+        stm = event.stm
+        if stm._defers_event(event.id):
+            Driver._execute_transition(
+                self, stm, event.id, event.args, event.kwargs, event
+            )
+            return
+        recorder = self._recorder
+        if recorder is None:
+            await stm._execute_transition_async(event.id, event.args, event.kwargs)
+        else:
+            source = stm._current
+            try:
+                executed = await stm._execute_transition_async(
+                    event.id, event.args, event.kwargs
+                )
+            except Exception:
+                self._record_failure(stm, source, event.id)
+                raise
+            target = stm._current
+            if not executed:
+                target = _UNHANDLED
+            elif target is source and stm._id not in self._stms_by_id:
+                target = _FINAL
+            recorder.record(stm._id, source, event.id, target)
+        if self._max_transitions is not None:
+            self._max_transitions = self._max_transitions - 1
+            if self._max_transitions == 0:
+                self._logger.debug("Stopping driver because max_transitions reached.")
+                self._active = False
+
+    async def _run(self):
+        self._logger.debug("Starting loop of the driver.")
+        self._thread_ident = get_ident()
+        steps = 0
+        try:
+            # coroutines of actions replayed before the start
+            while self._pending:
+                await self._pending.popleft()
+            while self._active:
+                if self._trace_setting is None:
+                    self._trace = self._is_debug_enabled()
+                if self._timer_events:
+                    event = self._timer_events.popleft()
+                elif self._events:
+                    event = self._events.popleft()
+                else:
+                    self._wakeup.clear()
+                    if not (self._events or self._timer_events):
+                        await self._wakeup.wait()
+                    continue
+                await self._dispatch(event)
+                steps = steps + 1
+                if steps % _STEPS_PER_YIELD == 0:
+                    # let other tasks of the loop run
+                    await asyncio.sleep(0)
+        finally:
+            for _, handle in self._timers.values():
+                handle.cancel()
+            for task in list(self._do_tasks.values()):
+                task.cancel()
+            self._shutdown_executors()
+        self._logger.debug("Driver loop is finished.")
@@ -0,0 +1,150 @@
+import logging
+import os
+import pickle
+
+from .event import _NO_ARGS
+from .event import _NO_KWARGS
+from .event import _Event
+from .machine import _CompiledState
+
+_MAGIC = b"STMPYCP\x01"
+"""Start of checkpoint files, with the version of the format in the last byte."""
+
+_logger = logging.getLogger(__name__)
+
+
+def _pack_args(args, kwargs):
+    # the shared empty arguments of events are not picklable
+    return (tuple(args) if args else None, dict(kwargs) if kwargs else None)
+
+
+def _unpack_args(args, kwargs):
+    return (args or _NO_ARGS, kwargs or _NO_KWARGS)
+
+
+def _capture(driver):
+    """
+    Capture the state of a driver between two transitions.
+
+    This only copies references, so that the loop of the driver can go on
+    as soon as possible. The result is turned into a snapshot by `_pack`.
+    """
+    machines = [
+        (stm, stm._current, list(stm._defer_queue) if stm._defer_queue else None)
+        for stm in driver._stms_by_id.values()
+    ]
+    return (
+        machines,
+        driver._queued_events(),
+        driver._active_timers(),
+        driver._clock.time_millis(),
+    )
+
+
+def _pack(captured):
+    """
+    Turn what `_capture` returned into a snapshot that can be pickled.
+
+    Machines are recorded with the name of their state and their deferred
+    events, queued events with the name of their machine, and timers with
+    their remaining time.
+    """
+    machines, events, timers, now = captured
+    machines = [
+        (
+            stm._id,
+            current.name,
+            (
+                [
+                    (event.id, *_pack_args(event.args, event.kwargs), event.priority)
+                    for event in deferred
+                ]
+                if deferred
+                else None
+            ),
+        )
+        for stm, current, deferred in machines
+    ]
+    events = [
+        (event.stm._id, event.id, *_pack_args(event.args, event.kwargs), event.priority)
+        for event in events
+    ]
+    timers = [
+        (timer["stm"].id, timer["id"], timer["timeout_abs"] - now) for timer in timers
+    ]
+    return machines, events, timers
+
+
+def _write(snapshot, path):
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as file:
+        file.write(_MAGIC)
+        pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+
+def _read(path):
+    with open(path, "rb") as file:
+        if file.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("{} is not a checkpoint of a driver.".format(path))
+        return pickle.load(file)
+
+
+def _apply(driver, snapshot):
+    """
+    Bring the machines of a driver, which has not started yet, into the
+    state of a checkpoint.
+
+    Machines get their state back without any entry actions, and the initial
+    events that were queued for them when they were added are discarded.
+    Do-actions of the restored states are started again.
+    """
+    machines, events, timers = snapshot
+    stms_by_id = driver._stms_by_id
+    restored = set()
+    for stm_id, state, deferred in machines:
+        stm = stms_by_id.get(stm_id)
+        if stm is None:
+            _logger.warning(
+                "Machine %s of the checkpoint is not in the driver.", stm_id
+            )
+            continue
+        restored.add(stm)
+        stm._bind()
+        compiled = stm._type._compiled_states.get(state)
+        if compiled is None:
+            if state == "initial":
+                stm._reset()
+                compiled = stm._current
+            else:
+                compiled = stm._type._compiled_states[state] = _CompiledState(state)
+        stm._current = compiled
+        stm._defer_queue = None
+        for event_id, args, kwargs, priority in deferred or ():
+            stm._add_to_defer_queue(
+                _Event(event_id, *_unpack_args(args, kwargs), stm, priority)
+            )
+    # keep the events of machines that are not in the checkpoint
+    kept = [event for event in driver._take_events() if event.stm not in restored]
+    queued = []
+    for stm_id, event_id, args, kwargs, priority in events:
+        stm = stms_by_id.get(stm_id)
+        if stm is not None:
+            queued.append(_Event(event_id, *_unpack_args(args, kwargs), stm, priority))
+    driver._add_events(queued + kept)
+    for stm_id, name, remaining in timers:
+        stm = stms_by_id.get(stm_id)
+        if stm is not None:
+            driver._start_timer(name, max(0, remaining), stm)
+    for stm in restored:
+        do_action = stm._current.do
+        if do_action is not None:
+            # do-actions cannot be saved, so they start over
+            stm._run_function(
+                stm._obj,
+                do_action["name"],
+                do_action["args"],
+                _NO_KWARGS,
+                asynchronous=True,
+                executor=stm._current.do_executor or stm._type._do_executor,
+            )
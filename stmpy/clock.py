@@ -0,0 +1,46 @@
+import time
+
+
+class WallClock:
+    """
+    Clock that reads the system time.
+
+    This is the clock a driver uses by default.
+    """
+
+    def time_millis(self):
+        """Return the current time in milliseconds."""
+        return int(round(time.time() * 1000))
+
+
+class VirtualClock:
+    """
+    Clock whose time only moves when it is advanced explicitly.
+
+    A driver in simulation mode advances its virtual clock to the expiration
+    of the next timer whenever it has no events to process, so that behavior
+    involving long timeouts runs as fast as the transitions execute.
+
+        #!python
+        clock = VirtualClock()
+        driver = Driver(clock=clock, simulation=True)
+    """
+
+    def __init__(self, start=0):
+        """Create a virtual clock that starts at time `start`, in milliseconds."""
+        self._now = start
+
+    def time_millis(self):
+        """Return the current virtual time in milliseconds."""
+        return self._now
+
+    def advance(self, millis):
+        """Move the clock forward by `millis` milliseconds."""
+        if millis < 0:
+            raise ValueError("A virtual clock cannot go backwards.")
+        self._now = self._now + millis
+
+    def advance_to(self, time_millis):
+        """Move the clock forward to `time_millis`, if that is in its future."""
+        if time_millis > self._now:
+            self._now = time_millis
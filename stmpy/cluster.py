@@ -0,0 +1,541 @@
+import ctypes
+import logging
+import multiprocessing
+import os
+import pickle
+import platform
+import time
+from multiprocessing.connection import wait
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+from .driver import Driver
+from .machine import Machine
+from .pool import _ShardRing
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    shared_memory = None
+
+_logger = logging.getLogger(__name__)
+
+_HEADER = 24
+_LENGTH = 4
+# longest sleep of a receiver that polls shared memory without finding events
+_MAX_IDLE_SLEEP = 0.001
+# name of the machine that stops the driver of a worker
+_STOP_MACHINE = "stmpy.cluster.stop"
+
+
+class _RingChannel:
+    """
+    Single-producer, single-consumer ring buffer in shared memory.
+
+    The header holds the read and write positions as 64-bit counters that
+    only increase, and a flag that the consumer sets when it stops reading,
+    followed by the data area. Each record is its length followed by its
+    bytes, and may wrap around the end of the data area. The producer writes
+    the bytes of a record before it advances the write position, which the
+    consumer reads before the bytes. Without memory barriers, this relies on
+    the store order of x86 processors, so the ring is only used there.
+
+    When the ring is full, the producer waits until the consumer made room.
+    It raises a `RuntimeError` if the consumer stopped reading, or did not
+    make room within `timeout` seconds, which happens when its process died.
+    """
+
+    def __init__(self, capacity, timeout=10.0):
+        self._capacity = capacity
+        self._timeout = timeout
+        self._shm = shared_memory.SharedMemory(create=True, size=_HEADER + capacity)
+        self._attach()
+
+    def _attach(self):
+        self._buf = self._shm.buf
+        self._head = ctypes.c_uint64.from_buffer(self._buf, 0)
+        self._tail = ctypes.c_uint64.from_buffer(self._buf, 8)
+        self._closed = ctypes.c_uint64.from_buffer(self._buf, 16)
+        self._head.value = 0
+        self._tail.value = 0
+        self._closed.value = 0
+
+    def send(self, payload):
+        size = _LENGTH + len(payload)
+        if size > self._capacity:
+            raise ValueError(
+                "A batch of {} bytes does not fit into a channel of {} bytes.".format(
+                    len(payload), self._capacity
+                )
+            )
+        tail = self._tail.value
+        if self._capacity - (tail - self._head.value) < size:
+            self._wait_for_room(tail, size)
+        self._write(tail, len(payload).to_bytes(_LENGTH, "little"))
+        self._write(tail + _LENGTH, payload)
+        self._tail.value = tail + size
+
+    def _wait_for_room(self, tail, size):
+        deadline = time.monotonic() + self._timeout
+        while self._capacity - (tail - self._head.value) < size:
+            if self._closed.value:
+                raise RuntimeError("The receiver of the channel stopped reading.")
+            if time.monotonic() > deadline:
+                raise RuntimeError(
+                    "The receiver of the channel made no room for {} s.".format(
+                        self._timeout
+                    )
+                )
+            time.sleep(0.0001)
+
+    def receive(self):
+        """Return the payloads of all available records."""
+        head = self._head.value
+        tail = self._tail.value
+        payloads = []
+        while head < tail:
+            length = int.from_bytes(self._read(head, _LENGTH), "little")
+            payloads.append(self._read(head + _LENGTH, length))
+            head = head + _LENGTH + length
+        self._head.value = head
+        return payloads
+
+    def _write(self, position, data):
+        start = _HEADER + position % self._capacity
+        first = min(len(data), _HEADER + self._capacity - start)
+        self._buf[start : start + first] = data[:first]
+        if first < len(data):
+            self._buf[_HEADER : _HEADER + len(data) - first] = data[first:]
+
+    def _read(self, position, length):
+        start = _HEADER + position % self._capacity
+        first = min(length, _HEADER + self._capacity - start)
+        data = bytes(self._buf[start : start + first])
+        if first < length:
+            data = data + bytes(self._buf[_HEADER : _HEADER + length - first])
+        return data
+
+    @staticmethod
+    def wait(channels, timeout):
+        time.sleep(timeout)
+
+    def stop_reading(self):
+        self._closed.value = 1
+
+    def close(self, unlink=False):
+        # the views into the buffer must be released before closing it
+        del self._head
+        del self._tail
+        del self._closed
+        self._buf = None
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+class _PipeChannel:
+    """Channel over a `multiprocessing` pipe, for platforms without shared memory rings."""
+
+    def __init__(self, capacity, timeout=None):
+        self._reader, self._writer = multiprocessing.Pipe(duplex=False)
+
+    def send(self, payload):
+        self._writer.send_bytes(payload)
+
+    def receive(self):
+        payloads = []
+        while self._reader.poll():
+            payloads.append(self._reader.recv_bytes())
+        return payloads
+
+    @staticmethod
+    def wait(channels, timeout):
+        wait([channel._reader for channel in channels], timeout)
+
+    def stop_reading(self):
+        pass
+
+    def close(self, unlink=False):
+        self._reader.close()
+        self._writer.close()
+
+
+_CHANNELS = {"shm": _RingChannel, "pipe": _PipeChannel}
+
+
+def _shm_supported():
+    # the ring relies on the store order of x86 processors
+    return (
+        shared_memory is not None
+        and "fork" in multiprocessing.get_all_start_methods()
+        and platform.machine().lower() in ("x86_64", "amd64")
+    )
+
+
+class _Outbox:
+    """
+    Collects outgoing messages per destination worker and sends them in batches.
+
+    A batch is sent once it holds `batch` messages, or by a thread that
+    flushes all destinations every `interval` seconds.
+    """
+
+    def __init__(self, channels, batch, interval):
+        self._channels = channels
+        self._batch = batch
+        self._interval = interval
+        self._pending = [[] for _ in channels]
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def put(self, destination, message):
+        with self._lock:
+            pending = self._pending[destination]
+            pending.append(message)
+            if len(pending) >= self._batch:
+                self._pending[destination] = []
+                self._send(destination, pending)
+
+    def _send(self, destination, messages):
+        self._channels[destination].send(
+            pickle.dumps(messages, pickle.HIGHEST_PROTOCOL)
+        )
+
+    def flush(self):
+        with self._lock:
+            for destination, pending in enumerate(self._pending):
+                if pending:
+                    self._pending[destination] = []
+                    self._send(destination, pending)
+
+    def stop(self, destination):
+        """Tell the destination to stop, after all pending messages."""
+        with self._lock:
+            pending = self._pending[destination]
+            if pending:
+                self._pending[destination] = []
+                self._send(destination, pending)
+            self._send(destination, None)
+
+    def start(self):
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.flush()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+def _message(message_id, stm_id, args, kwargs):
+    # arguments travel as plain lists and dictionaries
+    return (
+        message_id,
+        stm_id,
+        list(args) if args else None,
+        dict(kwargs) if kwargs else None,
+    )
+
+
+def _deliver(driver, index, payloads):
+    """Deliver batches to the driver, and return if one of them asks to stop."""
+    stms_by_id = driver._stms_by_id
+    stop = False
+    for payload in payloads:
+        messages = pickle.loads(payload)
+        if messages is None:
+            stop = True
+            continue
+        local = []
+        for message in messages:
+            if message[1] in stms_by_id:
+                local.append(message)
+            else:
+                _logger.warning(
+                    "Machine with name %s cannot be found in worker %s. "
+                    "Ignoring message %s.",
+                    message[1],
+                    index,
+                    message[0],
+                )
+        driver.send_many(local)
+    return stop
+
+
+def _stop_after_queued(driver):
+    # a machine that stops the driver once it dispatched the events before
+    t0 = {"source": "initial", "target": "s"}
+    t1 = {"trigger": "stop", "source": "s", "target": "final", "effect": "stop"}
+    driver.add_machine(Machine(name=_STOP_MACHINE, transitions=[t0, t1], obj=driver))
+    driver.send("stop", _STOP_MACHINE)
+
+
+def _receive(driver, index, channels):
+    """Deliver the batches from other processes to the driver of a worker."""
+    wait = type(channels[0]).wait
+    idle = 0.0
+    stopping = False
+    while True:
+        received = False
+        for channel in channels:
+            payloads = channel.receive()
+            if payloads:
+                received = True
+                stopping = _deliver(driver, index, payloads) or stopping
+        if stopping and not received:
+            # all channels are drained
+            _stop_after_queued(driver)
+            return
+        if received:
+            idle = 0.0
+        else:
+            wait(channels, idle)
+            idle = min(_MAX_IDLE_SLEEP, idle * 2 or 0.00005)
+
+
+def _worker_main(index, workers, machines, inbound, outbound, options):
+    driver = Driver(**options["driver"])
+    ring = _ShardRing(workers)
+    placement = options["placement"]
+    outbox = _Outbox(outbound, options["batch"], options["flush_interval"])
+
+    def route(message_id, stm_id, args, kwargs):
+        worker = placement.get(stm_id)
+        if worker is None:
+            worker = ring.shard_of(stm_id)
+        if worker == index:
+            _logger.warning(
+                "Machine with name %s cannot be found. Ignoring message %s.",
+                stm_id,
+                message_id,
+            )
+            return
+        outbox.put(worker, _message(message_id, stm_id, args, kwargs))
+
+    driver._router = route
+    for factory, args in machines:
+        driver.add_machine(factory(*args))
+    outbox.start()
+    driver.start(keep_active=options["keep_active"])
+    Thread(target=_receive, args=(driver, index, inbound), daemon=True).start()
+    try:
+        driver.wait_until_finished()
+        outbox.close()
+    finally:
+        # senders waiting for room in the channels to this worker give up
+        for channel in inbound:
+            channel.stop_reading()
+
+
+class Cluster:
+    """
+    Runs machines in several worker processes, each with its own driver.
+
+    With the interpreter lock of CPython, the machines of one process never
+    execute transitions in parallel. A cluster starts a number of worker
+    processes that each run a `stmpy.Driver`, and places each machine on one
+    of them by a consistent hash of its name, or explicitly. Each worker runs
+    its machines to completion as usual, and timers stay within the worker
+    of their machine.
+
+    Since machines refer to the objects with their actions, they are not sent
+    to the workers. Instead, a cluster is given a factory for each machine,
+    which the worker calls to create it. Factories and their arguments must
+    be picklable if the platform does not support forking processes.
+
+        #!python
+        def create_counter(name):
+            counter = Counter()
+            return Machine(name=name, transitions=[t0, t1], obj=counter)
+
+        cluster = Cluster(workers=4)
+        for i in range(1000):
+            name = "stm_{}".format(i)
+            cluster.add_machine(name, create_counter, name)
+        cluster.start()
+        cluster.send("tick", "stm_17")
+        cluster.wait_until_finished()
+
+    Messages to machines in other workers, sent via `stmpy.Cluster.send` or
+    `stmpy.Driver.send` within a worker, are collected per destination and
+    sent in batches over channels between each pair of processes. Arguments
+    of such messages must be picklable. By default, the channels are
+    `multiprocessing` pipes. With `channel='shm'`, they are ring buffers in
+    shared memory instead, which the workers poll. These are only available
+    on x86 platforms that support forking. The order of messages from one
+    process to a machine is preserved.
+    """
+
+    def __init__(
+        self,
+        workers=None,
+        channel="pipe",
+        batch=256,
+        flush_interval=0.001,
+        capacity=1 << 18,
+        send_timeout=10.0,
+        **kwargs
+    ):
+        """
+        Create a cluster.
+
+        `workers`: Number of worker processes, by default one per CPU.
+
+        `channel`: `'shm'` or `'pipe'`, see above.
+
+        `batch`: Number of messages to the same worker that are sent at once.
+
+        `flush_interval`: Seconds after which incomplete batches are sent.
+
+        `capacity`: Size of each shared memory ring buffer in bytes.
+
+        `send_timeout`: Seconds that a sender waits for room in a full shared
+        memory ring buffer, before it raises a `RuntimeError`.
+
+        Further keyword arguments are passed to the constructor of the
+        `stmpy.Driver` of each worker.
+        """
+        self._workers = workers or os.cpu_count() or 1
+        if channel not in _CHANNELS:
+            raise ValueError("Unknown channel {}.".format(channel))
+        if channel == "shm" and not _shm_supported():
+            raise ValueError("Shared memory rings are not available on this platform.")
+        self._channel = channel
+        self._send_timeout = send_timeout
+        self._batch = batch
+        self._flush_interval = flush_interval
+        self._capacity = capacity
+        self._driver_options = kwargs
+        self._ring = _ShardRing(self._workers)
+        self._machines = [[] for _ in range(self._workers)]
+        # machines placed on another worker than the one chosen by hash
+        self._placement = {}
+        self._processes = []
+        self._channels = None
+        self._outbox = None
+
+    @property
+    def workers(self):
+        """Return the number of worker processes."""
+        return self._workers
+
+    def shard_of(self, stm_id):
+        """Return the index of the worker for a machine with this name."""
+        worker = self._placement.get(stm_id)
+        if worker is None:
+            worker = self._ring.shard_of(stm_id)
+        return worker
+
+    def add_machine(self, name, factory, *args, worker=None):
+        """
+        Add a machine to the cluster, before the cluster is started.
+
+        `name`: Name of the machine, which must be the name of the machine
+        returned by the factory.
+
+        `factory`: Callable that creates the machine within its worker,
+        called with `args`.
+
+        `worker`: Index of the worker that runs the machine. By default, the
+        worker is chosen by the name of the machine.
+        """
+        if self._processes:
+            raise RuntimeError("Machines must be added before the cluster starts.")
+        if worker is None:
+            worker = self.shard_of(name)
+        elif worker != self._ring.shard_of(name):
+            self._placement[name] = worker
+        self._machines[worker].append((factory, args))
+        return worker
+
+    def start(self, keep_active=False):
+        """
+        Start the worker processes.
+
+        `keep_active`: When true, keep the workers running even when all
+        their state machines terminated, until `stmpy.Cluster.stop` is called.
+        """
+        if self._channel == "shm":
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        channel = _CHANNELS[self._channel]
+        workers = self._workers
+        # channels[sender][receiver]; the cluster itself sends as the last
+        self._channels = [
+            [channel(self._capacity, self._send_timeout) for _ in range(workers)]
+            for _ in range(workers + 1)
+        ]
+        options = {
+            "driver": self._driver_options,
+            "batch": self._batch,
+            "flush_interval": self._flush_interval,
+            "keep_active": keep_active,
+            "placement": self._placement,
+        }
+        for index in range(workers):
+            inbound = [senders[index] for senders in self._channels]
+            process = context.Process(
+                target=_worker_main,
+                args=(
+                    index,
+                    workers,
+                    self._machines[index],
+                    inbound,
+                    self._channels[index],
+                    options,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+        self._outbox = _Outbox(
+            self._channels[workers], self._batch, self._flush_interval
+        )
+        self._outbox.start()
+
+    def send(self, message_id, stm_id, args=None, kwargs=None):
+        """Send a message to a machine in any worker of the cluster."""
+        self._outbox.put(
+            self.shard_of(stm_id), _message(message_id, stm_id, args, kwargs)
+        )
+
+    def send_many(self, messages):
+        """
+        Send several messages to machines in the workers of the cluster.
+
+        `messages` is an iterable of tuples `(message_id, stm_id, args,
+        kwargs)`, as for `stmpy.Driver.send_many`.
+        """
+        shard_of = self.shard_of
+        for message_id, stm_id, args, kwargs in messages:
+            self._outbox.put(
+                shard_of(stm_id), _message(message_id, stm_id, args, kwargs)
+            )
+
+    def flush(self):
+        """Send all messages that wait for their batch to be complete."""
+        self._outbox.flush()
+
+    def stop(self):
+        """Stop the drivers of all workers, after they dispatched all messages sent so far."""
+        for index in range(self._workers):
+            self._outbox.stop(index)
+
+    def wait_until_finished(self):
+        """Blocking method to wait until all workers finished."""
+        try:
+            for process in self._processes:
+                process.join()
+        finally:
+            self._outbox.close()
+            for senders in self._channels:
+                for channel in senders:
+                    channel.close(unlink=True)
@@ -1,12 +1,52 @@
-import time
+import asyncio
+import gc
 import logging
-from queue import Queue
+import os
+import sys
+from collections import deque
+from functools import partial
 from queue import Empty
+from queue import Full
+from threading import Event
+from threading import Lock
 from threading import Thread
+from threading import get_ident
+from time import perf_counter
 
+from .checkpoint import _apply
+from .checkpoint import _capture
+from .checkpoint import _pack
+from .checkpoint import _read
+from .checkpoint import _write
+from .clock import VirtualClock
+from .clock import WallClock
+from .event import _NO_ARGS
+from .event import _NO_KWARGS
+from .event import _Event
+from .executors import _DoActionPool
+from .executors import _ProcessDoActionPool
+from .journal import _EVENT
+from .journal import _TIMER
+from .journal import _Journal
+from .journal import _replay
+from .metrics import _Metrics
+from .metrics import serve_prometheus
+from .metrics import write_prometheus
+from .profiling import Profile
+from .profiling import _instrument
+from .profiling import _uninstrument
+from .queues import _INITIAL_PRIORITY
+from .queues import _EventQueue
+from .recorder import _FAILED
+from .recorder import _FINAL
+from .recorder import _UNHANDLED
+from .recorder import _FlightRecorder
+from .timers import _HeapTimerQueue
+from .timers import _TimingWheel
 
-def _current_time_millis():
-    return int(round(time.time() * 1000))
+_machine_logger = logging.getLogger("stmpy.machine")
+
+_OVERFLOW_POLICIES = ("block", "raise", "drop_newest", "drop_oldest")
 
 
 class Driver:
@@ -23,18 +63,433 @@ class Driver:
     executed separate from all other transitions.
     """
 
-    _stms_by_id = {}
+    def __init__(
+        self,
+        timer_backend="heap",
+        timer_tick=10,
+        timer_levels=4,
+        clock=None,
+        simulation=False,
+        trace=None,
+        gc_freeze=False,
+        do_workers=None,
+        process_workers=None,
+        cpus=None,
+        quantum=None,
+        timer_priority=1,
+        starvation_limit=100,
+        capacity=None,
+        machine_capacity=None,
+        overflow="block",
+        high_watermark=None,
+        on_high_watermark=None,
+        metrics=False,
+        journal=None,
+        journal_commit=1000,
+        flight_recorder=1024,
+    ):
+        """Create a new driver.
+
+        `timer_backend`: How active timers are stored. With `'heap'` (the
+        default), timers are kept in a heap and expire on the millisecond.
+        With `'wheel'`, timers are kept in a hierarchical timing wheel, for
+        which starting and stopping a timer takes constant time. This pays off
+        with hundreds of thousands of active timers, at the cost of a timer
+        possibly expiring up to one tick later.
+
+        `timer_tick`: Resolution of the timing wheel in milliseconds.
+
+        `timer_levels`: Number of levels of the timing wheel. Each level
+        covers 64 times the range of the level below it; timers beyond the
+        range of all levels are kept in an overflow slot.
+
+        `clock`: The clock from which the driver reads the time, see
+        `stmpy.WallClock` and `stmpy.VirtualClock`. By default, the driver
+        uses the system time.
+
+        `simulation`: When true, the driver does not wait for timers to
+        expire. Whenever its event queue is empty, it advances its clock
+        straight to the expiration of the next timer. This requires a
+        `stmpy.VirtualClock`, which is created if no clock is given.
+        Note that in simulation mode, the driver does not wait for do-actions
+        running in other threads before advancing the clock.
+
+        `trace`: Whether the driver and its machines log each step, such as
+        transitions, timers and deferred events, at debug level. With `None`
+        (the default), tracing follows the logging configuration: the driver
+        checks whether debug logging is enabled once per iteration of its
+        loop, and skips building any debug messages if it is not. With
+        `False`, tracing is off even if debug logging is enabled, which keeps
+        the cost of dispatching events minimal.
+
+        `gc_freeze`: When true, the driver calls `gc.freeze()` after a full
+        collection when it starts, and whenever a machine is added while it
+        runs. This moves the compiled machine definitions and all other
+        objects alive at that point out of the reach of the garbage
+        collector, so that collections while processing events only need to
+        visit new objects and pause the driver for a shorter time.
+
+        `do_workers`: When given, the driver runs do-actions in a thread pool
+        named `'default'` with at most this number of threads, instead of
+        starting a new thread for each do-action. More executors can be
+        added with `stmpy.Driver.add_executor`.
+
+        `process_workers`: Number of worker processes of the process pool
+        named `'process'`, which runs the do-actions marked as process-bound.
+        The pool is created when the first such do-action starts. By default,
+        it has one worker process per CPU.
+
+        `cpus`: Optional set of CPU numbers to which the thread of the driver
+        is pinned when it starts, on platforms that support it.
 
-    def __init__(self):
-        """Create a new driver."""
+        `quantum`: By default, the driver keeps the events of all machines in
+        a single queue, and dispatches them in the order in which they were
+        sent. When a quantum is given, each machine gets a mailbox of its
+        own instead. The driver then takes turns between the machines with
+        queued events, and dispatches up to `quantum` events of one machine
+        before it moves on to the next one. The events of each machine are
+        still dispatched in their order, but a machine with many queued
+        events no longer delays all others until its backlog is processed.
+
+        `timer_priority`: Priority of the events of expired timers. Events
+        are queued in a lane for each priority, and the driver dispatches
+        events of higher priority first. Messages have priority 0 unless
+        they are sent with another one, see `stmpy.Driver.send`, so by
+        default, expired timers are dispatched before waiting messages.
+
+        `starvation_limit`: How often the driver may pass over a lane of
+        lower priority in favour of events of higher priority, before it
+        dispatches an event of the lane that waited longest.
+
+        `capacity`: Maximal number of queued events of the driver. By
+        default, the queue is unbounded.
+
+        `machine_capacity`: Maximal number of queued events of each machine,
+        unless the machine declares its own capacity, see `stmpy.Machine`.
+
+        `overflow`: What happens to a message sent while the queue of the
+        driver or of the receiving machine is full. With `'block'` (the
+        default), the sender waits until the driver dispatched enough
+        events. With `'raise'`, sending raises `queue.Full`. With
+        `'drop_newest'`, the message is discarded, and with `'drop_oldest'`,
+        the oldest queued event of the machine, or of the driver, is
+        discarded to make room for the message. Machines can declare other
+        policies for single triggers. Messages sent from actions, which run
+        in the thread of the driver, never block; they are queued even if
+        the queue is full. Expired timers, the `done` events of do-actions
+        and deferred events are always queued. Discarded events are counted,
+        see `stmpy.Driver.queue_metrics`.
+
+        `high_watermark`: Number of queued events at which the driver calls
+        `on_high_watermark` with the driver and the number of queued events,
+        so that producers can throttle before the queue is full. The
+        callback is called again only after the queue was drained to half
+        of the high watermark.
+
+        `metrics`: Whether the driver measures its work, see
+        `stmpy.Driver.metrics`. Measuring can also be switched on and off
+        while the driver runs, with `stmpy.Driver.set_metrics`.
+
+        `journal`: Directory of a write-ahead journal, in which the driver
+        records each event before it dispatches it, and each expired timer.
+        After a crash, the states of the machines can be rebuilt from the
+        journal with `stmpy.Driver.replay`. The driver appends to the
+        journal in a new segment each time it starts.
+
+        `journal_commit`: Number of records after which the journal is
+        flushed to disk. The journal is also flushed whenever the driver
+        runs out of events, so that records are committed in groups.
+
+        `flight_recorder`: Number of recent transitions that the driver keeps
+        in memory, rounded up to a power of two, see
+        `stmpy.Driver.recent_transitions`. With `0`, the driver keeps none.
+        """
         self._logger = logging.getLogger(__name__)
         self._logger.debug("Logging works")
+        self.set_trace(trace)
         self._active = False
-        self._event_queue = Queue()
-        self._timer_queue = []
+        self._event_queue = _EventQueue(
+            quantum=quantum, starvation_limit=starvation_limit
+        )
+        self._timer_priority = timer_priority
+        if overflow not in _OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {}.".format(overflow))
+        self._capacity = capacity
+        self._machine_capacity = machine_capacity
+        self._overflow = overflow
+        self._on_high_watermark = on_high_watermark
+        self._shed = 0
+        self._shed_by_machine = {}
+        self._shed_by_trigger = {}
+        self._bounded = False
+        if (
+            capacity is not None
+            or machine_capacity is not None
+            or high_watermark is not None
+        ):
+            self._bound(high_watermark)
+        if clock is None:
+            clock = VirtualClock() if simulation else WallClock()
+        if simulation and not hasattr(clock, "advance_to"):
+            raise ValueError("Simulation mode requires a virtual clock.")
+        self._clock = clock
+        self._simulation = simulation
+        if timer_backend == "heap":
+            self._timer_queue = _HeapTimerQueue()
+        elif timer_backend == "wheel":
+            self._timer_queue = _TimingWheel(
+                tick=timer_tick, levels=timer_levels, now=clock.time_millis()
+            )
+        else:
+            raise ValueError("Unknown timer backend {}.".format(timer_backend))
+        self._timer_lock = Lock()
         self._next_timeout = None
-        # TODO need clarity if this should be a class variable
-        Driver._stms_by_id = {}
+        self._next_timeout_abs = None
+        self._thread_ident = None
+        self._gc_freeze = gc_freeze
+        # called with messages to machines outside of this process
+        self._router = None
+        # machines of all drivers of the pool of this driver, by their id
+        self._directory = None
+        self._executors = {}
+        if do_workers is not None:
+            self.add_executor("default", max_workers=do_workers)
+        self._process_workers = process_workers
+        self._stms_by_id = {}
+        self._cpus = cpus
+        self._metrics = None
+        self.set_metrics(metrics)
+        self._profile = None
+        # machine types that this driver instrumented for profiling, by id
+        self._instrumented = {}
+        self._recorder = None
+        if flight_recorder:
+            self._recorder = _FlightRecorder(flight_recorder)
+        self._journal = None
+        if journal is not None:
+            self._journal = _Journal(journal, journal_commit)
+        # functions that the loop calls between two transitions
+        self._pending_calls = deque()
+        # runs the coroutines of actions, created by the first of them
+        self._action_loop = None
+
+    def set_trace(self, trace):
+        """
+        Switch tracing of steps on (`True`), off (`False`), or let it follow
+        the logging configuration (`None`). See `stmpy.Driver`.
+        """
+        self._trace_setting = trace
+        if trace is None:
+            self._trace = self._is_debug_enabled()
+        else:
+            self._trace = bool(trace)
+
+    def set_metrics(self, enabled):
+        """
+        Switch measuring the work of the driver on or off.
+
+        Switching measuring off keeps the metrics collected so far, and
+        switching it on again continues them.
+        """
+        if enabled:
+            if self._metrics is None:
+                self._metrics = _Metrics()
+            self._event_queue._stamp = perf_counter
+            self._measuring = True
+        else:
+            self._event_queue._stamp = None
+            self._measuring = False
+
+    def metrics(self):
+        """
+        Return a snapshot of the metrics of this driver.
+
+        The result is a dictionary with the number of dispatched `events`,
+        executed `transitions`, `deferrals` of events, and `unhandled` events
+        for which the machine declared no transition. It also has histograms
+        of the `queue_wait` of events from sending until dispatch, the time
+        of each transition with its `action`s, and the `timer_lateness` of
+        expired timers. Each maps a tuple `(machine_type, trigger)` to a
+        dictionary with the `count`, `sum` and `max` of the measured times,
+        and their quantiles `p50`, `p90`, `p99` and `p999`, in seconds.
+        The machine type is the name of the class of the object of the
+        machine, and the trigger of initial transitions is `'initial'`.
+
+        Metrics are only collected while measuring is switched on, see
+        argument `metrics` of `stmpy.Driver`. Times are recorded in buckets
+        whose width is about 6% of their value, which bounds the error of
+        the quantiles. Events queued before measuring was switched on have
+        no queue wait.
+        """
+        if self._metrics is None:
+            return _Metrics().snapshot()
+        return self._metrics.snapshot()
+
+    def write_metrics(self, path):
+        """
+        Write the metrics of this driver to a file in the Prometheus text format.
+
+        The file is replaced at once, so that it can be read by the textfile
+        collector of the Prometheus node exporter.
+        """
+        write_prometheus(self, path)
+
+    def serve_metrics(self, address):
+        """
+        Serve the metrics of this driver in the Prometheus text format.
+
+        `address` is a tuple `(host, port)`, where Prometheus can scrape the
+        metrics over HTTP. Returns the server, which runs in a daemon thread
+        until its `shutdown()` method is called.
+        """
+        return serve_prometheus(self, address)
+
+    def start_profiling(self):
+        """
+        Start to measure the time of each action of the machines of this driver.
+
+        This can be called while the driver runs; the machines measure their
+        actions from their next transition on. Returns a new
+        `stmpy.profiling.Profile` that collects the measurements until
+        `stmpy.Driver.stop_profiling` is called. Machines created by a
+        `stmpy.MachineType` share their actions with the other machines of
+        their type, which are only measured if their driver profiles, too.
+        """
+        profile = Profile()
+        self._profile = profile
+        for machine_type in self._machine_types():
+            self._instrument(machine_type)
+        return profile
+
+    def stop_profiling(self):
+        """Stop profiling, and return the profile, or `None` if not profiling."""
+        profile = self._profile
+        self._profile = None
+        instrumented = self._instrumented
+        self._instrumented = {}
+        for machine_type in instrumented.values():
+            _uninstrument(machine_type)
+        return profile
+
+    def _instrument(self, machine_type):
+        # types shared with other drivers count each driver once
+        if id(machine_type) not in self._instrumented:
+            self._instrumented[id(machine_type)] = machine_type
+            _instrument(machine_type)
+
+    def _machine_types(self):
+        types = {}
+        for stm in list(self._stms_by_id.values()):
+            types[id(stm._type)] = stm._type
+        return types.values()
+
+    def recent_transitions(self):
+        """
+        Return the most recent transitions of the machines of this driver.
+
+        The driver always records its transitions in a ring buffer of fixed
+        size, see argument `flight_recorder` of `stmpy.Driver`, which costs
+        far less than tracing them with logging. The result is a list of
+        tuples `(machine, source, trigger, target)`, oldest first. To keep
+        recording cheap, transitions are not timed. The trigger of initial
+        transitions is `None`.
+        The target of events without a transition is `'(unhandled)'`, and of
+        transitions whose actions raised an exception `'(exception)'`.
+
+        This can also be called while the driver runs, or is stuck in an
+        action. When an action raises an exception, the driver logs the
+        recent transitions as an error before the exception ends its loop.
+        """
+        if self._recorder is None:
+            return []
+        return self._recorder.entries()
+
+    def dump_transitions(self, file=None):
+        """
+        Write the recent transitions to a file, `sys.stderr` by default.
+
+        See `stmpy.Driver.recent_transitions`.
+        """
+        if self._recorder is not None:
+            print(self._recorder.format(), file=file or sys.stderr)
+
+    def checkpoint(self, path):
+        """
+        Save the state of this driver to a file, to continue later with `restore`.
+
+        The checkpoint holds the state of each machine, its deferred events,
+        the events in the queue of the driver, and the active timers with
+        their remaining time. The arguments of events must be picklable.
+        While the driver runs, its loop captures the state between two
+        transitions, and then goes on while the file is written in the
+        calling thread. This method blocks until the file is written, and
+        must not be called from an action.
+        """
+        captured = []
+        if self._active:
+            if get_ident() == self._thread_ident:
+                raise RuntimeError("A checkpoint cannot be taken within an action.")
+            done = Event()
+
+            def capture():
+                captured.append(_capture(self))
+                done.set()
+
+            self._pending_calls.append(capture)
+            self._wake_queue()
+            # the loop may also have finished in the meantime
+            while not done.wait(0.1) and self.thread.is_alive():
+                pass
+        _write(_pack(captured[0] if captured else _capture(self)), path)
+
+    def restore(self, path):
+        """
+        Continue from a checkpoint written by `stmpy.Driver.checkpoint`.
+
+        The machines must be added to the driver as before, with the same
+        names, but the driver must not be started yet. Each machine gets its
+        state and its deferred events back, without executing the initial
+        transition or any entry actions again. The queued events and active
+        timers of the checkpoint replace the initial events of the machines.
+        Do-actions of the current states of machines are started again.
+        """
+        if self._active:
+            raise RuntimeError("A driver can only be restored before it starts.")
+        _apply(self, _read(path))
+
+    def replay(self, path):
+        """
+        Rebuild the states of machines from the journal in directory `path`.
+
+        The machines must be added to the driver as before, with the same
+        names, but the driver must not be started yet. The events and
+        expired timers of the journal are executed in their order, so the
+        actions of the machines run again and must lead to the same states.
+        Events that the actions send are not dispatched twice, but events
+        still queued when the journal ended are queued again. Timers that
+        were active when the journal ended start over when their machines
+        start them again during the replay. Returns the number of records.
+
+        Replaying can start from a checkpoint, see `stmpy.Driver.restore`,
+        if the journal only holds the events dispatched after it.
+        """
+        if self._active:
+            raise RuntimeError("A driver can only replay before it starts.")
+        return _replay(self, path)
+
+    def _run_pending_calls(self):
+        while self._pending_calls:
+            self._pending_calls.popleft()()
+
+    def _is_debug_enabled(self):
+        return self._logger.isEnabledFor(logging.DEBUG) or _machine_logger.isEnabledFor(
+            logging.DEBUG
+        )
+
+    @property
+    def clock(self):
+        """Return the clock from which this driver reads the time."""
+        return self._clock
 
     def _wake_queue(self):
         # Sends a None event to wake up the queue.
@@ -44,19 +499,19 @@ class Driver:
         """Provide a snapshot of the current status."""
         s = []
         s.append("=== State Machines: ===\n")
-        for stm_id in Driver._stms_by_id:
-            stm = Driver._stms_by_id[stm_id]
+        for stm_id in self._stms_by_id:
+            stm = self._stms_by_id[stm_id]
             s.append("    - {} in state {}\n".format(stm.id, stm.state))
         s.append("=== Events in Queue: ===\n")
-        for event in self._event_queue.queue:
-            if event is not None:
-                s.append(
-                    "    - {} for {} with args:{} kwargs:{}\n".format(
-                        event["id"], event["stm"].id, event["args"], event["kwargs"]
-                    )
+        for event in self._queued_events():
+            s.append(
+                "    - {} for {} with args:{} kwargs:{}\n".format(
+                    event.id, event.stm.id, event.args, dict(event.kwargs)
                 )
-        s.append("=== Active Timers: {} ===\n".format(len(self._timer_queue)))
-        for timer in self._timer_queue:
+            )
+        timers = self._active_timers()
+        s.append("=== Active Timers: {} ===\n".format(len(timers)))
+        for timer in timers:
             s.append(
                 "    - {} for {} with timeout {}\n".format(
                     timer["id"], timer["stm"].id, timer["timeout"]
@@ -80,19 +535,19 @@ class Driver:
         +---------------------------------------"""
         s = []
         s.append("=== State Machines: ===\n")
-        for stm_id in Driver._stms_by_id:
-            stm = Driver._stms_by_id[stm_id]
+        for stm_id in self._stms_by_id:
+            stm = self._stms_by_id[stm_id]
             s.append("    - {} in state {}\n".format(stm.id, stm.state))
         s.append("=== Events in Queue: ===\n")
-        for event in self._event_queue.queue:
-            if event is not None:
-                s.append(
-                    "    - {} for {} with args:{} kwargs:{}\n".format(
-                        event["id"], event["stm"].id, event["args"], event["kwargs"]
-                    )
+        for event in self._queued_events():
+            s.append(
+                "    - {} for {} with args:{} kwargs:{}\n".format(
+                    event.id, event.stm.id, event.args, dict(event.kwargs)
                 )
-        s.append("=== Active Timers: {} ===\n".format(len(self._timer_queue)))
-        for timer in self._timer_queue:
+            )
+        timers = self._active_timers()
+        s.append("=== Active Timers: {} ===\n".format(len(timers)))
+        for timer in timers:
             s.append(
                 "    - {} for {} with timeout {}\n".format(
                     timer["id"], timer["stm"].id, timer["timeout"]
@@ -101,15 +556,61 @@ class Driver:
         s.append("=== ================ ===\n")
         return "".join(s)
 
+    def _queued_events(self):
+        with self._event_queue.mutex:
+            return self._event_queue._events()
+
+    def queue_depth(self, stm_id):
+        """
+        Return the number of queued events for the machine with this name.
+
+        With mailboxes, see argument `quantum` of `stmpy.Driver`, this takes
+        constant time. Otherwise, the driver counts the events in its queue.
+        """
+        stm = self._stms_by_id.get(stm_id)
+        if stm is None:
+            return 0
+        with self._event_queue.mutex:
+            return self._event_queue._depth(stm)
+
+    def _take_events(self):
+        # removes all queued events, for restoring checkpoints and replaying
+        queue = self._event_queue
+        with queue.mutex:
+            events = queue._events()
+            queue.unfinished_tasks -= queue._size
+            queue._clear()
+        return events
+
+    def _active_timers(self):
+        with self._timer_lock:
+            return list(self._timer_queue)
+
     def add_machine(self, machine):
         """Add the state machine to this driver."""
         self._logger.debug("Adding machine {} to driver".format(machine.id))
         machine._driver = self
+        machine._compile()
         machine._reset()
+        if self._profile is not None:
+            self._instrument(machine._type)
+        if machine._type._capacity is not None and not self._bounded:
+            self._bound()
+        if self._gc_freeze and self._active:
+            self._freeze()
         if machine.id is not None:
             # TODO warning when STM already registered
-            Driver._stms_by_id[machine.id] = machine
-            self._add_event(event_id=None, args=[], kwargs={}, stm=machine)
+            self._stms_by_id[machine.id] = machine
+            if self._directory is not None:
+                self._directory.add(machine)
+            # the initial transition must come before any message
+            self._add_event(
+                event_id=None,
+                args=_NO_ARGS,
+                kwargs=_NO_KWARGS,
+                stm=machine,
+                priority=_INITIAL_PRIORITY,
+            )
 
     def start(self, max_transitions=None, keep_active=False):
         """
@@ -124,6 +625,8 @@ class Driver:
         machines terminated
         """
         self._active = True
+        if self._gc_freeze:
+            self._freeze()
         self._max_transitions = max_transitions
         self._keep_active = keep_active
         self.thread = Thread(target=self._start_loop)
@@ -134,6 +637,10 @@ class Driver:
         self.start(max_transitions=steps)
         self.wait_until_finished()
 
+    def _freeze(self):
+        gc.collect()
+        gc.freeze()
+
     def stop(self):
         """Stop the driver."""
         self._active = False
@@ -148,116 +655,396 @@ class Driver:
             self._active = False
             self._wake_queue()
 
-    def _sort_timer_queue(self):
-        self._timer_queue = sorted(
-            self._timer_queue, key=lambda timer: timer["timeout_abs"]
-        )
-
     def _start_timer(self, name, timeout, stm):
-        self._logger.debug("Start timer with name={} from stm={}".format(name, stm.id))
-        timeout_abs = _current_time_millis() + int(timeout)
-        self._stop_timer(name, stm, log=False)
-        self._timer_queue.append(
-            {
-                "id": name,
-                "timeout": timeout,
-                "timeout_abs": timeout_abs,
-                "stm": stm,
-                "tid": stm.id + "_" + name,
-            }
-        )
-        self._sort_timer_queue()
-        self._wake_queue()
+        if self._trace:
+            self._logger.debug("Start timer with name=%s from stm=%s", name, stm.id)
+        timeout_abs = self._clock.time_millis() + int(timeout)
+        timer = {
+            "id": name,
+            "timeout": timeout,
+            "timeout_abs": timeout_abs,
+            "stm": stm,
+            "tid": (stm.id, name),
+        }
+        with self._timer_lock:
+            self._timer_queue.start(timer)
+        if get_ident() != self._thread_ident:
+            # the driver thread may be blocked with an outdated timeout
+            self._wake_queue()
 
     def _stop_timer(self, name, stm, log=True):
-        if log:
-            self._logger.debug(
-                "Stopping timer with name={} from stm={}".format(name, stm.id)
-            )
-        index = 0
-        index_to_delete = None
-        tid = stm.id + "_" + name
-        for timer in self._timer_queue:
-            if timer["tid"] == tid:
-                index_to_delete = index
-            index = index + 1
-        if index_to_delete is not None:
-            self._timer_queue.pop(index_to_delete)
+        if log and self._trace:
+            self._logger.debug("Stopping timer with name=%s from stm=%s", name, stm.id)
+        with self._timer_lock:
+            self._timer_queue.stop((stm.id, name))
 
     def _get_timer(self, name, stm):
-        tid = stm.id + "_" + name
-        for timer in self._timer_queue:
-            if timer["tid"] == tid:
-                return timer["timeout_abs"] - _current_time_millis()
+        with self._timer_lock:
+            timer = self._timer_queue.get((stm.id, name))
+        if timer is not None:
+            return timer["timeout_abs"] - self._clock.time_millis()
         return None
 
     def _check_timers(self):
         """
         Check for expired timers.
 
-        If there are any timers that expired, place them in the event
-        queue.
+        All timers that expired are queued in the lane of the timer priority,
+        in the order of their expiration.
         """
-        if self._timer_queue:
-            timer = self._timer_queue[0]
-            if timer["timeout_abs"] < _current_time_millis():
-                # the timer is expired, remove first element in queue
-                self._timer_queue.pop(0)
-                # put into the event queue
-                self._logger.debug(
-                    "Timer {} expired for stm {}, adding it to event queue.".format(
-                        timer["id"], timer["stm"].id
+        now = self._clock.time_millis()
+        with self._timer_lock:
+            expired = self._timer_queue.pop_expired(now)
+            next_timeout_abs = self._timer_queue.next_timeout_abs()
+        if expired:
+            events = []
+            if self._measuring:
+                for timer in expired:
+                    self._metrics.observe(
+                        "timer_lateness",
+                        (type(timer["stm"]._obj).__name__, timer["id"]),
+                        (now - timer["timeout_abs"]) / 1000,
+                    )
+            for timer in expired:
+                if self._journal is not None:
+                    self._journal.append(
+                        _TIMER, timer["stm"].id, timer["id"], _NO_ARGS, _NO_KWARGS
+                    )
+                if self._trace:
+                    self._logger.debug(
+                        "Timer %s expired for stm %s, adding it to event queue.",
+                        timer["id"],
+                        timer["stm"].id,
+                    )
+                events.append(
+                    _Event(
+                        timer["id"],
+                        _NO_ARGS,
+                        _NO_KWARGS,
+                        timer["stm"],
+                        self._timer_priority,
                     )
                 )
-                self._add_event(timer["id"], [], {}, timer["stm"], front=True)
-                # not necessary to set next timeout,
-                # complete check timers will be called again
-            else:
-                self._next_timeout = (
-                    timer["timeout_abs"] - _current_time_millis()
-                ) / 1000
-                if self._next_timeout < 0:
-                    self._next_timeout = 0
-        else:
+            self._add_events(events)
+        self._next_timeout_abs = next_timeout_abs
+        if next_timeout_abs is None:
             self._next_timeout = None
+        else:
+            self._next_timeout = max(0, (next_timeout_abs - now) / 1000)
 
-    def _add_event(self, event_id, args, kwargs, stm, front=False):
-        if front:
-            self._event_queue.queue.appendleft(
-                {"id": event_id, "args": args, "kwargs": kwargs, "stm": stm}
-            )
+    def _add_event(self, event_id, args, kwargs, stm, priority=0):
+        self._event_queue.put(_Event(event_id, args, kwargs, stm, priority))
+
+    def _bound(self, high_watermark=None):
+        with self._event_queue.mutex:
+            self._event_queue._track(high_watermark)
+        self._bounded = True
+
+    def _send_event(self, event):
+        # messages pass the capacity checks, other events are always queued
+        if self._bounded:
+            self._admit((event,))
         else:
-            self._event_queue.put(
-                {"id": event_id, "args": args, "kwargs": kwargs, "stm": stm}
+            self._event_queue.put(event)
+
+    def _send_events(self, events):
+        if self._bounded:
+            self._admit(events)
+        else:
+            self._add_events(events)
+
+    def _admit(self, events):
+        queue = self._event_queue
+        in_loop = get_ident() == self._thread_ident
+        capacity = self._capacity
+        queued = False
+        crossed = False
+        with queue.mutex:
+            try:
+                for event in events:
+                    stm = event.stm
+                    limit = stm._type._capacity
+                    if limit is None:
+                        limit = self._machine_capacity
+                    while True:
+                        machine_full = (
+                            limit is not None and queue._counts.get(stm, 0) >= limit
+                        )
+                        if not machine_full and (
+                            capacity is None or queue._size < capacity
+                        ):
+                            break
+                        policy = stm._type._overflow.get(event.id, self._overflow)
+                        if policy == "block" and not in_loop:
+                            queue.not_full.wait()
+                            continue
+                        if policy == "raise":
+                            raise Full(
+                                "The queue for machine {} is full.".format(stm.id)
+                            )
+                        if policy == "drop_newest":
+                            self._count_shed(event)
+                            event = None
+                        elif policy == "drop_oldest":
+                            dropped = queue._drop_oldest(stm if machine_full else None)
+                            if dropped is not None:
+                                queue.unfinished_tasks -= 1
+                                self._count_shed(dropped)
+                        break
+                    if event is None:
+                        continue
+                    queue._put(event)
+                    queue.unfinished_tasks += 1
+                    queued = True
+                    if queue._crossed_high_watermark():
+                        crossed = True
+            finally:
+                if queued:
+                    queue.not_empty.notify()
+        if crossed and self._on_high_watermark is not None:
+            self._on_high_watermark(self, queue.qsize())
+
+    def _count_shed(self, event):
+        self._shed += 1
+        stm_id = event.stm.id
+        self._shed_by_machine[stm_id] = self._shed_by_machine.get(stm_id, 0) + 1
+        self._shed_by_trigger[event.id] = self._shed_by_trigger.get(event.id, 0) + 1
+
+    def queue_metrics(self):
+        """
+        Return the state of the event queue of this driver.
+
+        The result is a dictionary with the number of `queued` events, the
+        `capacity` of the queue, and the number of events discarded because
+        of a full queue, in total as `shed`, and by machine and by trigger
+        as `shed_by_machine` and `shed_by_trigger`.
+        """
+        with self._event_queue.mutex:
+            return {
+                "queued": self._event_queue._size,
+                "capacity": self._capacity,
+                "shed": self._shed,
+                "shed_by_machine": dict(self._shed_by_machine),
+                "shed_by_trigger": dict(self._shed_by_trigger),
+            }
+
+    def _add_events_front(self, events):
+        # put events at the head of the queue, keeping their order
+        queue = self._event_queue
+        with queue.mutex:
+            queue._put_front(events)
+            queue.unfinished_tasks += len(events)
+
+    def _add_events(self, events):
+        # enqueue all events under a single lock, and wake the driver once
+        queue = self._event_queue
+        with queue.mutex:
+            queue._put_many(events)
+            queue.unfinished_tasks += len(events)
+            queue.not_empty.notify()
+
+    def send_many(self, messages):
+        """
+        Send several messages to state machines handled by this driver.
+
+        `messages` is an iterable of tuples `(message_id, stm_id, args,
+        kwargs)`, where `args` and `kwargs` may be `None`. The messages are
+        added to the event queue at once, in their order, which is cheaper
+        than calling `stmpy.Driver.send` for each of them. Each message gets
+        the priority declared for its trigger by the receiving machine.
+        Messages to machines of other drivers of the same pool are passed on
+        to them, and messages to unknown machines are ignored with a warning,
+        like in `send`.
+        """
+        events = []
+        remote = None
+        stms_by_id = self._stms_by_id
+        for message_id, stm_id, args, kwargs in messages:
+            stm = stms_by_id.get(stm_id)
+            if stm is None and self._directory is not None:
+                stm = self._directory.get(stm_id)
+            if stm is None:
+                if self._router is not None:
+                    self._router(message_id, stm_id, args, kwargs)
+                    continue
+                self._logger.warning(
+                    "Machine with name %s cannot be found. Ignoring message %s.",
+                    stm_id,
+                    message_id,
+                )
+                continue
+            if args is None:
+                args = _NO_ARGS
+            if kwargs is None:
+                kwargs = _NO_KWARGS
+            event = _Event(
+                message_id, args, kwargs, stm, stm._type._priorities.get(message_id, 0)
             )
+            if stm._driver is self:
+                events.append(event)
+            else:
+                if remote is None:
+                    remote = {}
+                remote.setdefault(stm._driver, []).append(event)
+        if events:
+            self._send_events(events)
+        if remote is not None:
+            for driver, driver_events in remote.items():
+                driver._send_events(driver_events)
 
-    def send(self, message_id, stm_id, args=None, kwargs=None):
+    def send(self, message_id, stm_id, args=None, kwargs=None, priority=None):
         """
         Send a message to a state machine handled by this driver.
 
         If you have a reference to the state machine, you can also send it
         directly to it by using `stmpy.Machine.send`.
 
-        `stm_id` must be the id of a state machine earlier added to the driver.
+        `stm_id` must be the id of a state machine earlier added to the driver,
+        or to another running driver of the same `stmpy.DriverPool`, which
+        then receives the message.
+
+        `priority`: The driver dispatches messages of higher priority before
+        those of lower priority, see `stmpy.Driver`. By default, a message
+        has the priority that the receiving machine declares for its
+        trigger, or 0.
         """
+        stm = self._stms_by_id.get(stm_id)
+        if stm is None and self._directory is not None:
+            stm = self._directory.get(stm_id)
         if args is None:
-            args = []
+            args = _NO_ARGS
         if kwargs is None:
-            kwargs = {}
-        if stm_id not in Driver._stms_by_id:
+            kwargs = _NO_KWARGS
+        if stm is None:
+            if self._router is not None:
+                self._router(message_id, stm_id, args, kwargs)
+                return
             self._logger.warn(
                 "Machine with name {} cannot be found. "
                 "Ignoring message {}.".format(stm_id, message_id)
             )
         else:
-            stm = Driver._stms_by_id[stm_id]
-            self._add_event(message_id, args, kwargs, stm)
+            if priority is None:
+                priority = stm._type._priorities.get(message_id, 0)
+            stm._driver._send_event(_Event(message_id, args, kwargs, stm, priority))
+
+    def add_executor(self, name, max_workers=None, executor=None, processes=False):
+        """
+        Add an executor for do-actions with the given name.
+
+        Without an `executor`, the driver creates a thread pool with at most
+        `max_workers` threads. When all threads are busy, further do-actions
+        wait in the queue of the executor until a thread is free.
+        Alternatively, pass any `concurrent.futures.Executor` as `executor`.
+
+        With `processes=True`, the executor is a process pool instead, or
+        `executor` is expected to run its tasks in other processes. Do-actions
+        in a process pool do not hold the interpreter lock of the driver,
+        which suits CPU-bound activities. The method of such a do-action and
+        its arguments are pickled, so it must be a function or a
+        `staticmethod` rather than a method bound to the object of the
+        machine. Its return value is the argument of the `done` event.
+
+        Machines and states select the executor for their do-actions by its
+        name, see `stmpy.Machine`. The executor named `'default'` runs the
+        do-actions of all other machines and states.
+
+        Executors that the driver creates are shut down when its loop ends,
+        and created again when it runs the next do-action. An `executor`
+        passed to this method is not shut down by the driver.
+        """
+        if processes:
+            pool = _ProcessDoActionPool.create(name, max_workers, executor)
+        else:
+            pool = _DoActionPool.create(name, max_workers, executor)
+        self._executors[name] = pool
+
+    def _shutdown_executors(self):
+        # do-actions that still run complete, but do not keep the threads
+        # and processes of the executors alive after that
+        for pool in list(self._executors.values()):
+            pool.shutdown(wait=False)
+
+    def executor_metrics(self):
+        """
+        Return the utilisation of the executors for do-actions.
+
+        The result maps the name of each executor to a dictionary with its
+        `max_workers`, the number of `active` do-actions and of do-actions
+        `queued` for a free worker, the number of do-actions `submitted` and
+        `completed` so far, and the `utilisation` as the fraction of busy
+        workers. Process pools also report the `argument_bytes` and
+        `result_bytes` of pickled do-actions and results, and the
+        `pickle_seconds` and `unpickle_seconds` spent on them in the driver
+        and the worker processes.
+        """
+        return {name: pool.metrics() for name, pool in self._executors.items()}
+
+    def _get_executor(self, name):
+        if name is not None:
+            pool = self._executors.get(name)
+            if pool is not None:
+                return pool
+            if name == "process":
+                self.add_executor(
+                    "process", max_workers=self._process_workers, processes=True
+                )
+                return self._executors[name]
+            self._logger.error(
+                "No executor with name %s, using the default executor.", name
+            )
+        return self._executors.get("default")
+
+    def _start_do_action(
+        self, stm, function, function_name, args, kwargs, executor=None
+    ):
+        pool = self._get_executor(executor)
+        if pool is not None and pool.processes:
+            try:
+                future = pool.submit(partial(function, *args, **kwargs))
+            except Exception:
+                stm._log_function_error(function_name)
+                self._add_event("done", _NO_ARGS, _NO_KWARGS, stm)
+            else:
+                future.add_done_callback(
+                    partial(stm._finish_process_action, function_name)
+                )
+        elif pool is not None:
+            pool.submit(stm._run_do_action, function, function_name, args, kwargs)
+        else:
+            thread = Thread(
+                target=stm._run_do_action, args=[function, function_name, args, kwargs]
+            )
+            thread.start()
+
+    def _stop_do_action(self, stm):
+        # do-actions running in threads cannot be cancelled
+        pass
+
+    def _await(self, coroutine):
+        # coroutines of actions run to completion within the transition, on
+        # one event loop that is kept until the loop of the driver ends
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            coroutine.close()
+            raise RuntimeError(
+                "Actions that are coroutines cannot run in a thread with a "
+                "running event loop. Use stmpy.AsyncDriver instead."
+            )
+        if self._action_loop is None:
+            self._action_loop = asyncio.new_event_loop()
+        self._action_loop.run_until_complete(coroutine)
 
     def _terminate_stm(self, stm_id):
         self._logger.debug("Terminating machine {}.".format(stm_id))
         # removing it from the table of machines
-        Driver._stms_by_id.pop(stm_id, None)
-        if not self._keep_active and not Driver._stms_by_id:
+        stm = self._stms_by_id.pop(stm_id, None)
+        if stm is not None and self._directory is not None:
+            self._directory.remove(stm)
+        if not self._keep_active and not self._stms_by_id:
             self._logger.debug("No machines anymore, stopping driver.")
             self._active = False
             self._wake_queue()
@@ -265,33 +1052,113 @@ class Driver:
     def _execute_transition(self, stm, event_id, args, kwargs, event):
         if stm._defers_event(event_id):
             stm._add_to_defer_queue(event)
-            self._logger.debug(
-                "Machine {} defers event {} in state {}".format(
-                    stm._id, event_id, stm._state
+            if self._trace:
+                self._logger.debug(
+                    "Machine %s defers event %s in state %s",
+                    stm._id,
+                    event_id,
+                    stm._state,
                 )
-            )
-            return
-        stm._execute_transition(event_id, args, kwargs)
+            return False
+        recorder = self._recorder
+        if recorder is None:
+            executed = stm._execute_transition(event_id, args, kwargs)
+        else:
+            source = stm._current
+            try:
+                executed = stm._execute_transition(event_id, args, kwargs)
+            except Exception:
+                self._record_failure(stm, source, event_id)
+                raise
+            target = stm._current
+            if not executed:
+                target = _UNHANDLED
+            elif target is source and stm._id not in self._stms_by_id:
+                target = _FINAL
+            recorder.record(stm._id, source, event_id, target)
         if self._max_transitions is not None:
             self._max_transitions = self._max_transitions - 1
             if self._max_transitions == 0:
                 self._logger.debug("Stopping driver because max_transitions reached.")
                 self._active = False
+        return executed
+
+    def _record_failure(self, stm, source, event_id):
+        recorder = self._recorder
+        recorder.record(stm._id, source, event_id, _FAILED)
+        self._logger.error(
+            "Machine %s raised an exception. Recent transitions:\n%s",
+            stm._id,
+            recorder.format(),
+        )
+
+    def _execute_measured(self, stm, event_id, args, kwargs, event):
+        metrics = self._metrics
+        start = perf_counter()
+        key = (type(stm._obj).__name__, "initial" if event_id is None else event_id)
+        queued = getattr(event, "queued", None)
+        if queued is not None:
+            metrics.observe("queue_wait", key, start - queued)
+        metrics.events += 1
+        if stm._defers_event(event_id):
+            metrics.deferrals += 1
+            self._execute_transition(stm, event_id, args, kwargs, event)
+        elif self._execute_transition(stm, event_id, args, kwargs, event):
+            metrics.transitions += 1
+            metrics.observe("action", key, perf_counter() - start)
+        else:
+            metrics.unhandled += 1
+
+    def _execute_journaled(self, event):
+        self._journal.append(_EVENT, event.stm._id, event.id, event.args, event.kwargs)
+        if self._measuring:
+            self._execute_measured(event.stm, event.id, event.args, event.kwargs, event)
+        else:
+            self._execute_transition(
+                event.stm, event.id, event.args, event.kwargs, event
+            )
 
     def _start_loop(self):
         self._logger.debug("Starting loop of the driver.")
+        self._thread_ident = get_ident()
+        if self._cpus is not None and hasattr(os, "sched_setaffinity"):
+            # pins the calling thread only
+            os.sched_setaffinity(0, self._cpus)
         while self._active:
+            if self._pending_calls:
+                self._run_pending_calls()
+            if self._trace_setting is None:
+                self._trace = self._is_debug_enabled()
             self._check_timers()
+            if (
+                self._simulation
+                and self._next_timeout_abs is not None
+                and self._event_queue.empty()
+            ):
+                # nothing to do until the next timer expires, so skip ahead
+                self._clock.advance_to(self._next_timeout_abs)
+                continue
+            if (
+                self._journal is not None
+                and self._journal.pending
+                and self._event_queue.empty()
+            ):
+                # commits all records since the driver was last idle at once
+                self._journal.commit()
             try:
                 event = self._event_queue.get(block=True, timeout=(self._next_timeout))
-                if event is not None:
+                if event is None:
                     # (None events are just used to wake up the queue.)
+                    pass
+                elif self._journal is not None:
+                    self._execute_journaled(event)
+                elif self._measuring:
+                    self._execute_measured(
+                        event.stm, event.id, event.args, event.kwargs, event
+                    )
+                else:
                     self._execute_transition(
-                        stm=event["stm"],
-                        event_id=event["id"],
-                        args=event["args"],
-                        kwargs=event["kwargs"],
-                        event=event,
+                        event.stm, event.id, event.args, event.kwargs, event
                     )
             except Empty:
                 # timeout has occured
@@ -299,4 +1166,11 @@ class Driver:
             except KeyboardInterrupt:
                 self.active = False
                 self._logger.debug("Keyboard interrupt. Stopping the driver.")
+        self._run_pending_calls()
+        if self._journal is not None:
+            self._journal.close()
+        if self._action_loop is not None:
+            self._action_loop.close()
+            self._action_loop = None
+        self._shutdown_executors()
         self._logger.debug("Driver loop is finished.")
@@ -0,0 +1,30 @@
+from types import MappingProxyType
+
+_NO_ARGS = ()
+"""Shared arguments of events that carry no arguments."""
+
+_NO_KWARGS = MappingProxyType({})
+"""Shared, read-only keyword arguments of events that carry none."""
+
+
+class _Event:
+    """An event in the queue of a driver, addressed to a single machine."""
+
+    # `queued` is only set while the driver measures queue wait
+    __slots__ = ("id", "args", "kwargs", "stm", "priority", "queued")
+
+    def __init__(self, id, args, kwargs, stm, priority=0):
+        self.id = id
+        self.args = args
+        self.kwargs = kwargs
+        self.stm = stm
+        self.priority = priority
+
+    def __getitem__(self, key):
+        # events used to be dictionaries, keep reading them that way working
+        return getattr(self, key)
+
+    def __repr__(self):
+        return "_Event({!r}, {!r}, {!r}, {!r})".format(
+            self.id, self.args, dict(self.kwargs), self.stm.id
+        )
@@ -0,0 +1,184 @@
+import pickle
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+
+
+class _DoActionPool:
+    """
+    An executor for do-actions, together with counters about its use.
+
+    The counters are kept by the pool itself, so that they work for any
+    `concurrent.futures.Executor`.
+    """
+
+    processes = False
+
+    def __init__(self, name, executor, max_workers, owned):
+        self.name = name
+        self.executor = executor
+        self.max_workers = max_workers
+        self.owned = owned
+        self._lock = Lock()
+        self._submitted = 0
+        self._started = 0
+        self._completed = 0
+
+    @classmethod
+    def create(cls, name, max_workers=None, executor=None):
+        if executor is not None:
+            return cls(name, executor, getattr(executor, "_max_workers", None), False)
+        executor = cls._new_executor(name, max_workers)
+        return cls(name, executor, executor._max_workers, True)
+
+    @staticmethod
+    def _new_executor(name, max_workers):
+        return ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="stmpy-{}".format(name)
+        )
+
+    def _executor(self):
+        if self.executor is None:
+            # the driver shut it down when its loop ended, and started again
+            self.executor = self._new_executor(self.name, self.max_workers)
+        return self.executor
+
+    def submit(self, function, *args):
+        with self._lock:
+            self._submitted += 1
+        return self._executor().submit(self._run, function, args)
+
+    def _run(self, function, args):
+        with self._lock:
+            self._started += 1
+        try:
+            return function(*args)
+        finally:
+            with self._lock:
+                self._completed += 1
+
+    def metrics(self):
+        with self._lock:
+            submitted = self._submitted
+            started = self._started
+            completed = self._completed
+        active = started - completed
+        metrics = {
+            "max_workers": self.max_workers,
+            "active": active,
+            "queued": submitted - started,
+            "submitted": submitted,
+            "completed": completed,
+            "utilisation": None,
+        }
+        if self.max_workers:
+            metrics["utilisation"] = active / self.max_workers
+        return metrics
+
+    def shutdown(self, wait=True):
+        """
+        Shut down the executor if the pool created it.
+
+        Executors passed to the pool are left to their owner. A pool that was
+        shut down creates a new executor for the next do-action.
+        """
+        if self.owned and self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+
+def _run_pickled(payload):
+    # runs in the worker process, which reports its own pickling time
+    start = perf_counter()
+    function, args = pickle.loads(payload)
+    unpickle_seconds = perf_counter() - start
+    result = function(*args)
+    start = perf_counter()
+    result = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    return result, unpickle_seconds, perf_counter() - start
+
+
+class _ProcessDoActionPool(_DoActionPool):
+    """
+    A pool of worker processes for CPU-bound do-actions.
+
+    Do-actions and their arguments are pickled by the pool itself before
+    they are handed to the worker processes, and results are unpickled by
+    the pool when they come back, so that the time spent on pickling and
+    the size of the pickled data can be reported in the metrics. The future
+    returned by `submit` resolves to the result of the do-action.
+    """
+
+    processes = True
+
+    def __init__(self, name, executor, max_workers, owned):
+        _DoActionPool.__init__(self, name, executor, max_workers, owned)
+        self._argument_bytes = 0
+        self._result_bytes = 0
+        self._pickle_seconds = 0.0
+        self._unpickle_seconds = 0.0
+
+    @staticmethod
+    def _new_executor(name, max_workers):
+        return ProcessPoolExecutor(max_workers=max_workers)
+
+    def submit(self, function, *args):
+        start = perf_counter()
+        payload = pickle.dumps((function, args), pickle.HIGHEST_PROTOCOL)
+        pickle_seconds = perf_counter() - start
+        with self._lock:
+            self._submitted += 1
+            self._argument_bytes += len(payload)
+            self._pickle_seconds += pickle_seconds
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self._executor().submit(_run_pickled, payload).add_done_callback(
+            lambda inner: self._finish(inner, future)
+        )
+        return future
+
+    def _finish(self, inner, future):
+        try:
+            result, unpickle_seconds, pickle_seconds = inner.result()
+            start = perf_counter()
+            value = pickle.loads(result)
+            unpickle_seconds += perf_counter() - start
+        except BaseException as error:
+            with self._lock:
+                self._completed += 1
+            future.set_exception(error)
+            return
+        with self._lock:
+            self._completed += 1
+            self._result_bytes += len(result)
+            self._pickle_seconds += pickle_seconds
+            self._unpickle_seconds += unpickle_seconds
+        future.set_result(value)
+
+    def metrics(self):
+        with self._lock:
+            submitted = self._submitted
+            completed = self._completed
+            metrics = {
+                "argument_bytes": self._argument_bytes,
+                "result_bytes": self._result_bytes,
+                "pickle_seconds": self._pickle_seconds,
+                "unpickle_seconds": self._unpickle_seconds,
+            }
+        active = min(submitted - completed, self.max_workers or 0)
+        metrics.update(
+            {
+                "max_workers": self.max_workers,
+                # worker processes do not report when they pick up an action
+                "active": active,
+                "queued": submitted - completed - active,
+                "submitted": submitted,
+                "completed": completed,
+                "utilisation": None,
+            }
+        )
+        if self.max_workers:
+            metrics["utilisation"] = active / self.max_workers
+        return metrics
@@ -0,0 +1,210 @@
+import logging
+import mmap
+import os
+import pickle
+import struct
+from collections import deque
+
+from .checkpoint import _pack_args
+from .checkpoint import _unpack_args
+from .event import _NO_ARGS
+from .event import _NO_KWARGS
+from .event import _Event
+
+_MAGIC = b"STMPYJ\x01\x00"
+"""Start of journal segments, with the version of the format."""
+
+_LENGTH = struct.Struct("<I")
+
+_SEGMENT_SIZE = 1 << 24
+"""Default size of a segment, preallocated when it is created."""
+
+_EVENT = 0
+"""Kind of the records of events that the driver dispatched."""
+
+_TIMER = 1
+"""Kind of the records of expired timers."""
+
+_logger = logging.getLogger(__name__)
+
+
+def _segments(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".journal")
+    )
+
+
+class _Journal:
+    """
+    Write-ahead journal of the events that a driver dispatches.
+
+    The journal is a directory of segment files, which are numbered in the
+    order in which they are written. Each segment is preallocated and
+    mapped into memory, so that appending a record only copies it into the
+    mapping. A record is its length as an unsigned 32-bit integer, followed
+    by a pickled tuple `(kind, stm_id, event_id, args, kwargs)`. The end of
+    a segment is marked by a length of zero, which is what the unused part
+    of the file holds.
+
+    Records are committed in groups: the pages of all records appended since
+    the last commit are flushed to disk at once, after `commit_interval`
+    records or when the driver runs out of events. Records that are
+    appended but not yet committed survive a crash of the process, since
+    they are in the mapping of the file, but not a crash of the system.
+    """
+
+    def __init__(self, directory, commit_interval=1000, segment_size=_SEGMENT_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._commit_interval = commit_interval
+        self._segment_size = segment_size
+        self._map = None
+        self._offset = 0
+        self._committed = 0
+        self.pending = 0
+        segments = _segments(directory)
+        if segments:
+            self._index = int(os.path.basename(segments[-1]).split(".")[0]) + 1
+        else:
+            self._index = 0
+
+    def _next_segment(self, size):
+        self.close()
+        path = os.path.join(self._directory, "{:08d}.journal".format(self._index))
+        self._index += 1
+        size = max(self._segment_size, len(_MAGIC) + size + _LENGTH.size)
+        with open(path, "w+b") as file:
+            file.truncate(size)
+            self._map = mmap.mmap(file.fileno(), size)
+        self._map[: len(_MAGIC)] = _MAGIC
+        self._offset = len(_MAGIC)
+        self._committed = 0
+
+    def append(self, kind, stm_id, event_id, args, kwargs):
+        record = pickle.dumps(
+            (kind, stm_id, event_id, *_pack_args(args, kwargs)),
+            pickle.HIGHEST_PROTOCOL,
+        )
+        end = self._offset + _LENGTH.size + len(record)
+        if self._map is None or end + _LENGTH.size > len(self._map):
+            self._next_segment(len(record) + _LENGTH.size)
+            end = self._offset + _LENGTH.size + len(record)
+        # the length comes last, so that a torn record ends the segment
+        self._map[self._offset + _LENGTH.size : end] = record
+        _LENGTH.pack_into(self._map, self._offset, len(record))
+        self._offset = end
+        self.pending += 1
+        if self.pending >= self._commit_interval:
+            self.commit()
+
+    def commit(self):
+        """Flush the records appended since the last commit to disk."""
+        if self.pending:
+            # flushing must start at a page boundary
+            start = self._committed - self._committed % mmap.ALLOCATIONGRANULARITY
+            self._map.flush(start, self._offset - start)
+            self._committed = self._offset
+            self.pending = 0
+
+    def close(self):
+        if self._map is not None:
+            self.commit()
+            self._map.close()
+            self._map = None
+
+
+def _records(directory):
+    """Iterate over the records of all segments of a journal, in their order."""
+    for path in _segments(directory):
+        with open(path, "rb") as file:
+            data = file.read()
+        if data[: len(_MAGIC)] != _MAGIC:
+            raise ValueError("{} is not a segment of a journal.".format(path))
+        offset = len(_MAGIC)
+        while offset + _LENGTH.size <= len(data):
+            (length,) = _LENGTH.unpack_from(data, offset)
+            if length == 0:
+                break
+            offset += _LENGTH.size
+            try:
+                record = pickle.loads(data[offset : offset + length])
+            except Exception:
+                _logger.warning("Journal ends with an incomplete record in %s.", path)
+                return
+            offset += length
+            yield record
+
+
+def _match(entries, args, kwargs):
+    """Remove and return the first event of `entries` with these arguments."""
+    if entries:
+        for i, (_, event) in enumerate(entries):
+            if _pack_args(event.args, event.kwargs) == (args, kwargs):
+                del entries[i]
+                return event
+    return None
+
+
+def _replay(driver, directory):
+    """
+    Execute the records of a journal with the machines of a driver.
+
+    Events that the actions of machines send during the replay are not
+    dispatched, since the journal holds them where the driver dispatched
+    them. Instead, each is matched with the next record of its machine,
+    trigger and arguments. Events that remain unmatched were still queued when the
+    journal ended, and are queued again in the order in which they were
+    sent. Returns the number of records.
+    """
+    driver._keep_active = True
+    pending = {}
+    sequence = 0
+
+    def collect(events):
+        nonlocal sequence
+        for event in events:
+            key = (event.stm, event.id)
+            if key not in pending:
+                pending[key] = deque()
+            pending[key].append((sequence, event))
+            sequence += 1
+
+    collect(driver._take_events())
+    count = 0
+    for kind, stm_id, event_id, args, kwargs in _records(directory):
+        stm = driver._stms_by_id.get(stm_id)
+        if stm is None:
+            _logger.warning(
+                "Journal refers to machine %s, which is not in the driver.",
+                stm_id,
+            )
+            continue
+        count += 1
+        if kind == _TIMER:
+            # the event of the timer is matched by a later record, if any
+            driver._stop_timer(event_id, stm, log=False)
+            collect(
+                [_Event(event_id, _NO_ARGS, _NO_KWARGS, stm, driver._timer_priority)]
+            )
+            continue
+        event = _match(pending.get((stm, event_id)), args, kwargs)
+        if event is None:
+            event = _Event(event_id, *_unpack_args(args, kwargs), stm)
+        if stm._defers_event(event_id):
+            stm._add_to_defer_queue(event)
+        else:
+            stm._execute_transition(event.id, event.args, event.kwargs)
+            # the events sent by the actions wait for their own records
+            collect(driver._take_events())
+    remaining = sorted(
+        (entry for entries in pending.values() for entry in entries),
+        key=lambda entry: entry[0],
+    )
+    driver._add_events(
+        [event for _, event in remaining if event.stm._id in driver._stms_by_id]
+    )
+    return count
@@ -0,0 +1,333 @@
+"""
+Generate load on a driver, and report throughput, latency and memory.
+
+    python -m stmpy.loadgen [--topology pingpong] [--machines 1000] [--rate 10000] [--duration 10]
+
+The load generator creates machines in one of the following topologies:
+
+* `pingpong`: pairs of machines pass each message back and forth `--hops`
+  times.
+* `pipeline`: chains of `--stages` machines pass each message on to the
+  next stage.
+* `fanout`: sources forward each message to `--fanout` sinks.
+* `watchdog`: each message kicks a machine, which restarts a timer of
+  `--timeout` milliseconds. Machines whose timer expires count it.
+
+Messages are sent with `stmpy.Driver.send` at the target rate for the given
+duration, round-robin to the machines where messages enter the topology.
+Each message carries the time it was sent, and the machine where it ends
+records its end-to-end latency. While the load runs, the queue depth and the
+resident memory of the process are sampled. At the end, all machines are
+stopped, and the load generator reports any timers that terminated machines
+left behind. With `--json`, the report is also written to a file.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from .driver import Driver
+from .machine import MachineType
+from .metrics import _Histogram
+
+
+class _Load:
+    """Latencies of the messages that reached the end of the topology."""
+
+    def __init__(self):
+        self.latency = _Histogram()
+
+    def complete(self, sent):
+        self.latency.record(time.perf_counter() - sent)
+
+
+class _PingPong:
+    def __init__(self, load, partner):
+        self.load = load
+        self.partner = partner
+
+    def ball(self, sent, hops):
+        if hops <= 1:
+            self.load.complete(sent)
+        else:
+            self.stm.driver.send("ball", self.partner, args=[sent, hops - 1])
+
+
+class _Stage:
+    def __init__(self, load, next):
+        self.load = load
+        self.next = next
+
+    def item(self, sent):
+        if self.next is None:
+            self.load.complete(sent)
+        else:
+            self.stm.driver.send("item", self.next, args=[sent])
+
+
+class _Source:
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def item(self, sent):
+        self.stm.driver.send_many(("item", sink, [sent], None) for sink in self.sinks)
+
+
+class _Watchdog:
+    def __init__(self, load):
+        self.load = load
+        self.expired = 0
+
+    def kick(self, sent):
+        self.load.complete(sent)
+
+    def expire(self):
+        self.expired = self.expired + 1
+
+
+def _machine_type(trigger, effect, states=None, extra=()):
+    t0 = {"source": "initial", "target": "s"}
+    t1 = {"trigger": trigger, "source": "s", "target": "s", "effect": effect}
+    t2 = {"trigger": "stop", "source": "s", "target": "final"}
+    return MachineType(transitions=[t0, t1, t2] + list(extra), states=states)
+
+
+def build(topology, driver, load, machines, args):
+    """
+    Add the machines of the topology to the driver.
+
+    Returns the trigger of the messages, the names of the machines where
+    messages enter, the arguments of each message besides the time it was
+    sent, how many messages each sent message ends as, and all objects.
+    """
+    objects = []
+
+    def add(machine_type, name, obj):
+        obj.stm = machine_type.create(name, obj)
+        driver.add_machine(obj.stm)
+        objects.append(obj)
+
+    if topology == "pingpong":
+        machine_type = _machine_type("ball", "ball(*)")
+        pairs = max(1, machines // 2)
+        for i in range(pairs):
+            add(machine_type, "a_{}".format(i), _PingPong(load, "b_{}".format(i)))
+            add(machine_type, "b_{}".format(i), _PingPong(load, "a_{}".format(i)))
+        entries = ["a_{}".format(i) for i in range(pairs)]
+        return "ball", entries, [args.hops], 1, objects
+    if topology == "pipeline":
+        machine_type = _machine_type("item", "item(*)")
+        chains = max(1, machines // args.stages)
+        for c in range(chains):
+            for s in range(args.stages):
+                next = None
+                if s + 1 < args.stages:
+                    next = "stage_{}_{}".format(c, s + 1)
+                add(machine_type, "stage_{}_{}".format(c, s), _Stage(load, next))
+        entries = ["stage_{}_0".format(c) for c in range(chains)]
+        return "item", entries, [], 1, objects
+    if topology == "fanout":
+        source_type = _machine_type("item", "item(*)")
+        sink_type = _machine_type("item", "item(*)")
+        sources = max(1, machines // (args.fanout + 1))
+        for i in range(sources):
+            sinks = ["sink_{}_{}".format(i, k) for k in range(args.fanout)]
+            add(source_type, "source_{}".format(i), _Source(sinks))
+            for sink in sinks:
+                add(sink_type, sink, _Stage(load, None))
+        entries = ["source_{}".format(i) for i in range(sources)]
+        return "item", entries, [], args.fanout, objects
+    if topology == "watchdog":
+        restart = 'start_timer("watchdog", {})'.format(args.timeout)
+        s = {"name": "s", "entry": restart}
+        t3 = {"trigger": "watchdog", "source": "s", "target": "s", "effect": "expire"}
+        machine_type = _machine_type(
+            "kick", "kick(*); " + restart, states=[s], extra=[t3]
+        )
+        for i in range(machines):
+            add(machine_type, "watchdog_{}".format(i), _Watchdog(load))
+        entries = ["watchdog_{}".format(i) for i in range(machines)]
+        return "kick", entries, [], 1, objects
+    raise ValueError("Unknown topology {}.".format(topology))
+
+
+def _rss():
+    """Return the resident memory of this process in bytes, if available."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # peak instead of current memory, in kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _wait_until_idle(driver, timeout):
+    deadline = time.perf_counter() + timeout
+    while driver.queue_metrics()["queued"] and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+
+def run(args):
+    driver = Driver()
+    load = _Load()
+    trigger, entries, extra, ends, objects = build(
+        args.topology, driver, load, args.machines, args
+    )
+    driver.start(keep_active=True)
+    _wait_until_idle(driver, args.drain)
+    rss_start = _rss()
+    samples = []
+    sent = 0
+    start = time.perf_counter()
+    next_sample = start
+    while True:
+        now = time.perf_counter()
+        elapsed = now - start
+        if elapsed >= args.duration:
+            break
+        for _ in range(int(elapsed * args.rate) - sent):
+            stm_id = entries[sent % len(entries)]
+            driver.send(trigger, stm_id, args=[time.perf_counter()] + extra)
+            sent += 1
+        if now >= next_sample:
+            samples.append(
+                {
+                    "time": round(elapsed, 3),
+                    "queued": driver.queue_metrics()["queued"],
+                    "rss": _rss(),
+                }
+            )
+            next_sample += args.interval
+        time.sleep(0.0005)
+    elapsed = time.perf_counter() - start
+    _wait_until_idle(driver, args.drain)
+    rss_end = _rss()
+    # stop all machines, and look for timers they left behind
+    driver.send_many(("stop", obj.stm.id, None, None) for obj in objects)
+    _wait_until_idle(driver, args.drain)
+    leaked = [
+        timer
+        for timer in driver._active_timers()
+        if timer["stm"].id not in driver._stms_by_id
+    ]
+    driver.stop()
+    driver.wait_until_finished()
+    latency = load.latency.snapshot()
+    return {
+        "topology": args.topology,
+        "machines": len(objects),
+        "duration": elapsed,
+        "sent": sent,
+        "sent_per_s": sent / elapsed,
+        "completed": latency["count"],
+        "expected": sent * ends,
+        "completed_per_s": latency["count"] / elapsed,
+        "latency": {key: value for key, value in latency.items() if key != "count"},
+        "queue_depth": samples,
+        "rss_start": rss_start,
+        "rss_end": rss_end,
+        "expired_timers": sum(getattr(obj, "expired", 0) for obj in objects),
+        "leaked_timers": len(leaked),
+    }
+
+
+def _megabytes(size):
+    return "n/a" if size is None else "{:.1f} MB".format(size / 1048576)
+
+
+def report(result):
+    lines = []
+    lines.append(
+        "{} with {} machines for {:.1f} s".format(
+            result["topology"], result["machines"], result["duration"]
+        )
+    )
+    lines.append(
+        "sent       {:>10} ({:.0f}/s)".format(result["sent"], result["sent_per_s"])
+    )
+    lines.append(
+        "completed  {:>10} of {} ({:.0f}/s)".format(
+            result["completed"], result["expected"], result["completed_per_s"]
+        )
+    )
+    latency = result["latency"]
+    lines.append(
+        "latency    p50 {:.3f} ms, p99 {:.3f} ms, p999 {:.3f} ms, max {:.3f} ms".format(
+            latency["p50"] * 1000,
+            latency["p99"] * 1000,
+            latency["p999"] * 1000,
+            latency["max"] * 1000,
+        )
+    )
+    lines.append("queue depth over time:")
+    for sample in result["queue_depth"]:
+        lines.append(
+            "  {:>8.1f} s {:>10} queued {:>12}".format(
+                sample["time"], sample["queued"], _megabytes(sample["rss"])
+            )
+        )
+    growth = None
+    if result["rss_start"] is not None and result["rss_end"] is not None:
+        growth = result["rss_end"] - result["rss_start"]
+    lines.append(
+        "memory     {} at start, {} at end, growth {}".format(
+            _megabytes(result["rss_start"]),
+            _megabytes(result["rss_end"]),
+            _megabytes(growth),
+        )
+    )
+    if result["topology"] == "watchdog":
+        lines.append("expired    {:>10} timers".format(result["expired_timers"]))
+    lines.append(
+        "leaked     {:>10} timers of terminated machines".format(
+            result["leaked_timers"]
+        )
+    )
+    return "\n".join(lines)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m stmpy.loadgen", description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument(
+        "--topology",
+        choices=["pingpong", "pipeline", "fanout", "watchdog"],
+        default="pingpong",
+    )
+    parser.add_argument("--machines", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=10000, help="messages per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--hops", type=int, default=2, help="for pingpong")
+    parser.add_argument("--stages", type=int, default=4, help="for pipeline")
+    parser.add_argument("--fanout", type=int, default=8, help="for fanout")
+    parser.add_argument("--timeout", type=int, default=1000, help="for watchdog, ms")
+    parser.add_argument(
+        "--interval", type=float, default=1, help="seconds between samples"
+    )
+    parser.add_argument(
+        "--drain", type=float, default=10, help="seconds to wait for the queue"
+    )
+    parser.add_argument("--json", help="file to write the report to")
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    result = run(args)
+    print(report(result))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
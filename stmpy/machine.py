@@ -1,6 +1,14 @@
+import asyncio
 import logging
-from threading import Thread
 from ast import literal_eval
+from inspect import iscoroutine
+from inspect import iscoroutinefunction
+
+from .event import _NO_ARGS
+from .event import _NO_KWARGS
+from .event import _Event
+from .profiling import _compiled
+from .queues import _DeferQueue
 
 
 def _parse_arg_list(arglist):
@@ -65,6 +73,9 @@ def _parse_action_list_attribute(attribute):
     return actions
 
 
+_PROCESS_MARKER = "process:"
+
+
 def _is_state_machine_method(name):
     return name in ["start_timer", "stop_timer", "send", "terminate"]
 
@@ -73,13 +84,51 @@ def _tid(state_id, event_id):
     return state_id + "_" + event_id
 
 
-class Machine:
+class MachineType:
     """
-    Implements a state machine.
+    A definition of state machines, shared by many machines.
 
-    A machine must be added to a driver to execute it.
+    A type parses and validates its transitions and states once. Machines
+    created with `create` only hold their name, their state, their object
+    and their deferred events, and share the compiled transitions of their
+    type, so that large numbers of machines with the same behavior are
+    cheap to create and to keep.
+
+        #!python
+        counter = MachineType(transitions=[t0, t1], states=[s1])
+        machines = [counter.create('stm_{}'.format(i), Counter()) for i in range(50000)]
+
+    The arguments are those of `stmpy.Machine`, except `name` and `obj`.
     """
 
+    def __init__(
+        self,
+        transitions,
+        states=None,
+        do_executor=None,
+        priorities=None,
+        capacity=None,
+        overflow=None,
+    ):
+        self._table = {}
+        self._transitions = {}
+        self._states = {}
+        if states == None:
+            states = []
+        self._parse_states(states)
+        self._parse_transitions(transitions, states)
+        self._do_executor = do_executor
+        self._priorities = priorities or {}
+        self._capacity = capacity
+        self._overflow = overflow or {}
+        # compiled states and initial transition, shared by the machines of
+        # this type, or bound to the single machine of a private type
+        self._compiled_states = None
+        self._initial = None
+        self._private = False
+        # number of drivers that profile the actions of this type
+        self._profilers = 0
+
     def _parse_transitions(self, transitions, states):
         self._initial_transition = None
         for transition_string in transitions:
@@ -95,13 +144,14 @@ class Machine:
                 # TODO error handling: what if several transition with same
                 # id start from same source state?
                 self._table[t_id] = transition
+                self._transitions.setdefault(source, {})[trigger] = transition
         if self._initial_transition is None:
             raise Exception("The machine has no initial transition")
         # parse states for internal transitions
         for s_dict in states:
             source = s_dict["name"]
             for key in s_dict.keys():
-                if key not in ["name", "entry", "exit"]:
+                if key not in ["name", "entry", "exit", "do_executor"]:
                     t_id = _tid(source, key)
                     transition = _Transition(
                         {
@@ -112,6 +162,7 @@ class Machine:
                         }
                     )
                     self._table[t_id] = transition
+                    self._transitions.setdefault(source, {})[key] = transition
 
     def _parse_states(self, states):
         for s_dict in states:
@@ -120,7 +171,129 @@ class Machine:
             # initial state cannot be detailed
             self._states[name] = _State(s_dict)
 
-    def __init__(self, name, transitions, obj, states=None):
+    def create(self, name, obj):
+        """
+        Create a machine of this type.
+
+        `name`: Name of the state machine.
+
+        `obj`: An object that encapsulates any actions called from states or transitions.
+
+        Unlike the machines created by `stmpy.Machine`, machines of a type do
+        not look up the methods of `obj` when they are added to a driver, but
+        each time an action runs.
+        """
+        machine = Machine.__new__(Machine)
+        machine._setup(name, obj, self)
+        return machine
+
+    def _compile(self, compile_action):
+        """
+        Compile the states and transitions for dispatch.
+
+        Each state gets a dictionary from trigger to compiled transition, and
+        each action is compiled by `compile_action` into a function
+        `(stm, args, kwargs)`. Returns the compiled states and the compiled
+        initial transition.
+        """
+        states = {}
+        names = set(self._states) | set(self._transitions)
+        for transition in self._table.values():
+            if transition.target:
+                names.add(transition.target)
+        names.discard("final")
+        for name in names:
+            if name in self._states:
+                state = self._states[name]
+                states[name] = _CompiledState(
+                    name,
+                    entry=tuple(compile_action(action) for action in state.entry),
+                    exit=tuple(compile_action(action) for action in state.exit),
+                    do=state.do[0] if state.do else None,
+                    do_executor=state.do_executor,
+                    defers=frozenset(state.defer),
+                )
+            else:
+                states[name] = _CompiledState(name)
+        for name, transitions in self._transitions.items():
+            compiled = states[name].transitions
+            for trigger, transition in transitions.items():
+                compiled[trigger] = _compile_transition(transition, compile_action)
+        initial = _compile_transition(self._initial_transition, compile_action)
+        return states, initial
+
+    def _compile_shared(self):
+        """Compile the states and transitions once for all machines of this type."""
+        if self._compiled_states is None:
+            self._compiled_states, self._initial = self._compile(_compile_shared_action)
+
+
+def _compile_transition(transition, compile_action):
+    return _CompiledTransition(
+        effect=tuple(compile_action(action) for action in transition.effect),
+        target=transition.target,
+        function=None if transition.target else transition.function,
+        internal=transition.internal,
+    )
+
+
+def _compile_shared_action(action):
+    """
+    Compile an action into a function `(stm, args, kwargs)` for any machine.
+
+    Built-in actions are called on the machine, and methods are looked up on
+    the object of the machine when the action runs.
+    """
+    name = action["name"].strip()
+    args = action["args"]
+    event_args = action["event_args"]
+    if _is_state_machine_method(name):
+        if event_args:
+            return lambda stm, a, k: stm._run_state_machine_function(name, a, k)
+        if name == "start_timer" and len(args) == 2:
+            timer_id, timeout = args
+            return lambda stm, a, k: stm.start_timer(timer_id, timeout)
+        if name == "stop_timer" and len(args) == 1:
+            timer_id = args[0]
+            return lambda stm, a, k: stm.stop_timer(timer_id)
+        if name == "terminate":
+            return lambda stm, a, k: stm.terminate()
+        return lambda stm, a, k: stm._run_state_machine_function(name, args, _NO_KWARGS)
+    if event_args:
+        return lambda stm, a, k: stm._run_function(stm._obj, name, a, k)
+    return lambda stm, a, k: stm._run_function(stm._obj, name, args, _NO_KWARGS)
+
+
+class Machine:
+    """
+    Implements a state machine.
+
+    A machine must be added to a driver to execute it.
+    """
+
+    __slots__ = (
+        "_id",
+        "_obj",
+        "_type",
+        "_current",
+        "_defer_queue",
+        "_driver",
+        "__weakref__",
+    )
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        name,
+        transitions,
+        obj,
+        states=None,
+        do_executor=None,
+        priorities=None,
+        capacity=None,
+        overflow=None,
+    ):
         """Create a new state machine.
 
         Throws an exception if the state machine is not well-formed.
@@ -223,6 +396,10 @@ class Machine:
         means that the state machine uses the args and kwargs of the incoming
         event and offers them to the method.
 
+        The methods of `obj` are looked up once, before the machine executes
+        its initial transition. Methods that `obj` does not have at that time
+        are looked up each time the action is executed.
+
         The actions can also directly refer to the state machine actions
         `stmpy.Machine.start_timer` and `stmpy.Machine.stop_timer`.
         A transition can for instance declare the following effects:
@@ -252,6 +429,28 @@ class Machine:
             s1 = {'name': 's1',
                   'do': 'do_action("a")'}
 
+        By default, each do-action runs in a new thread. A driver can instead
+        provide executors with a bounded number of threads, see
+        `stmpy.Driver.add_executor`. A state selects the executor for its
+        do-action by its name via the key `do_executor`, which overrides the
+        executor selected for the whole machine:
+
+            #!python
+            s1 = {'name': 's1',
+                  'do': 'do_action("a")',
+                  'do_executor': 'io'}
+
+        A do-action that starts with `process:` is process-bound. It runs in
+        the process pool of the driver named `'process'`, so that CPU-bound
+        activities do not stall the other machines of the driver. The action
+        and its arguments are pickled, so it must be a function or a
+        `staticmethod` of `obj`, and its return value is passed as the
+        argument of the `done` event:
+
+            #!python
+            s1 = {'name': 's1',
+                  'do': 'process: score(*)'}
+
         `name`: Name of the state machine. This name is used to send messages to it, and show its state during debugging.
 
         `transitions`: A set of transitions, as explained above. There must be at least one initial transition.
@@ -259,18 +458,49 @@ class Machine:
         `obj`: An object that encapsulates any actions called from states or transitions.
 
         `states`: Optional state declarations to add entry and exit actions to them.
+
+        `do_executor`: Optional name of the driver executor that runs the do-actions of this machine.
+
+        `priorities`: Optional dictionary from triggers to the priority with which messages with this trigger are queued by default, see `stmpy.Driver.send`.
+
+        `capacity`: Optional maximal number of queued events of this machine, instead of the `machine_capacity` of the driver.
+
+        `overflow`: Optional dictionary from triggers to the policy for messages with this trigger when the queue is full, instead of the `overflow` policy of the driver. See `stmpy.Driver`.
         """
-        self._logger = logging.getLogger(__name__)
-        self._state = "initial"
+        machine_type = MachineType(
+            transitions, states, do_executor, priorities, capacity, overflow
+        )
+        machine_type._private = True
+        self._setup(name, obj, machine_type)
+
+    def _setup(self, name, obj, machine_type):
+        self._current = _INITIAL_STATE
         self._obj = obj
         self._id = name
-        self._table = {}
-        self._states = {}
-        if states == None:
-            states = []
-        self._parse_states(states)
-        self._parse_transitions(transitions, states)
+        self._type = machine_type
+        # created when the first event is deferred
         self._defer_queue = None
+        self._driver = None
+
+    @property
+    def _state(self):
+        return self._current.name
+
+    @property
+    def _table(self):
+        return self._type._table
+
+    @property
+    def _transitions(self):
+        return self._type._transitions
+
+    @property
+    def _states(self):
+        return self._type._states
+
+    @property
+    def _initial_transition(self):
+        return self._type._initial_transition
 
     @property
     def state(self):
@@ -291,46 +521,140 @@ class Machine:
         return self._driver
 
     def _reset(self):
-        self._state = "initial"
+        self._current = _INITIAL_STATE
 
-    def _run_function(self, obj, function_name, args, kwargs, asynchronous=False):
-        function_name = function_name.strip()
-        self._logger.debug("Running function {}.".format(function_name))
-        func = getattr(obj, function_name)
-        if asynchronous:
+    def _compile(self):
+        """
+        Prepare the states and transitions of this machine for dispatch.
+
+        This happens when the machine is added to a driver. Machines created
+        by a `MachineType` use the compilation shared by their type. Other
+        machines are only compiled by `_bind` before their first transition,
+        so that adding them to a driver stays cheap.
+        """
+        if not self._type._private:
+            self._type._compile_shared()
+
+    def _bind(self):
+        """
+        Compile the private states and transitions of this machine, if needed.
 
-            def running(function, args, kwargs):
+        Built-in actions like `start_timer` are bound to this machine, and the
+        methods of `obj` are looked up once, so that dispatching an event only
+        takes a dictionary lookup and direct calls. Returns the compiled
+        initial transition.
+        """
+        machine_type = self._type
+        if machine_type._compiled_states is None:
+            machine_type._compiled_states, machine_type._initial = (
+                machine_type._compile(self._compile_action)
+            )
+            _compiled(machine_type)
+        return machine_type._initial
+
+    def _compile_action(self, action):
+        name = action["name"].strip()
+        if _is_state_machine_method(name):
+            return _compile_shared_action(action)
+        args = action["args"]
+        event_args = action["event_args"]
+        try:
+            func = getattr(self._obj, name)
+        except AttributeError:
+            # look the method up again when the action runs, which reports
+            # the error the same way as before compilation
+            return _compile_shared_action(action)
+        if iscoroutinefunction(func):
+            func = self._awaiting(func)
+
+        if event_args:
+
+            def run(stm, a, k):
                 try:
-                    function(*args, **kwargs)
-                except AttributeError as error:
-                    self._logger.error(
-                        "Error when running function {} from machine.".format(
-                            function_name
-                        ),
-                        exc_info=True,
-                    )
-                # dispatch completion event
-                self._logger.debug(
-                    "Do action complete, sending completion action after done.".format()
-                )
-                self._driver._add_event(
-                    event_id="done", args=args, kwargs=kwargs, stm=self
-                )
+                    func(*a, **k)
+                except AttributeError:
+                    self._log_function_error(name)
+
+        elif args:
+
+            def run(stm, a, k):
+                try:
+                    func(*args)
+                except AttributeError:
+                    self._log_function_error(name)
+
+        else:
+
+            def run(stm, a, k):
+                try:
+                    func()
+                except AttributeError:
+                    self._log_function_error(name)
+
+        return run
+
+    def _log_function_error(self, function_name):
+        self._logger.error(
+            "Error when running function {} from machine.".format(function_name),
+            exc_info=True,
+        )
 
-            function = getattr(obj, function_name.strip())
-            thread = Thread(target=running, args=[function, args, kwargs])
-            thread.start()
-            self._logger.debug("Started do action.".format())
+    def _run_function(
+        self, obj, function_name, args, kwargs, asynchronous=False, executor=None
+    ):
+        function_name = function_name.strip()
+        if self._driver._trace:
+            self._logger.debug("Running function %s.", function_name)
+        func = getattr(obj, function_name)
+        if asynchronous:
+            self._driver._start_do_action(
+                self, func, function_name, args, kwargs, executor
+            )
+            if self._driver._trace:
+                self._logger.debug("Started do action.")
         else:
             try:
-                func(*args, **kwargs)
+                result = func(*args, **kwargs)
             except AttributeError as error:
-                self._logger.error(
-                    "Error when running function {} from machine.".format(
-                        function_name
-                    ),
-                    exc_info=True,
-                )
+                self._log_function_error(function_name)
+            else:
+                if iscoroutine(result):
+                    self._driver._await(result)
+
+    def _run_do_action(self, function, function_name, args, kwargs):
+        try:
+            result = function(*args, **kwargs)
+            if iscoroutine(result):
+                # the thread of the do-action awaits it before `done`
+                asyncio.run(result)
+        except AttributeError as error:
+            self._log_function_error(function_name)
+        # dispatch completion event
+        if self._driver._trace:
+            self._logger.debug(
+                "Do action complete, sending completion action after done."
+            )
+        self._driver._add_event(event_id="done", args=args, kwargs=kwargs, stm=self)
+
+    def _finish_process_action(self, function_name, future):
+        try:
+            args = [future.result()]
+        except Exception:
+            self._log_function_error(function_name)
+            args = _NO_ARGS
+        if self._driver._trace:
+            self._logger.debug(
+                "Do action complete, sending completion action after done."
+            )
+        self._driver._add_event(event_id="done", args=args, kwargs=_NO_KWARGS, stm=self)
+
+    def _awaiting(self, coroutine_function):
+        # hand the coroutines of an action over to the driver, to be awaited
+        # before the driver dispatches the next event
+        def run(*args, **kwargs):
+            self._driver._await(coroutine_function(*args, **kwargs))
+
+        return run
 
     def _run_state_machine_function(self, name, args, kwargs):
         if name == "start_timer":
@@ -349,98 +673,88 @@ class Machine:
     def _initialize(self, driver):
         self._driver = driver
 
-    def _run_actions(self, actions, args=None, kwargs=None):
-        if args == None:
-            args = []
-        if kwargs == None:
-            kwargs = {}
-        for action in actions:
-            if action["event_args"]:  # use the arguments provided by the event
-                args, kwargs = args, kwargs
-            else:  # use the arguments provided in the declaration
-                args, kwargs = action["args"], {}
-            if _is_state_machine_method(action["name"]):
-                self._run_state_machine_function(action["name"], args, kwargs)
-            else:
-                self._run_function(self._obj, action["name"], args, kwargs)
-
     def _defers_event(self, event_id):
-        if self._state in self._states:
-            return event_id in self._states[self._state].defer
-        return False
+        return event_id in self._current.defers
 
     def _add_to_defer_queue(self, event):
         if self._defer_queue is None:
-            self._defer_queue = []
-        # add at beginning, because we reverse when putting back
-        self._defer_queue.insert(0, event)
+            self._defer_queue = _DeferQueue()
+        self._defer_queue.add(event)
 
     def _enter_state(self, state, args, kwargs):
-        self._logger.debug("Machine {} enters state {}".format(self.id, state))
-        if (
-            self._state != state
-            and self._defer_queue != None
-            and len(self._defer_queue) > 0
-        ):
-            self._logger.debug(
-                "Machine {} transfers back {} deferred events into event queue.".format(
-                    self.id, len(self._defer_queue)
-                )
-            )
-            self._driver._event_queue.queue.extendleft(self._defer_queue)
-            self._defer_queue.clear()
-        if state in self._states:
-            # execute any entry actions
-            self._run_actions(self._states[state].entry)
-            # execute any do actions
-            if self._states[state].do:
-                do_action = self._states[state].do[0]
-                if do_action["event_args"]:
-                    self._run_function(
-                        self._obj, do_action["name"], args, kwargs, asynchronous=True
-                    )
-                else:
-                    self._run_function(
-                        self._obj,
-                        do_action["name"],
-                        do_action["args"],
-                        {},
-                        asynchronous=True,
+        compiled = self._arrive(state)
+        # execute any entry actions
+        for action in compiled.entry:
+            action(self, _NO_ARGS, _NO_KWARGS)
+        if compiled.do is not None:
+            self._start_do(compiled, args, kwargs)
+        self._current = compiled
+
+    def _arrive(self, state):
+        # returns the compiled state, and releases the events it accepts
+        trace = self._driver._trace
+        if trace:
+            self._logger.debug("Machine %s enters state %s", self._id, state)
+        compiled = self._type._compiled_states.get(state)
+        if compiled is None:
+            # target returned by a compound transition that is not declared
+            compiled = self._type._compiled_states[state] = _CompiledState(state)
+        if self._current is not compiled and self._defer_queue:
+            # only events that the new state does not defer go back
+            released = self._defer_queue.release(compiled.defers)
+            if released:
+                if trace:
+                    self._logger.debug(
+                        "Machine %s transfers back %s deferred events into event queue.",
+                        self._id,
+                        len(released),
                     )
-        self._state = state
+                self._driver._add_events_front(released)
+        return compiled
+
+    def _start_do(self, compiled, args, kwargs):
+        do_action = compiled.do
+        if not do_action["event_args"]:
+            args, kwargs = do_action["args"], _NO_KWARGS
+        self._run_function(
+            self._obj,
+            do_action["name"],
+            args,
+            kwargs,
+            asynchronous=True,
+            executor=compiled.do_executor or self._type._do_executor,
+        )
 
     def _exit_state(self, state):
-        self._logger.debug("Machine {} exits state {}".format(self.id, state))
+        self._stop_do(state)
         # execute any exit actions
-        if state in self._states:
-            self._run_actions(self._states[state].exit)
+        for action in self._current.exit:
+            action(self, _NO_ARGS, _NO_KWARGS)
+
+    def _stop_do(self, state):
+        if self._driver._trace:
+            self._logger.debug("Machine %s exits state %s", self._id, state)
+        if self._current.do is not None:
+            self._driver._stop_do_action(self)
 
     def _execute_transition(self, event_id, args, kwargs):
-        previous_state = self._state
-        if self._state == "initial":
-            transition = self._initial_transition
+        previous_state = self._current.name
+        if previous_state == "initial":
+            transition = self._type._initial
+            if transition is None:
+                transition = self._bind()
         else:
-            t_id = _tid(self._state, event_id)
-            if t_id not in self._table:
-                self._logger.warning(
-                    "Machine {} is in state {} and received "
-                    "event {}, but no transition with this event is declared!".format(
-                        self.id, self._state, event_id
-                    )
-                )
-                return
-            else:
-                transition = self._table[t_id]
-                if not transition.internal:
-                    self._exit_state(self._state)
+            transition = self._current.transitions.get(event_id)
+            if transition is None:
+                self._log_unhandled(event_id)
+                return False
+            if not transition.internal:
+                self._exit_state(previous_state)
         # execute all effects
-        self._run_actions(transition.effect, args, kwargs)
+        for action in transition.effect:
+            action(self, args, kwargs)
         if transition.internal:
-            self._logger.debug(
-                "Internal transition in {} state {} triggered by {}".format(
-                    self.id, previous_state, event_id
-                )
-            )
+            target = previous_state
         else:
             if transition.target:
                 # simple transition
@@ -451,18 +765,92 @@ class Machine:
             # go into the next state
             if target == "final":
                 self.terminate()
-                self._logger.debug(
-                    "Transition in {} from {} to final state triggered by {}".format(
-                        self.id, previous_state, event_id
-                    )
-                )
             else:
                 self._enter_state(target, args, kwargs)
-                self._logger.debug(
-                    "Transition in {} from {} to {} triggered by {}".format(
-                        self.id, previous_state, target, event_id
-                    )
-                )
+        if self._driver._trace:
+            self._trace_transition(transition, previous_state, target, event_id)
+        return True
+
+    async def _execute_transition_async(self, event_id, args, kwargs):
+        """
+        Execute a transition like `_execute_transition`, for an AsyncDriver.
+
+        The coroutine of an action is awaited before the next action runs, so
+        that the actions of a transition run in the same order as with
+        `stmpy.Driver`.
+        """
+        previous_state = self._current.name
+        if previous_state == "initial":
+            transition = self._type._initial
+            if transition is None:
+                transition = self._bind()
+        else:
+            transition = self._current.transitions.get(event_id)
+            if transition is None:
+                self._log_unhandled(event_id)
+                return False
+            if not transition.internal:
+                self._stop_do(previous_state)
+                await self._run_actions(self._current.exit, _NO_ARGS, _NO_KWARGS)
+        await self._run_actions(transition.effect, args, kwargs)
+        if transition.internal:
+            target = previous_state
+        else:
+            if transition.target:
+                target = transition.target
+            else:
+                target = transition.function(*args, **kwargs)
+            if target == "final":
+                self.terminate()
+            else:
+                compiled = self._arrive(target)
+                await self._run_actions(compiled.entry, _NO_ARGS, _NO_KWARGS)
+                if compiled.do is not None:
+                    self._start_do(compiled, args, kwargs)
+                self._current = compiled
+        if self._driver._trace:
+            self._trace_transition(transition, previous_state, target, event_id)
+        return True
+
+    async def _run_actions(self, actions, args, kwargs):
+        pending = self._driver._pending
+        for action in actions:
+            action(self, args, kwargs)
+            while pending:
+                await pending.popleft()
+
+    def _log_unhandled(self, event_id):
+        self._logger.warning(
+            "Machine %s is in state %s and received "
+            "event %s, but no transition with this event is declared!",
+            self._id,
+            self._current.name,
+            event_id,
+        )
+
+    def _trace_transition(self, transition, previous_state, target, event_id):
+        if transition.internal:
+            self._logger.debug(
+                "Internal transition in %s state %s triggered by %s",
+                self._id,
+                previous_state,
+                event_id,
+            )
+        elif target == "final":
+            self._logger.debug(
+                "Transition in %s from %s to final state triggered by %s",
+                self._id,
+                previous_state,
+                event_id,
+            )
+        else:
+            self._logger.debug(
+                "Transition in %s from %s to %s triggered by %s",
+                self._id,
+                previous_state,
+                target,
+                event_id,
+            )
 
     def start_timer(self, timer_id, timeout):
         """
@@ -474,7 +862,8 @@ class Machine:
         expiration, but may vary due to the state of the event queue and the
         load of the system.
         """
-        self._logger.debug("Start timer {} in stm {}".format(timer_id, self.id))
+        if self._driver._trace:
+            self._logger.debug("Start timer %s in stm %s", timer_id, self._id)
         self._driver._start_timer(timer_id, timeout, self)
 
     def stop_timer(self, timer_id):
@@ -483,7 +872,8 @@ class Machine:
 
         If the timer is not active, nothing happens.
         """
-        self._logger.debug("Stop timer {} in stm {}".format(timer_id, self.id))
+        if self._driver._trace:
+            self._logger.debug("Stop timer %s in stm %s", timer_id, self._id)
         self._driver._stop_timer(timer_id, self)
 
     def get_timer(self, timer_id):
@@ -494,19 +884,52 @@ class Machine:
         """
         return self._driver._get_timer(timer_id, self)
 
-    def send(self, message_id, args=None, kwargs=None):
+    def send(self, message_id, args=None, kwargs=None, priority=None):
         """
         Send a message to this state machine.
 
         To send a message to a state machine by its name, use
         `stmpy.Driver.send` instead.
+
+        `priority`: Priority of the message, see `stmpy.Driver.send`. By
+        default, the priority declared for the trigger, or 0.
         """
-        if args == None:
-            args = []
-        if kwargs == None:
-            kwargs = {}
-        self._logger.debug("Send {} in stm {}".format(message_id, self.id))
-        self._driver._add_event(event_id=message_id, args=args, kwargs=kwargs, stm=self)
+        if args is None:
+            args = _NO_ARGS
+        if kwargs is None:
+            kwargs = _NO_KWARGS
+        if self._driver._trace:
+            self._logger.debug("Send %s in stm %s", message_id, self._id)
+        if priority is None:
+            priority = self._type._priorities.get(message_id, 0)
+        self._driver._send_event(_Event(message_id, args, kwargs, self, priority))
+
+    def send_many(self, messages):
+        """
+        Send several messages to this state machine.
+
+        `messages` is an iterable of tuples `(message_id, args, kwargs)`,
+        where `args` and `kwargs` may be `None`. The messages are added to
+        the event queue of the driver at once, in their order, with the
+        priorities declared for their triggers. To send messages to several machines, use `stmpy.Driver.send_many`.
+        """
+        events = []
+        for message_id, args, kwargs in messages:
+            if args is None:
+                args = _NO_ARGS
+            if kwargs is None:
+                kwargs = _NO_KWARGS
+            events.append(
+                _Event(
+                    message_id,
+                    args,
+                    kwargs,
+                    self,
+                    self._type._priorities.get(message_id, 0),
+                )
+            )
+        if events:
+            self._driver._send_events(events)
 
     def terminate(self):
         """
@@ -520,6 +943,16 @@ class Machine:
 
 
 class _Transition:
+    __slots__ = (
+        "source",
+        "effect",
+        "trigger",
+        "target",
+        "function",
+        "targets",
+        "internal",
+    )
+
     def __init__(self, t_dict):
         self.source = t_dict["source"]
         if "effect" in t_dict:
@@ -546,6 +979,8 @@ class _Transition:
 
 
 class _State:
+    __slots__ = ("name", "entry", "exit", "do", "do_executor", "internal", "defer")
+
     # TODO does not work with empty entry and exit dict entries.
     def __init__(self, s_dict):
         self.name = s_dict["name"]
@@ -557,16 +992,50 @@ class _State:
             self.exit = _parse_action_list_attribute(s_dict["exit"])
         else:
             self.exit = []
+        self.do_executor = s_dict.get("do_executor")
         if "do" in s_dict:
-            self.do = _parse_action_list_attribute(s_dict["do"])
+            do = s_dict["do"].strip()
+            if do.startswith(_PROCESS_MARKER):
+                do = do[len(_PROCESS_MARKER) :]
+                if self.do_executor is None:
+                    self.do_executor = "process"
+            self.do = _parse_action_list_attribute(do)
         else:
             self.do = []
         self.internal = []
         self.defer = []
         for key in s_dict.keys():
-            if key not in ["entry", "exit", "name", "do"]:
+            if key not in ["entry", "exit", "name", "do", "do_executor"]:
                 value = s_dict[key]
                 if value.strip().lower() == "defer":
                     self.defer.append(key)
                 else:
                     self.internal.append({"trigger": key, "effect_string": s_dict[key]})
+
+
+class _CompiledState:
+    __slots__ = ("name", "entry", "exit", "do", "do_executor", "defers", "transitions")
+
+    def __init__(
+        self, name, entry=(), exit=(), do=None, do_executor=None, defers=frozenset()
+    ):
+        self.name = name
+        self.entry = entry
+        self.exit = exit
+        self.do = do
+        self.do_executor = do_executor
+        self.defers = defers
+        self.transitions = {}
+
+
+class _CompiledTransition:
+    __slots__ = ("effect", "target", "function", "internal")
+
+    def __init__(self, effect, target, function, internal):
+        self.effect = effect
+        self.target = target
+        self.function = function
+        self.internal = internal
+
+
+_INITIAL_STATE = _CompiledState("initial")
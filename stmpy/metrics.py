@@ -0,0 +1,205 @@
+import os
+import socketserver
+from threading import Lock
+from threading import Thread
+
+_SUB_BUCKETS = 16
+"""Buckets per power of two of a histogram, which bounds the relative error."""
+
+_QUANTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+
+_HISTOGRAMS = {
+    "queue_wait": "Time from sending an event until the driver dispatches it.",
+    "action": "Time to execute a transition with all its actions.",
+    "timer_lateness": "Time from the expiration of a timer until the driver notices it.",
+}
+
+_COUNTERS = {
+    "events": "Dispatched events.",
+    "transitions": "Executed transitions.",
+    "deferrals": "Deferred events.",
+    "unhandled": "Events for which the machine declares no transition.",
+}
+
+
+class _Histogram:
+    """
+    Histogram of durations with logarithmic buckets, similar to HDR histograms.
+
+    Durations are counted in microseconds. Below 2 * `_SUB_BUCKETS`, each
+    microsecond has a bucket of its own; above, each power of two is split
+    into `_SUB_BUCKETS` buckets of equal width, so that the relative error of
+    a quantile stays below 1 / `_SUB_BUCKETS`, whatever the range of values.
+    """
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds < 0:
+            seconds = 0.0
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        micros = int(seconds * 1000000)
+        if micros < 2 * _SUB_BUCKETS:
+            index = micros
+        else:
+            shift = micros.bit_length() - 5
+            index = _SUB_BUCKETS * shift + (micros >> shift)
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+    def quantile(self, q, counts=None):
+        """Return the upper bound in seconds of the bucket holding the quantile `q`."""
+        if counts is None:
+            counts = self.counts.copy()
+        total = sum(counts.values())
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index in sorted(counts):
+            seen += counts[index]
+            if seen >= rank:
+                break
+        if index < 2 * _SUB_BUCKETS:
+            upper = index + 1
+        else:
+            shift = index // _SUB_BUCKETS - 1
+            upper = (index % _SUB_BUCKETS + _SUB_BUCKETS + 1) << shift
+        return min(upper / 1000000, self.max)
+
+    def snapshot(self):
+        # copying a dict does not release the interpreter lock
+        counts = self.counts.copy()
+        result = {"count": self.count, "sum": self.sum, "max": self.max}
+        for key, q in _QUANTILES:
+            result[key] = self.quantile(q, counts)
+        return result
+
+
+class _Metrics:
+    """
+    Counters and histograms of a driver.
+
+    Only the thread of the driver records, so recording takes no lock. The
+    lock only guards adding histograms against taking a snapshot.
+    """
+
+    def __init__(self):
+        self.events = 0
+        self.transitions = 0
+        self.deferrals = 0
+        self.unhandled = 0
+        self._histograms = {name: {} for name in _HISTOGRAMS}
+        self._lock = Lock()
+
+    def observe(self, name, key, seconds):
+        histograms = self._histograms[name]
+        histogram = histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms[key] = _Histogram()
+        histogram.record(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {
+                name: list(histograms.items())
+                for name, histograms in self._histograms.items()
+            }
+        result = {name: getattr(self, name) for name in _COUNTERS}
+        for name, items in histograms.items():
+            result[name] = {key: histogram.snapshot() for key, histogram in items}
+        return result
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus(snapshot, prefix="stmpy"):
+    """
+    Return a snapshot of driver metrics in the Prometheus text format.
+
+    Counters are exported as `<prefix>_<name>_total`, and histograms as
+    summaries `<prefix>_<name>_seconds` with the labels `machine_type` and
+    `trigger`. See `stmpy.Driver.metrics`.
+    """
+    lines = []
+    for name, help in _COUNTERS.items():
+        metric = "{}_{}_total".format(prefix, name)
+        lines.append("# HELP {} {}".format(metric, help))
+        lines.append("# TYPE {} counter".format(metric))
+        lines.append("{} {}".format(metric, snapshot[name]))
+    for name, help in _HISTOGRAMS.items():
+        metric = "{}_{}_seconds".format(prefix, name)
+        lines.append("# HELP {} {}".format(metric, help))
+        lines.append("# TYPE {} summary".format(metric))
+        for (machine_type, trigger), values in sorted(
+            snapshot[name].items(), key=lambda item: tuple(map(str, item[0]))
+        ):
+            labels = 'machine_type="{}",trigger="{}"'.format(
+                _escape(machine_type), _escape(trigger)
+            )
+            for key, q in _QUANTILES:
+                lines.append(
+                    '{}{{{},quantile="{}"}} {!r}'.format(metric, labels, q, values[key])
+                )
+            lines.append("{}_sum{{{}}} {!r}".format(metric, labels, values["sum"]))
+            lines.append("{}_count{{{}}} {}".format(metric, labels, values["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(driver, path):
+    """
+    Write the metrics of a driver to a file in the Prometheus text format.
+
+    The file is replaced at once, so that a collector reading it, such as
+    the textfile collector of the node exporter, never sees a partial file.
+    """
+    text = to_prometheus(driver.metrics())
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "w") as file:
+        file.write(text)
+    os.replace(temporary, path)
+
+
+class _MetricsHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # answers any HTTP request, so that Prometheus can scrape the socket
+        self.rfile.readline()
+        while self.rfile.readline().strip():
+            pass
+        body = to_prometheus(self.server.driver.metrics()).encode()
+        self.wfile.write(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+        )
+
+
+class _MetricsServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_prometheus(driver, address):
+    """
+    Serve the metrics of a driver in the Prometheus text format.
+
+    `address` is a tuple `(host, port)`. Each request, for instance a scrape
+    by Prometheus over HTTP, is answered with the current metrics. The
+    server runs in a daemon thread; call `shutdown()` on the returned
+    server to stop it.
+    """
+    server = _MetricsServer(address, _MetricsHandler)
+    server.driver = driver
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,197 @@
+import logging
+from bisect import bisect
+from threading import Lock
+from zlib import crc32
+
+from .driver import Driver
+
+_VIRTUAL_NODES = 64
+
+
+def _hash(key):
+    return crc32(key.encode("utf-8"))
+
+
+class _ShardRing:
+    """
+    Consistent hash ring that maps machine names to shards.
+
+    The hash does not depend on the process, so that all processes of a
+    cluster agree on the placement of a machine.
+    """
+
+    def __init__(self, shards):
+        self._ring = sorted(
+            (_hash("{}#{}".format(shard, node)), shard)
+            for shard in range(shards)
+            for node in range(_VIRTUAL_NODES)
+        )
+        self._keys = [key for key, _ in self._ring]
+
+    def shard_of(self, key):
+        index = bisect(self._keys, _hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class _Directory:
+    """
+    The machines of all drivers of a pool, by their id.
+
+    Drivers look up machines here that they do not handle themselves, so
+    that messages are routed to the driver of the receiving machine. Machines
+    of drivers that were started and stopped again are not found.
+    """
+
+    def __init__(self):
+        self._machines = {}
+        self._lock = Lock()
+
+    def add(self, machine):
+        with self._lock:
+            self._machines[machine.id] = machine
+
+    def remove(self, machine):
+        with self._lock:
+            if self._machines.get(machine.id) is machine:
+                del self._machines[machine.id]
+
+    def get(self, stm_id):
+        stm = self._machines.get(stm_id)
+        if stm is None:
+            return None
+        driver = stm._driver
+        if not driver._active and driver._thread_ident is not None:
+            # the driver stopped, and would never dispatch the message
+            return None
+        return stm
+
+
+class DriverPool:
+    """
+    Runs machines on several drivers, each with a thread of its own.
+
+    The pool partitions its machines into shards, one for each driver. By
+    default, a machine is placed by a consistent hash of its name, so that
+    the same machine always lands on the same driver. A machine can also be
+    placed on a driver explicitly. Each driver runs its machines to
+    completion as usual; machines on different drivers run concurrently.
+
+    Messages sent via `stmpy.DriverPool.send`, `stmpy.Driver.send` of any
+    driver of the pool, or `stmpy.Machine.send` are routed to the driver of
+    the receiving machine via a directory of all machines of the pool.
+    Messages to machines of drivers that stopped are ignored.
+
+        #!python
+        pool = DriverPool(drivers=4)
+        for i in range(1000):
+            pool.add_machine(create_machine("stm_{}".format(i)))
+        pool.start()
+        pool.send("tick", "stm_17")
+        pool.wait_until_finished()
+
+    With Python builds that release the interpreter lock, the drivers run in
+    parallel. With the lock, the pool still keeps busy machines on one
+    driver from delaying the machines on the other drivers.
+    """
+
+    def __init__(self, drivers=2, cpus=None, **kwargs):
+        """
+        Create a pool of drivers.
+
+        `drivers`: Number of drivers of the pool.
+
+        `cpus`: Optional list of CPU numbers. Driver `i` pins its thread to
+        CPU `cpus[i % len(cpus)]`, on platforms that support it.
+
+        Further keyword arguments are passed to the constructor of each
+        `stmpy.Driver`.
+        """
+        if drivers < 1:
+            raise ValueError("A driver pool needs at least one driver.")
+        self._logger = logging.getLogger(__name__)
+        self._drivers = []
+        self._directory = _Directory()
+        for i in range(drivers):
+            if cpus:
+                kwargs["cpus"] = {cpus[i % len(cpus)]}
+            driver = Driver(**kwargs)
+            driver._directory = self._directory
+            self._drivers.append(driver)
+        self._ring = _ShardRing(drivers)
+        self._started = []
+        self._keep_active = False
+
+    @property
+    def drivers(self):
+        """Return the list of drivers of this pool."""
+        return list(self._drivers)
+
+    def shard_of(self, stm_id):
+        """Return the index of the driver for a machine with this name."""
+        return self._ring.shard_of(stm_id)
+
+    def add_machine(self, machine, shard=None):
+        """
+        Add the state machine to one of the drivers of this pool.
+
+        `shard`: Index of the driver that runs the machine. By default, the
+        driver is chosen by the name of the machine, see
+        `stmpy.DriverPool.shard_of`.
+        """
+        if shard is None:
+            shard = self.shard_of(machine.id)
+        driver = self._drivers[shard]
+        driver.add_machine(machine)
+        if self._started and driver not in self._started:
+            # the driver had no machines when the pool started
+            driver.start(keep_active=self._keep_active)
+            self._started.append(driver)
+        return driver
+
+    def start(self, keep_active=False):
+        """
+        Start all drivers of the pool.
+
+        `keep_active`: When true, keep the drivers running even when all
+        their state machines terminated. Otherwise, each driver stops once
+        its machines terminated, and drivers without machines do not start
+        until a machine is added to them.
+        """
+        self._keep_active = keep_active
+        self._started = []
+        for driver in self._drivers:
+            if keep_active or driver._stms_by_id:
+                driver.start(keep_active=keep_active)
+                self._started.append(driver)
+
+    def stop(self):
+        """Stop all drivers of the pool."""
+        for driver in self._started:
+            driver.stop()
+
+    def wait_until_finished(self):
+        """Blocking method to wait until all drivers finished their execution."""
+        for driver in list(self._started):
+            driver.wait_until_finished()
+
+    def send(self, message_id, stm_id, args=None, kwargs=None):
+        """Send a message to a state machine on any driver of this pool."""
+        stm = self._directory.get(stm_id)
+        if stm is None:
+            self._logger.warning(
+                "Machine with name %s cannot be found. Ignoring message %s.",
+                stm_id,
+                message_id,
+            )
+            return
+        stm.send(message_id, args, kwargs)
+
+    def send_many(self, messages):
+        """
+        Send several messages to state machines on the drivers of this pool.
+
+        `messages` is an iterable of tuples `(message_id, stm_id, args,
+        kwargs)`, as for `stmpy.Driver.send_many`. Each driver receives its
+        messages at once, in their order.
+        """
+        self._drivers[0].send_many(messages)
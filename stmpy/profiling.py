@@ -0,0 +1,177 @@
+import pstats
+from threading import Lock
+from time import perf_counter
+
+# guards the number of drivers that profile each machine type
+_lock = Lock()
+
+
+class Profile:
+    """
+    Time spent in the actions of machines, while a driver profiles them.
+
+    A profile is returned by `stmpy.Driver.start_profiling`. For each tuple
+    `(machine, state, trigger, action)`, it counts the calls of the action
+    and the time they took. Entry and exit actions have the trigger
+    `'entry'` and `'exit'`, and the effects of the initial transition the
+    state and trigger `'initial'`.
+
+        #!python
+        profile = driver.start_profiling()
+        time.sleep(30)
+        driver.stop_profiling()
+        profile.stats().sort_stats('cumulative').print_stats(10)
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def _record(self, key, seconds):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def entries(self):
+        """
+        Return a dictionary from `(machine, state, trigger, action)` to a
+        tuple with the number of calls and their cumulative time in seconds.
+        """
+        # copying a dict does not release the interpreter lock
+        return {key: tuple(entry) for key, entry in self._entries.copy().items()}
+
+    def stats(self):
+        """
+        Return the profile as `pstats.Stats`.
+
+        Each action is a function named `state:trigger:action` in a file
+        named after the machine, so that the usual methods of `pstats`, like
+        `sort_stats`, `print_stats` and `dump_stats`, work on it.
+        """
+        return pstats.Stats(_StatsData(self.entries()))
+
+    def collapsed(self):
+        """
+        Return the profile as collapsed stacks, one line for each action.
+
+        Each line lists the machine, state, trigger and action separated by
+        semicolons, followed by the cumulative time in microseconds. This is
+        the input format of flame graph tools such as `flamegraph.pl`.
+        """
+        lines = []
+        for key, (_, seconds) in sorted(
+            self.entries().items(), key=lambda item: tuple(map(str, item[0]))
+        ):
+            frames = ";".join(str(frame).replace(";", ",") for frame in key)
+            lines.append("{} {}".format(frames, round(seconds * 1000000)))
+        return "".join(line + "\n" for line in lines)
+
+
+class _StatsData:
+    """Profile data in the form that `pstats.Stats` loads from profilers."""
+
+    def __init__(self, entries):
+        self.stats = {}
+        for (machine, state, trigger, action), (calls, seconds) in entries.items():
+            function = (str(machine), 0, "{}:{}:{}".format(state, trigger, action))
+            self.stats[function] = (calls, calls, seconds, seconds, {})
+
+    def create_stats(self):
+        pass
+
+
+def _label(action):
+    if action["event_args"]:
+        return "{}(*)".format(action["name"].strip())
+    if action["args"]:
+        return "{}({})".format(
+            action["name"].strip(), ", ".join(repr(arg) for arg in action["args"])
+        )
+    return action["name"].strip()
+
+
+def _profiled(action, state, trigger, label):
+    def run(stm, a, k):
+        profile = stm._driver._profile
+        if profile is None:
+            action(stm, a, k)
+            return
+        start = perf_counter()
+        try:
+            action(stm, a, k)
+        finally:
+            profile._record((stm._id, state, trigger, label), perf_counter() - start)
+
+    run.__wrapped__ = action
+    return run
+
+
+def _wrap(actions, parsed, state, trigger):
+    return tuple(
+        (
+            action
+            if hasattr(action, "__wrapped__")
+            else _profiled(action, state, trigger, _label(definition))
+        )
+        for action, definition in zip(actions, parsed)
+    )
+
+
+def _unwrap(actions, parsed, state, trigger):
+    return tuple(getattr(action, "__wrapped__", action) for action in actions)
+
+
+def _rewrite(machine_type, wrap):
+    """
+    Replace the compiled actions of a machine type by profiled ones, or back.
+
+    The compiled states and transitions are changed in place, so that
+    machines pick up the change with their next transition. Types that are
+    not compiled yet are instrumented when they are compiled.
+    """
+    if machine_type._compiled_states is None:
+        return
+    parsed_states = machine_type._states
+    for name, compiled in list(machine_type._compiled_states.items()):
+        state = parsed_states.get(name)
+        if state is not None:
+            compiled.entry = wrap(compiled.entry, state.entry, name, "entry")
+            compiled.exit = wrap(compiled.exit, state.exit, name, "exit")
+        parsed_transitions = machine_type._transitions.get(name, {})
+        for trigger, transition in list(compiled.transitions.items()):
+            parsed = parsed_transitions[trigger]
+            transition.effect = wrap(transition.effect, parsed.effect, name, trigger)
+    initial = machine_type._initial
+    initial.effect = wrap(
+        initial.effect, machine_type._initial_transition.effect, "initial", "initial"
+    )
+
+
+def _instrument(machine_type):
+    """
+    Profile the actions of a machine type for one more driver.
+
+    A type may be shared by the machines of several drivers, so its actions
+    stay profiled until every driver that instrumented it called
+    `_uninstrument`. Each driver calls these once per type.
+    """
+    with _lock:
+        machine_type._profilers += 1
+        if machine_type._profilers == 1:
+            _rewrite(machine_type, _wrap)
+
+
+def _compiled(machine_type):
+    """Profile the actions of a type that was just compiled, if needed."""
+    with _lock:
+        if machine_type._profilers:
+            _rewrite(machine_type, _wrap)
+
+
+def _uninstrument(machine_type):
+    with _lock:
+        machine_type._profilers -= 1
+        if machine_type._profilers == 0:
+            _rewrite(machine_type, _unwrap)
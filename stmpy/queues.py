@@ -0,0 +1,346 @@
+from collections import deque
+from heapq import merge
+from itertools import count
+from queue import Queue
+
+_INITIAL_PRIORITY = float("inf")
+"""Priority of the initial events of machines, above that of any message."""
+
+
+class _FifoLane(deque):
+    """Events of one priority, in the order in which they were sent."""
+
+    # a deque itself, so that the driver loop only calls into C
+    put = deque.append
+    get = deque.popleft
+
+    def __init__(self, priority):
+        deque.__init__(self)
+        self.priority = priority
+        self.waited = 0
+
+    def put_front(self, events):
+        self.extendleft(reversed(events))
+
+    def depth(self, stm):
+        return sum(1 for event in self if event.stm is stm)
+
+    def drop_oldest(self, stm=None):
+        for index, event in enumerate(self):
+            if stm is None or event.stm is stm:
+                del self[index]
+                return event
+        return None
+
+
+class _MailboxLane:
+    """
+    Events of one priority, with a mailbox for each machine, served round-robin.
+
+    Machines with queued events wait in a ready list. `get` takes up to
+    `quantum` events from the mailbox of the machine at the head of the
+    ready list, and then moves that machine to the end of the list. The
+    events of each machine keep their order, but a machine with a long
+    backlog delays the other machines by at most one quantum.
+    """
+
+    def __init__(self, priority, quantum):
+        self.priority = priority
+        self.waited = 0
+        self._quantum = quantum
+        self._mailboxes = {}
+        self._ready = deque()
+        self._served = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return (event for stm in self._ready for event in self._mailboxes[stm])
+
+    def put(self, event):
+        mailbox = self._mailboxes.get(event.stm)
+        if mailbox is None:
+            mailbox = self._mailboxes[event.stm] = deque()
+            self._ready.append(event.stm)
+        mailbox.append(event)
+        self._size += 1
+
+    def put_front(self, events):
+        for event in reversed(events):
+            mailbox = self._mailboxes.get(event.stm)
+            if mailbox is None:
+                mailbox = self._mailboxes[event.stm] = deque()
+                # the machine re-queues its events while it is served
+                self._ready.appendleft(event.stm)
+                self._served = 0
+            mailbox.appendleft(event)
+            self._size += 1
+
+    def get(self):
+        stm = self._ready[0]
+        mailbox = self._mailboxes[stm]
+        event = mailbox.popleft()
+        self._size -= 1
+        if not mailbox:
+            del self._mailboxes[stm]
+            self._ready.popleft()
+            self._served = 0
+        else:
+            self._served += 1
+            if self._served >= self._quantum:
+                self._ready.rotate(-1)
+                self._served = 0
+        return event
+
+    def depth(self, stm):
+        return len(self._mailboxes.get(stm, ()))
+
+    def clear(self):
+        self._mailboxes.clear()
+        self._ready.clear()
+        self._served = 0
+        self._size = 0
+
+    def drop_oldest(self, stm=None):
+        if stm is None:
+            if not self._ready:
+                return None
+            stm = self._ready[0]
+        mailbox = self._mailboxes.get(stm)
+        if mailbox is None:
+            return None
+        event = mailbox.popleft()
+        self._size -= 1
+        if not mailbox:
+            del self._mailboxes[stm]
+            self._ready.remove(stm)
+        return event
+
+
+class _EventQueue(Queue):
+    """
+    Queue of the events of a driver, with a lane for each priority.
+
+    Events are served from the lane with the highest priority that holds
+    any. To keep a steady stream of urgent events from starving the others,
+    each lane counts how often it was passed over while it had events. Once
+    a lane was passed over `starvation_limit` times, the lane that waited
+    longest is served next.
+
+    Within a lane, events are served in their order, or, with a `quantum`,
+    from a mailbox per machine, see `_MailboxLane`.
+
+    `None` events only wake up the driver, and are counted instead of
+    queued. Besides the methods of `queue.Queue`, the driver calls
+    `_put_many`, `_put_front`, `_events`, `_depth`, `_drop_oldest` and
+    `_clear` while it holds the `mutex` of the queue.
+
+    For the capacity of machines, the queue can count the events of each
+    machine, see `_track`. It then also tracks whether its size is above a
+    high watermark, until it falls back to a low watermark.
+    """
+
+    def __init__(self, quantum=None, starvation_limit=100):
+        if quantum is not None and quantum < 1:
+            raise ValueError("The quantum of mailboxes must be positive.")
+        self._quantum = quantum
+        self._starvation_limit = starvation_limit
+        Queue.__init__(self)
+
+    def _init(self, maxsize):
+        self._lanes = {}
+        # lanes ordered by descending priority
+        self._order = []
+        self._size = 0
+        self._wakeups = 0
+        self._counts = None
+        self._high_watermark = None
+        self._low_watermark = 0
+        self._above = False
+        # when set, a clock that stamps events with the time they are queued
+        self._stamp = None
+        self.queue = self._lane(0)
+
+    def _track(self, high_watermark=None):
+        """Start to count the queued events of each machine."""
+        if self._counts is None:
+            self._counts = {}
+            for event in self._events():
+                self._counts[event.stm] = self._counts.get(event.stm, 0) + 1
+        if high_watermark is not None:
+            self._high_watermark = high_watermark
+            self._low_watermark = high_watermark // 2
+
+    def _lane(self, priority):
+        lane = self._lanes.get(priority)
+        if lane is None:
+            if self._quantum is None:
+                lane = _FifoLane(priority)
+            else:
+                lane = _MailboxLane(priority, self._quantum)
+            self._lanes[priority] = lane
+            self._order = sorted(
+                self._lanes.values(), key=lambda lane: lane.priority, reverse=True
+            )
+        return lane
+
+    def _qsize(self):
+        return self._size + self._wakeups
+
+    def _put(self, event):
+        if event is None:
+            self._wakeups += 1
+            return
+        lane = self._lanes.get(event.priority)
+        if lane is None:
+            lane = self._lane(event.priority)
+        lane.put(event)
+        self._size += 1
+        if self._stamp is not None:
+            event.queued = self._stamp()
+        if self._counts is not None:
+            self._counts[event.stm] = self._counts.get(event.stm, 0) + 1
+
+    def _get(self):
+        if self._wakeups:
+            self._wakeups -= 1
+            return None
+        self._size -= 1
+        served = None
+        for lane in self._order:
+            if lane:
+                if served is None:
+                    served = lane
+                else:
+                    lane.waited += 1
+                    if lane.waited >= self._starvation_limit and (
+                        served.waited < self._starvation_limit
+                        or lane.waited > served.waited
+                    ):
+                        served = lane
+        served.waited = 0
+        event = served.get()
+        if self._counts is not None:
+            self._uncount(event)
+            if self._above and self._size <= self._low_watermark:
+                self._above = False
+        return event
+
+    def _uncount(self, event):
+        count = self._counts[event.stm] - 1
+        if count:
+            self._counts[event.stm] = count
+        else:
+            del self._counts[event.stm]
+
+    def _crossed_high_watermark(self):
+        """Return whether the size just reached the high watermark."""
+        if (
+            self._high_watermark is not None
+            and not self._above
+            and self._size >= self._high_watermark
+        ):
+            self._above = True
+            return True
+        return False
+
+    def _drop_oldest(self, stm=None):
+        """
+        Remove the oldest event, of the given machine or of any machine.
+
+        Events are taken from the lane with the lowest priority first. The
+        initial events of machines are never removed.
+        """
+        for lane in reversed(self._order):
+            if lane.priority == _INITIAL_PRIORITY:
+                continue
+            event = lane.drop_oldest(stm)
+            if event is not None:
+                self._size -= 1
+                if self._counts is not None:
+                    self._uncount(event)
+                return event
+        return None
+
+    def _put_many(self, events):
+        for event in events:
+            self._put(event)
+
+    def _put_front(self, events):
+        for event in reversed(events):
+            self._lane(event.priority).put_front([event])
+            if self._counts is not None:
+                self._counts[event.stm] = self._counts.get(event.stm, 0) + 1
+        self._size += len(events)
+
+    def _events(self):
+        return [event for lane in self._order for event in lane]
+
+    def _clear(self):
+        for lane in self._order:
+            lane.clear()
+        self._size = 0
+        if self._counts is not None:
+            self._counts.clear()
+        self._above = False
+
+    def _depth(self, stm):
+        if self._counts is not None:
+            return self._counts.get(stm, 0)
+        return sum(lane.depth(stm) for lane in self._order)
+
+
+class _DeferQueue:
+    """
+    Deferred events of a machine, indexed by their trigger.
+
+    Each trigger has a deque of its deferred events, numbered in the order
+    in which they were deferred. When the machine enters another state,
+    `release` takes out only the events of the triggers that the state does
+    not defer, and merges them back into their original order. Events that
+    stay deferred are not touched.
+    """
+
+    def __init__(self):
+        self._triggers = {}
+        self._counter = count()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """Iterate over the deferred events in their original order."""
+        if len(self._triggers) == 1:
+            (entries,) = self._triggers.values()
+            return (event for _, event in entries)
+        return (event for _, event in merge(*self._triggers.values()))
+
+    def add(self, event):
+        entries = self._triggers.get(event.id)
+        if entries is None:
+            entries = self._triggers[event.id] = deque()
+        entries.append((next(self._counter), event))
+        self._size += 1
+
+    def release(self, defers):
+        """Remove and return the events not in `defers`, in their original order."""
+        released = [
+            self._triggers.pop(trigger)
+            for trigger in list(self._triggers)
+            if trigger not in defers
+        ]
+        if not released:
+            return []
+        if len(released) == 1:
+            events = [event for _, event in released[0]]
+        else:
+            events = [event for _, event in merge(*released)]
+        self._size -= len(events)
+        return events
+
+    def clear(self):
+        self._triggers.clear()
+        self._size = 0
@@ -0,0 +1,63 @@
+_UNHANDLED = "(unhandled)"
+"""Target of events for which the machine declares no transition."""
+
+_FAILED = "(exception)"
+"""Target of transitions whose actions raised an exception."""
+
+_FINAL = "final"
+"""Target of transitions into the final state."""
+
+
+class _FlightRecorder:
+    """
+    Ring buffer of the most recent transitions of a driver.
+
+    Records are kept in a single list that is allocated once, with one slot
+    for each record, so that recording a transition only stores a tuple
+    `(machine, source, trigger, target)` into its slot. It neither grows
+    any container, reads a clock nor formats any strings. The source and
+    target are the compiled states of the machine, or one of the markers
+    above as target, and their names are only looked up when the records
+    are read. The size is rounded up to a power of two.
+    """
+
+    def __init__(self, size):
+        size = 1 << max(0, size - 1).bit_length()
+        self._mask = size - 1
+        self._records = [None] * size
+        self._count = 0
+
+    def record(self, machine, source, trigger, target):
+        """Record a transition of `machine` from state `source` to `target`."""
+        count = self._count
+        self._records[count & self._mask] = (machine, source, trigger, target)
+        self._count = count + 1
+
+    def entries(self):
+        """
+        Return the recorded transitions, oldest first.
+
+        Each is a tuple `(machine, source, trigger, target)` with the names of
+        the machine and its states. This can be called from any thread, at
+        the risk of missing a record that is just being written.
+        """
+        count = self._count
+        records = self._records[:]
+        entries = []
+        for n in range(max(0, count - self._mask - 1), count):
+            machine, source, trigger, target = records[n & self._mask]
+            if not isinstance(target, str):
+                target = target.name
+            entries.append((machine, source.name, trigger, target))
+        return entries
+
+    def format(self):
+        """Return the recorded transitions as a table, one line each."""
+        lines = []
+        for machine, source, trigger, target in self.entries():
+            lines.append(
+                "{} {} --{}--> {}".format(
+                    machine, source, "initial" if trigger is None else trigger, target
+                )
+            )
+        return "\n".join(lines)
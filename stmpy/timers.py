@@ -0,0 +1,207 @@
+import heapq
+from itertools import count
+
+
+class _HeapTimerQueue:
+    """
+    Timer queue ordered by a binary heap and indexed by timer id.
+
+    Each timer is identified by its `tid`, the pair of machine id and timer
+    name. Starting or restarting a timer pushes a new entry onto the heap in
+    O(log n). Stopping a timer only removes it from the index and marks its
+    heap entry as cancelled, which is O(1). Cancelled entries are discarded
+    lazily once they reach the top of the heap, or when they make up most of
+    the heap.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._timers = {}
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __iter__(self):
+        """Iterate over the active timers, earliest expiration first."""
+        return iter(
+            sorted(self._timers.values(), key=lambda timer: timer["timeout_abs"])
+        )
+
+    def start(self, timer):
+        entry = self._timers.get(timer["tid"])
+        if entry is not None:
+            entry["cancelled"] = True
+        timer["cancelled"] = False
+        self._timers[timer["tid"]] = timer
+        heapq.heappush(self._heap, (timer["timeout_abs"], next(self._counter), timer))
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._timers):
+            self._compact()
+
+    def stop(self, tid):
+        timer = self._timers.pop(tid, None)
+        if timer is not None:
+            timer["cancelled"] = True
+        return timer
+
+    def get(self, tid):
+        return self._timers.get(tid)
+
+    def pop_expired(self, now):
+        """Remove and return all timers that expired at time `now`."""
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if not timer["cancelled"]:
+                del self._timers[timer["tid"]]
+                expired.append(timer)
+        return expired
+
+    def next_timeout_abs(self):
+        """Return the earliest expiration time, or `None` if no timer is active."""
+        heap = self._heap
+        while heap and heap[0][2]["cancelled"]:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][0]
+        return None
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if not entry[2]["cancelled"]]
+        heapq.heapify(self._heap)
+
+
+class _TimingWheel:
+    """
+    Hierarchical timing wheel with a fixed tick resolution.
+
+    Time is divided into ticks of `tick` milliseconds. Level 0 has one slot
+    per tick for the next 64 ticks, and each further level covers 64 times
+    the range of the level below it. Timers beyond the range of the top level
+    wait in an overflow slot. Starting and stopping a timer is O(1): a timer
+    is placed into the slot of its expiration tick and remembers that slot.
+    When level 0 wraps around, the next slot of level 1 is cascaded into
+    level 0, and so on for the higher levels, so the work of sorting timers
+    is amortized over the ticks.
+
+    A timer never expires before its timeout, but may expire up to one tick
+    later than it.
+    """
+
+    _BITS = 6
+    _SLOTS = 1 << _BITS
+    _MASK = _SLOTS - 1
+
+    def __init__(self, tick=10, levels=4, now=0):
+        if tick <= 0:
+            raise ValueError("The tick of a timing wheel must be positive.")
+        if levels < 1:
+            raise ValueError("A timing wheel needs at least one level.")
+        self._tick_ms = tick
+        self._levels = [[{} for _ in range(self._SLOTS)] for _ in range(levels)]
+        self._overflow = {}
+        self._timers = {}
+        self._tick = now // tick
+        self._next_tick = None
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __iter__(self):
+        """Iterate over the active timers, earliest expiration first."""
+        return iter(
+            sorted(self._timers.values(), key=lambda timer: timer["timeout_abs"])
+        )
+
+    def start(self, timer):
+        self.stop(timer["tid"])
+        self._timers[timer["tid"]] = timer
+        # round up, so that a timer never expires before its timeout
+        expires = max(-(-timer["timeout_abs"] // self._tick_ms), self._tick + 1)
+        timer["tick"] = expires
+        self._insert(timer, expires)
+        if self._next_tick is not None and expires < self._next_tick:
+            self._next_tick = expires
+
+    def stop(self, tid):
+        timer = self._timers.pop(tid, None)
+        if timer is not None:
+            del timer["slot"][tid]
+        return timer
+
+    def get(self, tid):
+        return self._timers.get(tid)
+
+    def pop_expired(self, now):
+        """Advance the wheel to time `now` and return the expired timers."""
+        now_tick = now // self._tick_ms
+        if now_tick <= self._tick:
+            return []
+        if not self._timers:
+            # nothing to expire, jump ahead without visiting the ticks
+            self._tick = now_tick
+            self._next_tick = None
+            return []
+        expired = []
+        level_0 = self._levels[0]
+        while self._tick < now_tick:
+            self._tick += 1
+            index = self._tick & self._MASK
+            if index == 0:
+                self._cascade(1)
+            slot = level_0[index]
+            if slot:
+                expired.extend(slot.values())
+                slot.clear()
+        for timer in expired:
+            del self._timers[timer["tid"]]
+        if self._next_tick is not None and self._next_tick <= self._tick:
+            self._next_tick = None
+        if len(expired) > 1:
+            expired.sort(key=lambda timer: timer["timeout_abs"])
+        return expired
+
+    def next_timeout_abs(self):
+        """
+        Return the time at which the wheel needs to advance next, or `None`.
+
+        This is either the tick of the earliest timer in level 0, or the next
+        wrap-around of level 0, at which the higher levels are cascaded.
+        """
+        if not self._timers:
+            return None
+        if self._next_tick is None:
+            level_0 = self._levels[0]
+            tick = self._tick + 1
+            while tick & self._MASK and not level_0[tick & self._MASK]:
+                tick += 1
+            self._next_tick = tick
+        return self._next_tick * self._tick_ms
+
+    def _insert(self, timer, expires):
+        delta = expires - self._tick
+        level = 0
+        while delta >= self._SLOTS and level < len(self._levels):
+            delta >>= self._BITS
+            level += 1
+        if level == len(self._levels):
+            slot = self._overflow
+        else:
+            slot = self._levels[level][(expires >> (self._BITS * level)) & self._MASK]
+        slot[timer["tid"]] = timer
+        timer["slot"] = slot
+
+    def _cascade(self, level):
+        if level == len(self._levels):
+            timers = list(self._overflow.values())
+            self._overflow.clear()
+        else:
+            index = (self._tick >> (self._BITS * level)) & self._MASK
+            if index == 0:
+                self._cascade(level + 1)
+            slot = self._levels[level][index]
+            timers = list(slot.values())
+            slot.clear()
+        for timer in timers:
+            self._insert(timer, timer["tick"])
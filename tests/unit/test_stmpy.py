@@ -2,14 +2,24 @@ from tests import *
 from tests.helpers import *
 import unittest
 import logging
+import multiprocessing
+import os
+import queue
+import asyncio
+import tempfile
+import threading
+import time
 
 import sys
 
 sys.path.insert(0, "../../stmpy")
 
 from stmpy import Machine
+from stmpy import MachineType
 from stmpy import Driver
+from stmpy import DriverPool
 from stmpy import to_promela
+from stmpy import Cluster
 import stmpy
 
 
@@ -451,6 +461,1112 @@ class ToPromela(unittest.TestCase):
         # raise Exception
 
 
+class TimerLogic:
+    def __init__(self):
+        self.expired = []
+
+    def on_expired(self, name):
+        self.expired.append(name)
+
+
+class TimerQueue(unittest.TestCase):
+    def create_driver(self):
+        return Driver()
+
+    def test(self):
+        logic = TimerLogic()
+        t0 = {
+            "source": "initial",
+            "target": "s1",
+            "effect": "start_timer('t3', 30); start_timer('t1', 10); "
+            "start_timer('t2', 20); start_timer('t4', 20); stop_timer('t4'); "
+            "start_timer('t2', 40)",
+        }
+        t1 = {
+            "trigger": "t1",
+            "source": "s1",
+            "target": "s1",
+            "effect": "on_expired('t1')",
+        }
+        t2 = {
+            "trigger": "t2",
+            "source": "s1",
+            "target": "s1",
+            "effect": "on_expired('t2')",
+        }
+        t3 = {
+            "trigger": "t3",
+            "source": "s1",
+            "target": "s1",
+            "effect": "on_expired('t3')",
+        }
+        stm = Machine(name="stm", transitions=[t0, t1, t2, t3], obj=logic)
+
+        driver = self.create_driver()
+        driver.add_machine(stm)
+        driver.start(max_transitions=4)
+        driver.wait_until_finished()
+
+        self.assertEqual(logic.expired, ["t1", "t3", "t2"])
+        self.assertIsNone(stm.get_timer("t4"))
+        self.assertEqual(len(driver._timer_queue), 0)
+
+
+class TimerWheel(TimerQueue):
+    def create_driver(self):
+        return Driver(timer_backend="wheel", timer_tick=5, timer_levels=2)
+
+
+class Simulation(unittest.TestCase):
+    def test(self):
+        tick = Tick()
+        t0 = {
+            "source": "initial",
+            "target": "active",
+            "effect": "start_timer('tick', 1000)",
+        }
+        t1 = {
+            "trigger": "tick",
+            "source": "active",
+            "target": "active",
+            "effect": "start_timer('tick', 60000); print('timeout')",
+        }
+        stm = Machine(name="stm_tick", transitions=[t0, t1], obj=tick)
+        tick.stm = stm
+
+        driver = Driver(simulation=True, clock=stmpy.VirtualClock(start=500))
+        driver.add_machine(stm)
+        driver.start(max_transitions=1001)
+        driver.wait_until_finished()
+
+        self.assertEqual(driver.clock.time_millis(), 500 + 1000 + 999 * 60000)
+        self.assertEqual(stm.get_timer("tick"), 60000)
+
+
+class CompiledDispatch(unittest.TestCase):
+    def test(self):
+        logic = EntryExitSelfLogic()
+        t0 = {"source": "initial", "target": "s1", "effect": "add('init')"}
+        t1 = {"trigger": "b", "source": "s1", "target": "s2", "effect": "add(*)"}
+        t2 = {"trigger": "c", "source": "s2", "target": "final"}
+        s1 = {"name": "s1", "a": "add(1); start_timer('t', 60000)"}
+        s2 = {"name": "s2", "entry": "add('entry'); stop_timer('t')"}
+        stm = Machine(name="stm", transitions=[t0, t1, t2], states=[s1, s2], obj=logic)
+
+        driver = Driver()
+        driver.add_machine(stm)
+        driver.send("a", "stm")
+        driver.send("x", "stm")
+        driver.send("b", "stm", args=["b"])
+        driver.send("a", "stm")
+        driver.send("c", "stm")
+        driver.start()
+        driver.wait_until_finished()
+
+        self.assertEqual(logic.list, ["init", 1, "b", "entry"])
+        self.assertEqual(len(driver._timer_queue), 0)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class Trace(unittest.TestCase):
+    def run_machine(self, trace):
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {"trigger": "a", "source": "s1", "target": "final"}
+        stm = Machine(name="stm", transitions=[t0, t1], obj=None)
+        driver = Driver(trace=trace)
+        driver.add_machine(stm)
+        driver.send("a", "stm")
+        driver.start()
+        driver.wait_until_finished()
+
+    def test(self):
+        logger = logging.getLogger("stmpy.machine")
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        level = logger.level
+        logger.setLevel(logging.DEBUG)
+        try:
+            self.run_machine(trace=False)
+            self.assertEqual(handler.records, [])
+            self.run_machine(trace=True)
+            self.assertTrue(handler.records)
+        finally:
+            logger.setLevel(level)
+            logger.removeHandler(handler)
+
+
+class GcFreeze(unittest.TestCase):
+    def test(self):
+        import gc
+
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {"trigger": "a", "source": "s1", "target": "final"}
+        stm = Machine(name="stm", transitions=[t0, t1], obj=None)
+        driver = Driver(gc_freeze=True)
+        driver.add_machine(stm)
+        driver.send("a", "stm")
+        try:
+            driver.start()
+            driver.wait_until_finished()
+            self.assertGreater(gc.get_freeze_count(), 0)
+        finally:
+            gc.unfreeze()
+        self.assertEqual(stm.state, "s1")
+
+
+class SendMany(unittest.TestCase):
+    def test(self):
+        logics = []
+        driver = Driver()
+        for name in ["stm1", "stm2"]:
+            logic = EntryExitSelfLogic()
+            t0 = {"source": "initial", "target": "s1"}
+            t1 = {"trigger": "a", "source": "s1", "target": "s1", "effect": "add(*)"}
+            t2 = {"trigger": "b", "source": "s1", "target": "final"}
+            stm = Machine(name=name, transitions=[t0, t1, t2], obj=logic)
+            driver.add_machine(stm)
+            logics.append(logic)
+        driver.send_many(
+            [
+                ("a", "stm1", [1], None),
+                ("a", "stm2", [1], None),
+                ("a", "unknown", [1], None),
+                ("a", "stm1", [2], None),
+            ]
+        )
+        stm.send_many([("a", [2], None), ("a", [3], None), ("b", None, None)])
+        driver.send_many([("a", "stm1", [3], {}), ("b", "stm1", None, None)])
+        driver.start()
+        driver.wait_until_finished()
+        self.assertEqual(logics[0].list, [1, 2, 3])
+        self.assertEqual(logics[1].list, [1, 2, 3])
+
+
+class AsyncLogic:
+    def __init__(self):
+        self.list = []
+
+    async def fetch(self, x):
+        await asyncio.sleep(0.01)
+        self.list.append(x)
+
+    def add(self, x):
+        self.list.append(x)
+
+    async def long_activity(self):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.list.append("cancelled")
+            raise
+
+
+class AsyncDriverTestCase(unittest.TestCase):
+    def test(self):
+        logic = AsyncLogic()
+        t0 = {"source": "initial", "target": "s1", "effect": "fetch('a'); add('b')"}
+        t1 = {"trigger": "done", "source": "s1", "target": "s2"}
+        t2 = {"trigger": "t", "source": "s2", "target": "s3", "effect": "add('t')"}
+        t3 = {"trigger": "t", "source": "s3", "target": "final", "effect": "add('t')"}
+        s1 = {"name": "s1", "do": "fetch('do')"}
+        s2 = {"name": "s2", "entry": "start_timer('t', 10)"}
+        s3 = {"name": "s3", "do": "long_activity", "entry": "start_timer('t', 10)"}
+        stm = Machine(
+            name="stm", transitions=[t0, t1, t2, t3], states=[s1, s2, s3], obj=logic
+        )
+
+        async def main():
+            driver = stmpy.AsyncDriver()
+            driver.add_machine(stm)
+            driver.start()
+            await driver.wait_until_finished()
+            await asyncio.sleep(0)
+
+        asyncio.run(main())
+        self.assertEqual(logic.list, ["a", "b", "do", "t", "t", "cancelled"])
+
+    def test_action_order(self):
+        def create_machine(logic):
+            t0 = {"source": "initial", "target": "s1", "effect": "add('initial')"}
+            t1 = {"trigger": "x", "source": "s1", "target": "s2"}
+            t1["effect"] = "fetch('fetch'); add('after')"
+            s1 = {"name": "s1", "exit": "fetch('exit s1')"}
+            s2 = {"name": "s2", "entry": "add('entry s2')"}
+            return Machine(name="stm", transitions=[t0, t1], states=[s1, s2], obj=logic)
+
+        logic = AsyncLogic()
+        driver = Driver()
+        driver.add_machine(create_machine(logic))
+        driver.send("x", "stm")
+        driver.start(max_transitions=2)
+        driver.wait_until_finished()
+
+        async_logic = AsyncLogic()
+
+        async def main():
+            driver = stmpy.AsyncDriver()
+            driver.add_machine(create_machine(async_logic))
+            driver.send("x", "stm")
+            await driver.step(2)
+
+        asyncio.run(main())
+        expected = ["initial", "exit s1", "fetch", "after", "entry s2"]
+        self.assertEqual(logic.list, expected)
+        self.assertEqual(async_logic.list, expected)
+
+    def test_unsupported(self):
+        t0 = {"source": "initial", "target": "s1"}
+        driver = stmpy.AsyncDriver()
+        for options in [{"priorities": {"x": 1}}, {"capacity": 10}]:
+            stm = Machine(name="stm", transitions=[t0], obj=None, **options)
+            with self.assertRaises(ValueError):
+                driver.add_machine(stm)
+        driver.add_machine(Machine(name="stm", transitions=[t0], obj=None))
+        with self.assertRaises(ValueError):
+            driver.send("x", "stm", priority=1)
+
+    def test_threaded_driver(self):
+        logic = AsyncLogic()
+        t0 = {"source": "initial", "target": "s1", "effect": "fetch('a'); add('b')"}
+        t1 = {"trigger": "done", "source": "s1", "target": "s2", "effect": "add('c')"}
+        t2 = {"trigger": "x", "source": "s2", "target": "final", "effect": "fetch(*)"}
+        s1 = {"name": "s1", "do": "fetch('do')", "x": "defer"}
+        stm = Machine(name="stm", transitions=[t0, t1, t2], states=[s1], obj=logic)
+        driver = Driver()
+        driver.add_machine(stm)
+        driver.send("x", "stm", args=["x"])
+        driver.start()
+        driver.wait_until_finished()
+        # coroutines complete within their transition, and do-actions before done
+        self.assertEqual(logic.list, ["a", "b", "do", "c", "x"])
+        self.assertIsNone(driver._action_loop)
+
+        async def main():
+            driver = Driver()
+            stm._reset()
+            driver.add_machine(stm)
+            # as in a replay of a journal on the thread of an event loop
+            stm._execute_transition(None, [], {})
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(main())
+
+
+class Worker:
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def work(self, pool):
+        self.tracker.enter(pool)
+        time.sleep(0.02)
+        self.tracker.leave(pool)
+
+
+class ConcurrencyTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.max_active = {}
+
+    def enter(self, pool):
+        with self.lock:
+            self.active[pool] = self.active.get(pool, 0) + 1
+            self.max_active[pool] = max(self.max_active.get(pool, 0), self.active[pool])
+
+    def leave(self, pool):
+        with self.lock:
+            self.active[pool] = self.active[pool] - 1
+
+
+class DoActionExecutor(unittest.TestCase):
+    def test(self):
+        tracker = ConcurrencyTracker()
+        driver = Driver(do_workers=2)
+        driver.add_executor("io", max_workers=1)
+        for i in range(6):
+            t0 = {"source": "initial", "target": "s1"}
+            t1 = {"trigger": "done", "source": "s1", "target": "s2"}
+            t2 = {"trigger": "done", "source": "s2", "target": "final"}
+            s1 = {"name": "s1", "do": "work('default')"}
+            s2 = {"name": "s2", "do": "work('io')", "do_executor": "io"}
+            stm = Machine(
+                name="stm_{}".format(i),
+                transitions=[t0, t1, t2],
+                states=[s1, s2],
+                obj=Worker(tracker),
+            )
+            driver.add_machine(stm)
+        driver.start()
+        driver.wait_until_finished()
+
+        self.assertEqual(tracker.max_active, {"default": 2, "io": 1})
+        metrics = driver.executor_metrics()
+        self.assertEqual(metrics["default"]["completed"], 6)
+        self.assertEqual(metrics["io"]["submitted"], 6)
+        self.assertEqual(metrics["io"]["max_workers"], 1)
+
+    def test_shutdown(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        tracker = ConcurrencyTracker()
+        own = ThreadPoolExecutor(max_workers=1)
+        driver = Driver(do_workers=1)
+        driver.add_executor("own", executor=own)
+        created = driver._executors["default"].executor
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {"trigger": "done", "source": "s1", "target": "s2"}
+        t2 = {"trigger": "done", "source": "s2", "target": "final"}
+        s1 = {"name": "s1", "do": "work('default')"}
+        s2 = {"name": "s2", "do": "work('own')", "do_executor": "own"}
+        for run in range(2):
+            stm = Machine(
+                name="stm",
+                transitions=[t0, t1, t2],
+                states=[s1, s2],
+                obj=Worker(tracker),
+            )
+            driver.add_machine(stm)
+            driver.start()
+            driver.wait_until_finished()
+            # the executor created by the driver is shut down with its loop,
+            # and created again for the next run
+            self.assertIsNone(driver._executors["default"].executor)
+        self.assertTrue(created._shutdown)
+        # the executor passed to the driver is left running
+        self.assertIs(driver._executors["own"].executor, own)
+        self.assertEqual(own.submit(lambda: 1).result(), 1)
+        own.shutdown()
+        self.assertEqual(driver.executor_metrics()["default"]["completed"], 2)
+
+
+class Scorer:
+    def __init__(self):
+        self.results = []
+
+    @staticmethod
+    def score(n):
+        return sum(i * i for i in range(n))
+
+    def store(self, result):
+        self.results.append(result)
+
+
+class ProcessDoAction(unittest.TestCase):
+    def test(self):
+        scorer = Scorer()
+        driver = Driver(process_workers=1)
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {
+            "trigger": "done",
+            "source": "s1",
+            "target": "final",
+            "effect": "store(*)",
+        }
+        s1 = {"name": "s1", "do": "process: score(1000)"}
+        stm = Machine(name="stm", transitions=[t0, t1], states=[s1], obj=scorer)
+        driver.add_machine(stm)
+        driver.start()
+        driver.wait_until_finished()
+
+        self.assertEqual(scorer.results, [Scorer.score(1000)])
+        metrics = driver.executor_metrics()["process"]
+        self.assertEqual(metrics["completed"], 1)
+        self.assertGreater(metrics["argument_bytes"], 0)
+        self.assertGreater(metrics["result_bytes"], 0)
+
+
+class PingPong:
+    def __init__(self, peer):
+        self.peer = peer
+        self.threads = set()
+
+    def forward(self, count):
+        self.threads.add(threading.get_ident())
+        if count > 0:
+            self.stm.driver.send("ping", self.peer, args=[count - 1])
+        else:
+            self.stm.terminate()
+            self.stm.driver.send("stop", self.peer)
+
+
+class DriverPoolTestCase(unittest.TestCase):
+    def test(self):
+        pool = DriverPool(drivers=3)
+        self.assertEqual(pool.shard_of("stm_a"), pool.shard_of("stm_a"))
+        t0 = {"source": "initial", "target": "s"}
+        t1 = {"trigger": "ping", "source": "s", "target": "s", "effect": "forward(*)"}
+        t2 = {"trigger": "stop", "source": "s", "target": "final"}
+        players = {}
+        for shard, (name, peer) in enumerate([("stm_a", "stm_b"), ("stm_b", "stm_a")]):
+            players[name] = PingPong(peer)
+            stm = Machine(name=name, transitions=[t0, t1, t2], obj=players[name])
+            players[name].stm = stm
+            self.assertIs(pool.add_machine(stm, shard=shard), pool.drivers[shard])
+        pool.start()
+        pool.send("ping", "stm_a", args=[10])
+        pool.wait_until_finished()
+
+        self.assertEqual(len(players["stm_a"].threads), 1)
+        self.assertEqual(len(players["stm_b"].threads), 1)
+        self.assertNotEqual(players["stm_a"].threads, players["stm_b"].threads)
+
+    def test_send_many(self):
+        pool = DriverPool(drivers=2)
+        t0 = {"source": "initial", "target": "s"}
+        t1 = {"trigger": "x", "source": "s", "target": "s", "effect": "add(*)"}
+        t2 = {"trigger": "stop", "source": "s", "target": "final"}
+        logics = [AsyncLogic(), AsyncLogic()]
+        for shard, logic in enumerate(logics):
+            stm = Machine(
+                name="stm_{}".format(shard), transitions=[t0, t1, t2], obj=logic
+            )
+            pool.add_machine(stm, shard=shard)
+        pool.start()
+        # messages to the machine of the other driver are passed on to it
+        pool.drivers[0].send_many(
+            [
+                ("x", "stm_1", [1], None),
+                ("x", "stm_0", [2], None),
+                ("x", "stm_1", [3], None),
+                ("stop", "stm_0", None, None),
+                ("stop", "stm_1", None, None),
+            ]
+        )
+        pool.wait_until_finished()
+
+        self.assertEqual(logics[0].list, [2])
+        self.assertEqual(logics[1].list, [1, 3])
+
+    def test_directory(self):
+        pool = DriverPool(drivers=2)
+        t0 = {"source": "initial", "target": "s"}
+        t1 = {"trigger": "x", "source": "s", "target": "s", "effect": "add(*)"}
+        logic = AsyncLogic()
+        pool.add_machine(Machine(name="stm", transitions=[t0, t1], obj=logic), shard=1)
+        pool.start(keep_active=True)
+        # drivers outside of the pool do not see its machines
+        Driver().send("x", "stm", args=[1])
+        pool.drivers[0].send("x", "stm", args=[2])
+        while not logic.list:
+            time.sleep(0.01)
+        pool.drivers[1].stop()
+        pool.drivers[1].wait_until_finished()
+        # nor do its drivers once the driver of the machine stopped
+        pool.drivers[0].send("x", "stm", args=[3])
+        pool.send("x", "stm", args=[4])
+        pool.stop()
+        pool.wait_until_finished()
+
+        self.assertEqual(logic.list, [2])
+        self.assertEqual(pool.drivers[1].queue_metrics()["queued"], 0)
+
+
+class Relay:
+    def __init__(self, index, peer, counts):
+        self.index = index
+        self.peer = peer
+        self.counts = counts
+
+    def forward(self, count):
+        self.counts[self.index] = self.counts[self.index] + 1
+        if count > 0:
+            self.stm.driver.send("ping", self.peer, args=[count - 1])
+        else:
+            self.stm.terminate()
+            self.stm.driver.send("stop", self.peer)
+
+
+def create_relay(index, name, peer, counts):
+    relay = Relay(index, peer, counts)
+    t0 = {"source": "initial", "target": "s"}
+    t1 = {"trigger": "ping", "source": "s", "target": "s", "effect": "forward(*)"}
+    t2 = {"trigger": "stop", "source": "s", "target": "final"}
+    relay.stm = Machine(name=name, transitions=[t0, t1, t2], obj=relay)
+    return relay.stm
+
+
+class Tally:
+    def __init__(self, index, counts):
+        self.index = index
+        self.counts = counts
+
+    def add(self):
+        self.counts[self.index] = self.counts[self.index] + 1
+
+
+def create_tally(index, name, counts):
+    t0 = {"source": "initial", "target": "s"}
+    t1 = {"trigger": "x", "source": "s", "target": "s", "effect": "add"}
+    return Machine(name=name, transitions=[t0, t1], obj=Tally(index, counts))
+
+
+class ClusterTestCase(unittest.TestCase):
+    def run_cluster(self, channel):
+        counts = multiprocessing.RawArray("q", 2)
+        cluster = Cluster(workers=2, channel=channel, flush_interval=0.0005)
+        cluster.add_machine(
+            "stm_a", create_relay, 0, "stm_a", "stm_b", counts, worker=0
+        )
+        cluster.add_machine(
+            "stm_b", create_relay, 1, "stm_b", "stm_a", counts, worker=1
+        )
+        self.assertEqual(cluster.shard_of("stm_b"), 1)
+        cluster.start()
+        cluster.send("ping", "stm_a", args=[9])
+        cluster.wait_until_finished()
+        self.assertEqual(list(counts), [5, 5])
+
+    def test_pipe(self):
+        self.run_cluster("pipe")
+
+    @unittest.skipUnless(stmpy.cluster._shm_supported(), "no shared memory")
+    def test_shared_memory(self):
+        self.run_cluster("shm")
+
+    def test_stop_after_queued(self):
+        counts = multiprocessing.RawArray("q", 2)
+        cluster = Cluster(workers=2, flush_interval=0.0005)
+        for i, name in enumerate(["stm_a", "stm_b"]):
+            cluster.add_machine(name, create_tally, i, name, counts, worker=i)
+        cluster.start(keep_active=True)
+        cluster.send_many(("x", "stm_a", None, None) for _ in range(2000))
+        cluster.send_many(("x", "stm_b", None, None) for _ in range(2000))
+        cluster.stop()
+        cluster.wait_until_finished()
+        # the workers dispatch all messages sent before they were stopped
+        self.assertEqual(list(counts), [2000, 2000])
+
+    @unittest.skipUnless(stmpy.cluster._shm_supported(), "no shared memory")
+    def test_full_ring(self):
+        channel = stmpy.cluster._RingChannel(64, timeout=0.05)
+        try:
+            channel.send(b"x" * 40)
+            with self.assertRaises(RuntimeError):
+                channel.send(b"x" * 40)
+            channel.stop_reading()
+            with self.assertRaises(RuntimeError):
+                channel.send(b"x" * 40)
+            self.assertEqual(channel.receive(), [b"x" * 40])
+            channel.send(b"x" * 40)
+        finally:
+            channel.close(unlink=True)
+
+
+class Recorder:
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+
+    def record(self, i):
+        self.log.append((self.name, i))
+
+
+class Mailboxes(unittest.TestCase):
+    def test(self):
+        log = []
+        driver = Driver(quantum=10)
+        t0 = {"source": "initial", "target": "s"}
+        t1 = {"trigger": "m", "source": "s", "target": "s", "effect": "record(*)"}
+        for name in ["noisy", "quiet"]:
+            stm = Machine(name=name, transitions=[t0, t1], obj=Recorder(name, log))
+            driver.add_machine(stm)
+        driver.send_many(("m", "noisy", [i], None) for i in range(100))
+        driver.send("m", "quiet", args=[0])
+        # including the initial transitions
+        self.assertEqual(driver.queue_depth("noisy"), 101)
+        self.assertEqual(driver.queue_depth("quiet"), 2)
+        driver.start(max_transitions=103)
+        driver.wait_until_finished()
+
+        self.assertLess(log.index(("quiet", 0)), 20)
+        noisy = [i for name, i in log if name == "noisy"]
+        self.assertEqual(noisy, list(range(100)))
+        self.assertEqual(driver.queue_depth("noisy"), 0)
+
+
+class PriorityLanes(unittest.TestCase):
+    def test(self):
+        log = []
+        driver = Driver(starvation_limit=5)
+        t0 = {"source": "initial", "target": "s"}
+        t1 = {"trigger": "bulk", "source": "s", "target": "s", "effect": "record(*)"}
+        t2 = {"trigger": "ctrl", "source": "s", "target": "s", "effect": "record(*)"}
+        stm = Machine(
+            name="stm",
+            transitions=[t0, t1, t2],
+            obj=Recorder("stm", log),
+            priorities={"ctrl": 5},
+        )
+        driver.add_machine(stm)
+        driver.send_many(("bulk", "stm", [i], None) for i in range(20))
+        driver.send("ctrl", "stm", args=["c0"])
+        stm.send("bulk", args=["urgent"], priority=10)
+        driver.send_many(("ctrl", "stm", ["c{}".format(i)], None) for i in range(1, 20))
+        driver.start(max_transitions=42)
+        driver.wait_until_finished()
+
+        order = [i for _, i in log]
+        self.assertEqual(order[0], "urgent")
+        # bulk events are not starved by the control events
+        self.assertLess(order.index(0), 10)
+        bulk = [i for i in order if isinstance(i, int)]
+        self.assertEqual(bulk, list(range(20)))
+        ctrl = [i for i in order if isinstance(i, str) and i != "urgent"]
+        self.assertEqual(ctrl, ["c{}".format(i) for i in range(20)])
+
+
+class BoundedQueue(unittest.TestCase):
+    def machine(self, name, log, **kwargs):
+        t0 = {"source": "initial", "target": "s"}
+        t1 = {"trigger": "m", "source": "s", "target": "s", "effect": "record(*)"}
+        t2 = {"trigger": "telemetry", "source": "s", "target": "s"}
+        return Machine(
+            name=name, transitions=[t0, t1, t2], obj=Recorder(name, log), **kwargs
+        )
+
+    def test_shedding(self):
+        log = []
+        marks = []
+        driver = Driver(
+            machine_capacity=5,
+            overflow="drop_oldest",
+            high_watermark=8,
+            on_high_watermark=lambda driver, queued: marks.append(queued),
+        )
+        driver.add_machine(
+            self.machine("a", log, overflow={"telemetry": "drop_newest"})
+        )
+        driver.add_machine(self.machine("b", log, capacity=3, overflow={"m": "raise"}))
+        for i in range(10):
+            driver.send("m", "a", args=[i])
+        driver.send("telemetry", "a")
+        driver.send("m", "b", args=[0])
+        driver.send("m", "b", args=[1])
+        with self.assertRaises(queue.Full):
+            driver.send("m", "b", args=[2])
+
+        self.assertEqual(driver.queue_depth("a"), 5)
+        self.assertEqual(marks, [8])
+        metrics = driver.queue_metrics()
+        self.assertEqual(metrics["shed"], 7)
+        self.assertEqual(metrics["shed_by_machine"], {"a": 7})
+        self.assertEqual(metrics["shed_by_trigger"], {"m": 6, "telemetry": 1})
+        driver.start(max_transitions=8)
+        driver.wait_until_finished()
+        self.assertEqual(
+            log, [("a", 6), ("a", 7), ("a", 8), ("a", 9), ("b", 0), ("b", 1)]
+        )
+
+    def test_block(self):
+        log = []
+        driver = Driver(machine_capacity=2)
+        driver.add_machine(self.machine("a", log))
+        driver.start(max_transitions=21)
+        producer = threading.Thread(
+            target=lambda: [driver.send("m", "a", args=[i]) for i in range(20)]
+        )
+        producer.start()
+        producer.join()
+        driver.wait_until_finished()
+        self.assertEqual(log, [("a", i) for i in range(20)])
+
+
+class DeferQueueTestCase(unittest.TestCase):
+    def test(self):
+        log = []
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {"trigger": "next", "source": "s1", "target": "s2"}
+        t2 = {"trigger": "next", "source": "s2", "target": "s3"}
+        t3 = {"trigger": "next", "source": "s3", "target": "s4"}
+        s1 = {"name": "s1", "x": "defer", "y": "defer"}
+        s2 = {"name": "s2", "x": "record(*)", "y": "defer"}
+        s3 = {"name": "s3", "x": "defer", "y": "defer"}
+        s4 = {"name": "s4", "x": "record(*)", "y": "record(*)"}
+        stm = Machine(
+            name="stm",
+            transitions=[t0, t1, t2, t3],
+            states=[s1, s2, s3, s4],
+            obj=Recorder("stm", log),
+        )
+        driver = Driver()
+        driver.add_machine(stm)
+        messages = [("x", [0]), ("y", [1]), ("x", [2]), ("y", [3]), ("x", [4])]
+        driver.send_many((m, "stm", args, None) for m, args in messages)
+        driver.send("next", "stm")
+        driver.send("next", "stm")
+        driver.send("y", "stm", args=[5])
+        driver.send("next", "stm")
+        driver.start(max_transitions=10)
+        driver.wait_until_finished()
+
+        # s2 only releases x, while y stays deferred until s4
+        self.assertEqual([i for _, i in log], [0, 2, 4, 1, 3, 5])
+        self.assertEqual(len(stm._defer_queue), 0)
+
+
+class MachineTypeTestCase(unittest.TestCase):
+    def test(self):
+        log = []
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {"trigger": "next", "source": "s1", "target": "s2"}
+        t2 = {
+            "trigger": "stop",
+            "source": "s2",
+            "target": "final",
+            "effect": "record(9)",
+        }
+        s1 = {"name": "s1", "x": "defer"}
+        s2 = {"name": "s2", "entry": 'stop_timer("t")', "x": "record(*)"}
+        machine_type = MachineType(transitions=[t0, t1, t2], states=[s1, s2])
+        driver = Driver()
+        machines = []
+        for i in range(10):
+            stm = machine_type.create("stm_{}".format(i), Recorder(i, log))
+            driver.add_machine(stm)
+            machines.append(stm)
+        driver.send_many(("x", stm.id, [i], None) for i, stm in enumerate(machines))
+        driver.send_many(("next", stm.id, None, None) for stm in machines)
+        driver.send_many(("stop", stm.id, None, None) for stm in machines)
+        # the driver stops once all machines reached their final state
+        driver.start()
+        driver.wait_until_finished()
+
+        expected = [(i, i) for i in range(10)] + [(i, 9) for i in range(10)]
+        self.assertEqual(sorted(log), sorted(expected))
+        self.assertIs(machines[0]._type, machines[1]._type)
+        self.assertIn("s2", stmpy.to_graphviz(machines[0]))
+
+
+class DriverMetrics(unittest.TestCase):
+    def test(self):
+        log = []
+        t0 = {"source": "initial", "target": "s1", "effect": 'start_timer("t", 0)'}
+        t1 = {"trigger": "next", "source": "s1", "target": "s2"}
+        t2 = {"trigger": "x", "source": "s2", "target": "final", "effect": "record(*)"}
+        s1 = {"name": "s1", "x": "defer", "t": "record(0)"}
+        stm = Machine(
+            name="stm", transitions=[t0, t1, t2], states=[s1], obj=Recorder("stm", log)
+        )
+        driver = Driver(metrics=True)
+        driver.add_machine(stm)
+        driver.send("x", "stm", args=[1])
+        driver.send("y", "stm")
+        driver.send("next", "stm")
+        driver.start()
+        driver.wait_until_finished()
+
+        metrics = driver.metrics()
+        self.assertEqual(metrics["events"], 6)
+        self.assertEqual(metrics["transitions"], 4)
+        self.assertEqual(metrics["deferrals"], 1)
+        self.assertEqual(metrics["unhandled"], 1)
+        self.assertEqual(metrics["action"][("Recorder", "x")]["count"], 1)
+        self.assertEqual(metrics["queue_wait"][("Recorder", "x")]["count"], 2)
+        self.assertEqual(metrics["timer_lateness"][("Recorder", "t")]["count"], 1)
+
+        text = stmpy.metrics.to_prometheus(metrics)
+        self.assertIn("stmpy_transitions_total 4\n", text)
+        self.assertIn(
+            'stmpy_action_seconds_count{machine_type="Recorder",trigger="x"} 1\n',
+            text,
+        )
+
+    def test_disabled(self):
+        driver = Driver()
+        self.assertEqual(driver.metrics()["events"], 0)
+        driver.set_metrics(True)
+        driver.set_metrics(False)
+        self.assertIsNone(driver._event_queue._stamp)
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def test(self):
+        log = []
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {"trigger": "x", "source": "s1", "target": "s2", "effect": "record(*)"}
+        t2 = {"trigger": "x", "source": "s2", "target": "s1", "effect": "record(2)"}
+        s1 = {"name": "s1", "entry": 'start_timer("t", 1000)'}
+        stm = Machine(
+            name="stm", transitions=[t0, t1, t2], states=[s1], obj=Recorder("stm", log)
+        )
+        driver = Driver()
+        driver.add_machine(stm)
+        driver.send("x", "stm", args=[1])
+        driver.start(max_transitions=2)
+        driver.wait_until_finished()
+        profile = driver.start_profiling()
+        driver.send_many(("x", "stm", [1], None) for _ in range(4))
+        driver.start(max_transitions=4)
+        driver.wait_until_finished()
+        self.assertIs(driver.stop_profiling(), profile)
+
+        entries = profile.entries()
+        self.assertEqual(entries[("stm", "s1", "x", "record(*)")][0], 2)
+        self.assertEqual(entries[("stm", "s2", "x", "record(2)")][0], 2)
+        self.assertEqual(
+            entries[("stm", "s1", "entry", "start_timer('t', 1000)")][0], 2
+        )
+        self.assertIn("stm;s2;x;record(2) ", profile.collapsed())
+        stats = profile.stats()
+        self.assertEqual(stats.total_calls, 6)
+        # the actions are restored once profiling stopped
+        compiled = stm._type._compiled_states["s1"]
+        self.assertFalse(hasattr(compiled.entry[0], "__wrapped__"))
+
+    def test_shared_type(self):
+        log = []
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {"trigger": "x", "source": "s1", "target": "s1", "effect": "record(*)"}
+        machine_type = MachineType(transitions=[t0, t1])
+        drivers = [Driver(), Driver()]
+        for i, driver in enumerate(drivers):
+            driver.add_machine(machine_type.create("stm", Recorder(i, log)))
+        profiles = [driver.start_profiling() for driver in drivers]
+        drivers[0].stop_profiling()
+        # the other driver still profiles the actions of the shared type
+        drivers[1].send("x", "stm", args=[1])
+        drivers[1].start(max_transitions=2)
+        drivers[1].wait_until_finished()
+        self.assertEqual(profiles[1].entries()[("stm", "s1", "x", "record(*)")][0], 1)
+        drivers[1].stop_profiling()
+        compiled = machine_type._compiled_states["s1"].transitions["x"]
+        self.assertFalse(hasattr(compiled.effect[0], "__wrapped__"))
+
+
+class LoadGenerator(unittest.TestCase):
+    def test(self):
+        from stmpy import loadgen
+
+        for topology in ["pingpong", "pipeline", "fanout", "watchdog"]:
+            args = loadgen._parser().parse_args(
+                ["--topology", topology, "--machines", "20", "--rate", "500"]
+                + ["--duration", "0.2", "--interval", "0.1"]
+            )
+            result = loadgen.run(args)
+            self.assertEqual(result["completed"], result["expected"])
+            self.assertGreater(result["sent"], 0)
+            self.assertTrue(result["queue_depth"])
+
+
+class CheckpointTestCase(unittest.TestCase):
+    def create_machine(self, log):
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {"trigger": "x", "source": "s1", "target": "s2", "effect": "record(*)"}
+        t2 = {"trigger": "y", "source": "s2", "target": "s3", "effect": "record(3)"}
+        s1 = {"name": "s1", "entry": 'record(0); start_timer("t", 5000)', "y": "defer"}
+        return Machine(
+            name="stm", transitions=[t0, t1, t2], states=[s1], obj=Recorder("stm", log)
+        )
+
+    def test(self):
+        log = []
+        driver = Driver()
+        driver.add_machine(self.create_machine(log))
+        driver.start(keep_active=True)
+        driver.send("y", "stm")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "driver.checkpoint")
+            # taken by the loop while it runs
+            while driver.queue_metrics()["queued"]:
+                time.sleep(0.01)
+            driver.checkpoint(path)
+            driver.stop()
+            driver.wait_until_finished()
+            self.assertEqual(log, [("stm", 0)])
+            # taken while the driver does not run, with a queued event
+            driver.send("x", "stm", args=[7])
+            driver.checkpoint(path)
+
+            log = []
+            restored = Driver()
+            stm = self.create_machine(log)
+            restored.add_machine(stm)
+            restored.restore(path)
+        self.assertEqual(stm.state, "s1")
+        self.assertEqual([event.id for event in stm._defer_queue], ["y"])
+        [timer] = restored._active_timers()
+        self.assertEqual(timer["id"], "t")
+        remaining = timer["timeout_abs"] - restored.clock.time_millis()
+        self.assertTrue(3000 < remaining <= 5000)
+        self.assertEqual([event.id for event in restored._queued_events()], ["x"])
+        restored.start(max_transitions=2)
+        restored.wait_until_finished()
+        # the entry action of s1 did not run again
+        self.assertEqual(log, [("stm", 7), ("stm", 3)])
+        self.assertEqual(stm.state, "s3")
+
+    def test_async_driver(self):
+        log = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "driver.checkpoint")
+
+            async def run():
+                driver = stmpy.AsyncDriver()
+                driver.add_machine(self.create_machine(log))
+                driver.start(keep_active=True)
+                driver.send("y", "stm")
+                while driver._queued_events():
+                    await asyncio.sleep(0.01)
+                driver.checkpoint(path)
+                driver.send("x", "stm", args=[7])
+                driver.stop()
+                await driver.wait_until_finished()
+
+            asyncio.run(run())
+            self.assertEqual(log, [("stm", 0)])
+            log = []
+            stm = self.create_machine(log)
+
+            async def restore():
+                restored = stmpy.AsyncDriver()
+                restored.add_machine(stm)
+                restored.restore(path)
+                self.assertEqual(restored._queued_events(), [])
+                self.assertTrue(3000 < stm.get_timer("t") <= 5000)
+                restored.send("x", "stm", args=[8])
+                await restored.step(2)
+
+            asyncio.run(restore())
+        self.assertEqual(log, [("stm", 8), ("stm", 3)])
+        self.assertEqual(stm.state, "s3")
+
+
+class Rally:
+    def __init__(self, peer, log):
+        self.peer = peer
+        self.log = log
+
+    def ball(self, k):
+        self.log.append((self.stm.id, k))
+        if k > 0:
+            self.stm.driver.send("ball", self.peer, args=[k - 1])
+
+    def rest(self):
+        self.log.append((self.stm.id, "rest"))
+
+
+class JournalTestCase(unittest.TestCase):
+    def create_machines(self, driver, log):
+        t0 = {"source": "initial", "target": "s"}
+        t1 = {"trigger": "ball", "source": "s", "target": "s"}
+        t1["effect"] = 'ball(*); start_timer("t", 1000)'
+        t2 = {"trigger": "t", "source": "s", "target": "w", "effect": "rest"}
+        t3 = {"trigger": "ball", "source": "w", "target": "s", "effect": "ball(*)"}
+        for name, peer in [("a", "b"), ("b", "a")]:
+            rally = Rally(peer, log)
+            rally.stm = Machine(name=name, transitions=[t0, t1, t2, t3], obj=rally)
+            driver.add_machine(rally.stm)
+        return driver
+
+    def test(self):
+        def pending(driver):
+            events = [(e.stm.id, e.id, list(e.args)) for e in driver._queued_events()]
+            timers = [(t["stm"].id, t["id"]) for t in driver._active_timers()]
+            return events, timers
+
+        with tempfile.TemporaryDirectory() as directory:
+            log = []
+            driver = self.create_machines(
+                Driver(simulation=True, journal=directory, journal_commit=3), log
+            )
+            # segments of a few records each
+            driver._journal._segment_size = 64
+            driver.send("ball", "a", args=[6])
+            # stops when both timers expired, but only one was dispatched
+            driver.start(max_transitions=10)
+            driver.wait_until_finished()
+            self.assertGreater(len(os.listdir(directory)), 2)
+
+            replayed_log = []
+            replayed = self.create_machines(Driver(simulation=True), replayed_log)
+            self.assertEqual(replayed.replay(directory), 12)
+            self.assertEqual(replayed_log, log)
+            self.assertEqual(pending(replayed), pending(driver))
+            self.assertEqual(pending(replayed), ([("a", "t", [])], []))
+            for stm_id in ["a", "b"]:
+                self.assertEqual(
+                    replayed._stms_by_id[stm_id].state,
+                    driver._stms_by_id[stm_id].state,
+                )
+            for d in [driver, replayed]:
+                d.send("ball", "b", args=[1])
+                d.start(max_transitions=3)
+                d.wait_until_finished()
+        self.assertEqual(replayed_log, log)
+        self.assertEqual(log[-3:], [("a", "rest"), ("b", 1), ("a", 0)])
+
+    def test_async_driver(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = []
+            driver = Driver(simulation=True, journal=directory)
+            self.create_machines(driver, log)
+            driver.send("ball", "a", args=[6])
+            driver.start(max_transitions=10)
+            driver.wait_until_finished()
+
+            replayed_log = []
+            replayed = self.create_machines(stmpy.AsyncDriver(), replayed_log)
+            self.assertEqual(replayed.replay(directory), 12)
+        self.assertEqual(replayed_log, log)
+        events = [(e.stm.id, e.id) for e in replayed._queued_events()]
+        self.assertEqual(events, [("a", "t")])
+        self.assertEqual(replayed._active_timers(), [])
+        for stm_id in ["a", "b"]:
+            self.assertEqual(
+                replayed._stms_by_id[stm_id].state, driver._stms_by_id[stm_id].state
+            )
+
+
+class Failing:
+    def fail(self):
+        raise ValueError("failed")
+
+
+class FlightRecorder(unittest.TestCase):
+    def test(self):
+        t0 = {"source": "initial", "target": "s1"}
+        t1 = {"trigger": "x", "source": "s1", "target": "s2"}
+        t2 = {"trigger": "x", "source": "s2", "target": "s1"}
+        t3 = {"trigger": "stop", "source": "s1", "target": "final"}
+        t4 = {"trigger": "boom", "source": "s1", "target": "s2", "effect": "fail"}
+        stm = Machine(name="stm", transitions=[t0, t1, t2, t3, t4], obj=Failing())
+        driver = Driver(flight_recorder=3)
+        driver.add_machine(stm)
+        driver.send_many(("x", "stm", None, None) for _ in range(4))
+        driver.send("y", "stm")
+        driver.start(max_transitions=6)
+        driver.wait_until_finished()
+        # the size is rounded up to 4
+        recent = driver.recent_transitions()
+        self.assertEqual(
+            recent,
+            [
+                ("stm", "s2", "x", "s1"),
+                ("stm", "s1", "x", "s2"),
+                ("stm", "s2", "x", "s1"),
+                ("stm", "s1", "y", "(unhandled)"),
+            ],
+        )
+
+        driver._max_transitions = None
+        with self.assertLogs("stmpy.driver", level="ERROR") as logs:
+            with self.assertRaises(ValueError):
+                driver._execute_transition(stm, "boom", (), {}, None)
+        self.assertIn("stm s1 --boom--> (exception)", logs.output[0])
+        driver._execute_transition(stm, "stop", (), {}, None)
+        last = driver.recent_transitions()[-1]
+        self.assertEqual(last, ("stm", "s1", "stop", "final"))
+        self.assertEqual(Driver(flight_recorder=0).recent_transitions(), [])
+
+
 """
 testcases = ['m',
              'm;',